@@ -0,0 +1,72 @@
+"""
+Micro-benchmark for `webquills.sites.validators.normalize_domain`.
+
+Compares the per-call cost of the original implementation (always running the IDNA
+codec) with the current one, both with a cold memo (exercising the ASCII fast path)
+and a warm memo (the steady state for a server seeing the same hosts repeatedly).
+
+Usage (from the project root):
+
+    python benchmarks/bench_normalize_domain.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webquills.settings")
+os.environ.setdefault("IGNORE_ENV_FILE", "true")
+os.environ.setdefault("SECRET_KEY", "For benchmarking only!")
+os.environ.setdefault("WEBQUILLS_ROOT_DOMAIN", "example.com")
+django.setup()
+
+import idna  # noqa: E402
+
+from webquills.sites.validators import normalize_domain  # noqa: E402
+
+HOSTS = [
+    "www.example.com",
+    "Blog.Example.com",
+    "shop.example.com.",
+    "localhost",
+    "münchen.example.com",
+]
+
+
+def original(domain: str) -> str:
+    """normalize_domain as it was before memoization and the ASCII fast path."""
+    domain = domain.strip().lower().rstrip(".")
+    return idna.encode(domain).decode("ascii")
+
+
+def per_call_ns(func, number: int) -> float:
+    total = timeit.timeit(lambda: [func(h) for h in HOSTS], number=number)
+    return total / (number * len(HOSTS)) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=20_000)
+    args = parser.parse_args()
+
+    def cold(domain):
+        normalize_domain.cache_clear()
+        return normalize_domain(domain)
+
+    results = {
+        "original (idna every call)": per_call_ns(original, args.number),
+        "current, cold memo": per_call_ns(cold, args.number),
+        "current, warm memo": per_call_ns(normalize_domain, args.number),
+    }
+    baseline = results["original (idna every call)"]
+    for name, ns in results.items():
+        print(f"{name:30} {ns:10.0f} ns/call  {baseline / ns:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""
+Request-path benchmarks for the multi-tenant hot path.
+
+Seeds a database with many sites (each with a home page, and one in ten with an alias
+domain), then drives requests through the real WSGI `application` and measures the
+latency percentiles and database queries per request of each scenario:
+
+- resolve: a random site's home page, on its primary domain
+- alias_redirect: a random alias domain, redirected to its site's primary domain
+- unknown_host: a host that belongs to no site
+- site_list: the CMS site list, for a logged-in site owner
+- site_create: creating a site through the CMS form (the sites are deleted after)
+
+Results are printed and written as JSON, with the commit and database they were
+measured on. Pass an earlier result file to `--compare` to see the change.
+
+Usage (from the project root):
+
+    python benchmarks/bench_request_path.py [--sites 10000] [--requests 1000]
+    python benchmarks/bench_request_path.py --sites 100000 \\
+        --database-url postgres://localhost/webquills_bench
+
+By default each site count gets its own SQLite database under `var/bench`, which is
+seeded on the first run and reused after. Other databases (PostgreSQL requires
+`psycopg`) should be dedicated to benchmarking, since they are migrated and seeded
+too. Any other settings come from the environment as usual (e.g. `CACHE_URL`), except
+that static files are not hashed, so that no `collectstatic` is needed, and logging is
+disabled, so that console output doesn't skew the timings. Check the status codes
+reported for each scenario to spot errors.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import UTC, datetime
+from pathlib import Path
+from urllib.parse import urlencode
+
+import django
+
+ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ["resolve", "alias_redirect", "unknown_host", "site_list", "site_create"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sites", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=1000, help="Per scenario.")
+    parser.add_argument("--warmup", type=int, default=100, help="Per scenario.")
+    parser.add_argument("--database-url", help="Defaults to a SQLite file per --sites.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--seed", type=int, default=0, help="For the random hosts.")
+    parser.add_argument("--output", type=Path, help="Where to write JSON results.")
+    parser.add_argument("--compare", type=Path, help="Earlier results to compare.")
+    return parser.parse_args()
+
+
+args = parse_args()
+sys.path.insert(0, str(ROOT))
+BENCH_DIR = Path(os.environ.get("DATA_DIR", ROOT / "var")) / "bench"
+BENCH_DIR.mkdir(parents=True, exist_ok=True)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webquills.settings")
+os.environ.setdefault("IGNORE_ENV_FILE", "true")
+os.environ.setdefault("SECRET_KEY", "For benchmarking only!")
+os.environ.setdefault("WEBQUILLS_ROOT_DOMAIN", "example.com")
+os.environ["STATICFILES_STORAGE"] = (
+    "django.contrib.staticfiles.storage.StaticFilesStorage"
+)
+os.environ["DATABASE_URL"] = args.database_url or (
+    f"sqlite:///{BENCH_DIR / f'bench-{args.sites}.sqlite3'}"
+)
+django.setup()
+logging.disable(logging.CRITICAL)
+
+from commoncontent.models import HomePage, Status  # noqa: E402
+from django.apps import apps  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.contrib.auth.models import Group, User  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from django.utils.crypto import get_random_string  # noqa: E402
+
+from webquills.sites import actions  # noqa: E402
+from webquills.sites.models import Domain, Site  # noqa: E402
+from webquills.wsgi import application  # noqa: E402
+
+sites_config = apps.get_app_config("sites")
+SEED_BATCH = 5000
+SITES_PER_OWNER = 100
+ALIAS_DOMAIN = "example.org"
+
+
+#######################################################################################
+# Seeding
+#######################################################################################
+def seed(sites: int) -> None:
+    """Create `sites` benchmark sites, or as many as are missing."""
+    existing = Site.objects.filter(subdomain__startswith="bench").count()
+    if existing >= sites:
+        return
+    owner_count = max(1, sites // SITES_PER_OWNER)
+    names = [f"bench{n}" for n in range(owner_count)]
+    have = set(
+        User.objects.filter(username__in=names).values_list("username", flat=True)
+    )
+    User.objects.bulk_create([User(username=n) for n in names if n not in have])
+    owners = list(User.objects.filter(username__in=names).order_by("pk"))
+    actions.create_default_groups_and_perms()
+    Group.objects.get(name="regular_user").user_set.add(owners[0])
+
+    started = time.perf_counter()
+    now = timezone.now()
+    for start in range(existing, sites, SEED_BATCH):
+        rows = (
+            (owners[i % owner_count], f"Bench {i}", f"bench{i}")
+            for i in range(start, min(start + SEED_BATCH, sites))
+        )
+        created, errors = actions.bulk_create_sites(rows)
+        if errors:
+            raise SystemExit(f"Seeding failed: {errors[:5]}")
+        HomePage.objects.bulk_create(
+            HomePage(
+                site=site,
+                owner_id=site.owner_id,
+                title=site.name,
+                slug="home",
+                admin_name=f"home {site.pk}",
+                status=Status.USABLE,
+                date_published=now,
+            )
+            for site in created
+        )
+        Domain.objects.bulk_create(
+            Domain(
+                site=site,
+                display_domain=f"{site.subdomain}.{ALIAS_DOMAIN}",
+                normalized_domain=f"{site.normalized_subdomain}.{ALIAS_DOMAIN}",
+                is_primary=False,
+                is_canonical=False,
+            )
+            for site in created[::10]
+        )
+        print(f"Seeded {start + len(created)} sites", file=sys.stderr)
+    print(f"Seeding took {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+#######################################################################################
+# Requests
+#######################################################################################
+class QueryCounter:
+    """A database execute wrapper that counts queries."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def call(method, host, path, body=b"", cookies=None, content_type=""):
+    """Send one request through the WSGI application, returning the status code."""
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": host,
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "HTTP_HOST": host,
+        "CONTENT_TYPE": content_type,
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if cookies:
+        environ["HTTP_COOKIE"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
+    status = []
+    result = application(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        for _ in result:
+            pass
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return int(status[0].split()[0])
+
+
+def scenarios(sites: int, rng: random.Random):
+    """Return a function per scenario, which sends its i'th request."""
+    root = sites_config.root_domain
+    owner = User.objects.get(username="bench0")
+    client = Client()
+    client.force_login(owner)
+    session = client.cookies[settings.SESSION_COOKIE_NAME].value
+    login = {settings.SESSION_COOKIE_NAME: session}
+    csrf = get_random_string(32)
+    cms_host = f"bench0.{root}"
+    aliases = list(
+        Domain.objects.filter(normalized_domain__endswith=f".{ALIAS_DOMAIN}")
+        .order_by("pk")
+        .values_list("normalized_domain", flat=True)[:10_000]
+    )
+    run = get_random_string(6).lower()
+
+    def create(i):
+        body = urlencode(
+            {
+                "name": f"New {i}",
+                "subdomain": f"new{run}x{i}",
+                "csrfmiddlewaretoken": csrf,
+            }
+        ).encode()
+        return call(
+            "POST",
+            cms_host,
+            "/cms/sites/create/",
+            body,
+            cookies={**login, settings.CSRF_COOKIE_NAME: csrf},
+            content_type="application/x-www-form-urlencoded",
+        )
+
+    def cleanup():
+        Site.objects.filter(subdomain__startswith=f"new{run}x").delete()
+        Group.objects.filter(name__startswith=f"site:new{run}x").delete()
+
+    return {
+        "resolve": lambda i: call("GET", f"bench{rng.randrange(sites)}.{root}", "/"),
+        "alias_redirect": lambda i: call("GET", rng.choice(aliases), "/"),
+        "unknown_host": lambda i: call("GET", f"nosuch{run}{i}.{root}", "/"),
+        "site_list": lambda i: call("GET", cms_host, "/cms/sites/", cookies=login),
+        "site_create": create,
+    }, cleanup
+
+
+def measure(send, requests: int, warmup: int, counter: QueryCounter) -> dict:
+    for i in range(warmup):
+        send(-1 - i)
+    latencies = []
+    queries = []
+    statuses = Counter()
+    for i in range(requests):
+        before = counter.count
+        started = time.perf_counter_ns()
+        status = send(i)
+        latencies.append((time.perf_counter_ns() - started) / 1e6)
+        queries.append(counter.count - before)
+        statuses[str(status)] += 1
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": requests,
+        "p50_ms": round(percentiles[49], 3),
+        "p99_ms": round(percentiles[98], 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "queries_per_request": round(statistics.fmean(queries), 2),
+        "max_queries": max(queries),
+        "statuses": dict(statuses),
+    }
+
+
+#######################################################################################
+# Reporting
+#######################################################################################
+def git(*command) -> str | None:
+    try:
+        return subprocess.run(
+            ["git", *command], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(sites: int) -> dict:
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "date": datetime.now(UTC).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "database_version": ".".join(map(str, connection.get_database_version())),
+        "cache": settings.CACHES["default"]["BACKEND"],
+        "sites": sites,
+        "total_sites": Site.objects.count(),
+    }
+
+
+def print_results(results: dict, baseline: dict | None) -> None:
+    print(f"{'scenario':16} {'p50 ms':>9} {'p99 ms':>9} {'queries':>8}  statuses")
+    for name, result in results["scenarios"].items():
+        line = (
+            f"{name:16} {result['p50_ms']:9.2f} {result['p99_ms']:9.2f} "
+            f"{result['queries_per_request']:8.1f}  {result['statuses']}"
+        )
+        old = (baseline or {}).get("scenarios", {}).get(name)
+        if old:
+            changes = [
+                f"{key.split('_')[0]} {result[key] / old[key] - 1:+.0%}"
+                for key in ("p50_ms", "p99_ms", "queries_per_request")
+                if old[key]
+            ]
+            line += f"  vs baseline: {', '.join(changes)}"
+        print(line)
+
+
+def main():
+    call_command("migrate", verbosity=0)
+    seed(args.sites)
+    counter = QueryCounter()
+    connection.execute_wrappers.append(counter)
+    rng = random.Random(args.seed)
+    senders, cleanup = scenarios(args.sites, rng)
+    results = {"meta": metadata(args.sites), "scenarios": {}}
+    try:
+        for name in args.scenario or SCENARIOS:
+            results["scenarios"][name] = measure(
+                senders[name], args.requests, args.warmup, counter
+            )
+    finally:
+        cleanup()
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    print_results(results, baseline)
+    output = args.output or BENCH_DIR / (
+        f"results-{(results['meta']['commit'] or 'unknown')[:10]}-"
+        f"{connection.vendor}-{args.sites}.json"
+    )
+    output.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,3 +7,9 @@ class SitesConfig(AppConfig):
     name = "webquills"
     label = "webquills"
     verbose_name = _("WebQuills")
+
+    def ready(self) -> None:
+        from webquills import metrics
+
+        if metrics.metrics_enabled():
+            metrics.install_instrumentation()
@@ -0,0 +1,118 @@
+"""
+Health check endpoints for load balancers and orchestrators.
+
+These are served by a middleware at the top of the stack, so that probes skip
+sessions, CSRF, authentication and site resolution entirely. Probes do not need to
+send a Host header that belongs to a site.
+
+- The liveness endpoint (default `/healthz`) answers immediately if the process can
+  serve requests at all.
+- The readiness endpoint (default `/readyz`) checks the database and cache, each with
+  a timeout, and reports the latency of each check as JSON. It returns 503 if any
+  check fails or times out.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.http import HttpResponse, JsonResponse
+
+LIVENESS_PATH = "/healthz"
+READINESS_PATH = "/readyz"
+
+
+def check_database(alias: str = "default") -> None:
+    """Raise an exception if the database cannot run a trivial query."""
+    connection = connections[alias]
+    # Checks run in a long-lived worker thread, whose connection outlives requests.
+    connection.close_if_unusable_or_obsolete()
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+
+
+def check_cache(alias: str = "default") -> None:
+    """Raise an exception if the cache cannot be read."""
+    caches[alias].get("webquills:health")
+
+
+class HealthCheckMiddleware:
+    """
+    Answers liveness and readiness probes before any other middleware runs. Place it
+    first in MIDDLEWARE.
+    """
+
+    checks = {
+        "database": check_database,
+        "cache": check_cache,
+    }
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.liveness_path = getattr(
+            settings, "WEBQUILLS_HEALTH_LIVENESS_PATH", LIVENESS_PATH
+        )
+        self.readiness_path = getattr(
+            settings, "WEBQUILLS_HEALTH_READINESS_PATH", READINESS_PATH
+        )
+        self.timeout = getattr(settings, "WEBQUILLS_HEALTH_CHECK_TIMEOUT", 1.0)
+        # Probes may arrive thousands of times per minute from many load balancers, so
+        # a readiness result is reused for this many seconds.
+        self.max_age = getattr(settings, "WEBQUILLS_HEALTH_CHECK_MAX_AGE", 1.0)
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.checks), thread_name_prefix="healthcheck"
+        )
+        self._lock = threading.Lock()
+        self._result = None
+        self._result_expires = 0.0
+
+    def __call__(self, request):
+        if request.path == self.liveness_path:
+            return HttpResponse("ok", content_type="text/plain")
+        if request.path == self.readiness_path:
+            return self.readiness()
+        return self.get_response(request)
+
+    def readiness(self):
+        with self._lock:
+            if self._result is None or time.monotonic() >= self._result_expires:
+                self._result = self.run_checks()
+                self._result_expires = time.monotonic() + self.max_age
+            result = self._result
+        return JsonResponse(result, status=200 if result["status"] == "ok" else 503)
+
+    def run_checks(self) -> dict:
+        """Run all checks concurrently, returning a JSON-serializable report."""
+        started = time.perf_counter()
+        futures = {
+            name: self._executor.submit(self._timed, check)
+            for name, check in self.checks.items()
+        }
+        report = {}
+        for name, future in futures.items():
+            remaining = max(0.0, self.timeout - (time.perf_counter() - started))
+            try:
+                report[name] = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                report[name] = {"ok": False, "error": "timeout"}
+        status = "ok" if all(r["ok"] for r in report.values()) else "error"
+        return {"status": status, "checks": report}
+
+    @staticmethod
+    def _timed(check) -> dict:
+        started = time.perf_counter()
+        try:
+            check()
+        except Exception as e:
+            result = {"ok": False, "error": e.__class__.__name__}
+        else:
+            result = {"ok": True}
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        return result
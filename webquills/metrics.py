@@ -0,0 +1,411 @@
+"""
+Per-request instrumentation and query budgets.
+
+The `RequestMetricsMiddleware` measures each request: its duration, the number and
+total time of its SQL queries, its cache calls, and the time spent rendering
+templates. Cache calls and render time are only measured if metrics are enabled
+(by either setting below), since that wraps the cache backends and template
+rendering for the whole process. Measurements are aggregated per view in each
+process, and can be:
+
+- scraped in the Prometheus text format from `WEBQUILLS_METRICS_PATH`, by clients in
+  `WEBQUILLS_METRICS_ALLOWED_IPS`. Each process reports only its own requests.
+- logged per request (`WEBQUILLS_METRICS_LOG`), with the view and site as structured
+  fields (`extra`) of the `webquills.metrics` logger.
+
+Apps can add their own metrics to the endpoint with `registry.add_collector`.
+
+Sites are deliberately not a Prometheus label, since there may be many thousands.
+
+Views and other code can also declare query budgets: a view class (or function) may
+set a `query_budget` attribute, `WEBQUILLS_QUERY_BUDGETS` may set one per URL name,
+and any block of code can be wrapped in `query_budget(name, limit)`. Queries in such
+a block count towards its own budget instead of the view's. Exceeding a budget raises `QueryBudgetExceeded` if `WEBQUILLS_QUERY_BUDGET_ACTION` is "raise"
+(as the test runner sets it, so that N+1 regressions fail tests), and logs a warning
+otherwise.
+"""
+
+from __future__ import annotations
+
+import functools
+import logging
+import threading
+import time
+from collections.abc import Callable, Iterable
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.http import HttpResponse, HttpResponseNotFound
+from django.template.backends.django import Template
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = None
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestMetrics:
+    """The measurements of one request, so far."""
+
+    __slots__ = (
+        "queries",
+        "db_time",
+        "cache_calls",
+        "render_time",
+        "view_queries_start",
+        "budgeted_queries",
+        "view_budgeted_start",
+        "budgets_exceeded",
+        "_cache_depth",
+        "_render_depth",
+        "_budget_depth",
+    )
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.cache_calls = 0
+        self.render_time = 0.0
+        self.view_queries_start = None
+        # Queries issued in query_budget blocks, which have budgets of their own.
+        self.budgeted_queries = 0
+        self.view_budgeted_start = 0
+        self.budgets_exceeded = 0
+        self._cache_depth = 0
+        self._render_depth = 0
+        self._budget_depth = 0
+
+
+_current: ContextVar[RequestMetrics | None] = ContextVar(
+    "webquills_request_metrics", default=None
+)
+
+
+def current_metrics() -> RequestMetrics | None:
+    """Return the measurements of the current request, if it is being measured."""
+    return _current.get()
+
+
+#######################################################################################
+# Instrumentation
+#######################################################################################
+def _count_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db_time += time.perf_counter() - started
+
+
+def count_queries() -> None:
+    """Count the queries of measured requests on every database connection."""
+    for connection in connections.all():
+        if _count_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(_count_query)
+
+
+# Cache methods that are counted. Calls made within another counted call (e.g. the
+# get() within get_or_set()) are not counted again.
+CACHE_METHODS = (
+    "add",
+    "get",
+    "set",
+    "touch",
+    "delete",
+    "get_many",
+    "get_or_set",
+    "has_key",
+    "incr",
+    "decr",
+    "set_many",
+    "delete_many",
+    "clear",
+)
+
+
+def _count_cache_calls(method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        metrics = _current.get()
+        if metrics is None:
+            return method(*args, **kwargs)
+        if metrics._cache_depth == 0:
+            metrics.cache_calls += 1
+        metrics._cache_depth += 1
+        try:
+            return method(*args, **kwargs)
+        finally:
+            metrics._cache_depth -= 1
+
+    wrapper._webquills_metrics = True
+    return wrapper
+
+
+def _time_render(render):
+    @functools.wraps(render)
+    def wrapper(*args, **kwargs):
+        metrics = _current.get()
+        if metrics is None or metrics._render_depth:
+            return render(*args, **kwargs)
+        metrics._render_depth += 1
+        started = time.perf_counter()
+        try:
+            return render(*args, **kwargs)
+        finally:
+            metrics.render_time += time.perf_counter() - started
+            metrics._render_depth -= 1
+
+    wrapper._webquills_metrics = True
+    return wrapper
+
+
+_install_lock = threading.Lock()
+
+
+def metrics_enabled() -> bool:
+    """Return True if metrics are served or logged."""
+    return bool(
+        getattr(settings, "WEBQUILLS_METRICS_PATH", METRICS_PATH)
+        or getattr(settings, "WEBQUILLS_METRICS_LOG", False)
+    )
+
+
+def install_instrumentation() -> None:
+    """
+    Count the cache calls of the configured cache backends, and time the rendering of
+    Django templates. Safe to call more than once. Outside a measured request, the
+    instrumentation only costs a context variable lookup per call.
+
+    Called from `AppConfig.ready` if metrics are enabled.
+    """
+    with _install_lock:
+        classes = {type(caches[alias]) for alias in settings.CACHES}
+        for cls in classes:
+            for name in CACHE_METHODS:
+                method = getattr(cls, name, None)
+                if method is not None and not hasattr(method, "_webquills_metrics"):
+                    setattr(cls, name, _count_cache_calls(method))
+        if not hasattr(Template.render, "_webquills_metrics"):
+            Template.render = _time_render(Template.render)
+
+
+#######################################################################################
+# Query budgets
+#######################################################################################
+def budget_exceeded(name: str, queries: int, limit: int) -> None:
+    """Report that `name` issued more than its budget of queries."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.budgets_exceeded += 1
+    message = f"{name} issued {queries} queries, over its budget of {limit}"
+    if getattr(settings, "WEBQUILLS_QUERY_BUDGET_ACTION", "log") == "raise":
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+class query_budget:
+    """
+    A context manager that reports its block if it issues more than `limit` queries
+    during a measured request.
+    """
+
+    __slots__ = ("name", "limit", "metrics", "start")
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+
+    def __enter__(self):
+        self.metrics = _current.get()
+        if self.metrics is not None:
+            self.start = self.metrics.queries
+            self.metrics._budget_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.metrics is None:
+            return
+        queries = self.metrics.queries - self.start
+        self.metrics._budget_depth -= 1
+        if not self.metrics._budget_depth:
+            self.metrics.budgeted_queries += queries
+        if exc_type is None and queries > self.limit:
+            budget_exceeded(self.name, queries, self.limit)
+
+
+#######################################################################################
+# Aggregation
+#######################################################################################
+class MetricsRegistry:
+    """Totals of the measurements of each view, in this process."""
+
+    # (name, help, type) of each total, in the order they are kept.
+    metrics = (
+        ("webquills_requests_total", "Requests served.", "counter"),
+        ("webquills_request_seconds_total", "Time spent serving requests.", "counter"),
+        ("webquills_db_queries_total", "SQL queries issued.", "counter"),
+        ("webquills_db_seconds_total", "Time spent in SQL queries.", "counter"),
+        ("webquills_cache_calls_total", "Cache backend calls.", "counter"),
+        (
+            "webquills_render_seconds_total",
+            "Time spent rendering templates.",
+            "counter",
+        ),
+        ("webquills_query_budget_exceeded_total", "Query budgets exceeded.", "counter"),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: dict[str, list[float]] = {}
+        self._collectors: list[Callable[[], Iterable[str]]] = []
+
+    def add_collector(self, collector: Callable[[], Iterable[str]]) -> None:
+        """
+        Add a function that returns more lines, in the Prometheus text format, for the
+        metrics endpoint. Safe to call more than once with the same function.
+        """
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def record(self, view: str, metrics: RequestMetrics, duration: float) -> None:
+        values = (
+            1,
+            duration,
+            metrics.queries,
+            metrics.db_time,
+            metrics.cache_calls,
+            metrics.render_time,
+            metrics.budgets_exceeded,
+        )
+        with self._lock:
+            totals = self._totals.setdefault(view, [0] * len(values))
+            for i, value in enumerate(values):
+                totals[i] += value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._totals.clear()
+
+    def snapshot(self) -> dict[str, list[float]]:
+        with self._lock:
+            return {view: list(totals) for view, totals in self._totals.items()}
+
+    def prometheus(self) -> str:
+        """Return the totals in the Prometheus text exposition format."""
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+        for i, (name, help_text, kind) in enumerate(self.metrics):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for view, totals in snapshot:
+                lines.append(f'{name}{{view="{_escape_label(view)}"}} {totals[i]:g}')
+        for collector in list(self._collectors):
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = MetricsRegistry()
+
+
+#######################################################################################
+# Middleware
+#######################################################################################
+class RequestMetricsMiddleware:
+    """
+    Measures each request (see the module docstring), and answers requests for the
+    metrics endpoint. Place it near the top of MIDDLEWARE, after the health checks.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.path = getattr(settings, "WEBQUILLS_METRICS_PATH", METRICS_PATH)
+        self.allowed_ips = getattr(
+            settings, "WEBQUILLS_METRICS_ALLOWED_IPS", METRICS_ALLOWED_IPS
+        )
+        self.log = getattr(settings, "WEBQUILLS_METRICS_LOG", False)
+        self.budgets = getattr(settings, "WEBQUILLS_QUERY_BUDGETS", {})
+
+    def __call__(self, request):
+        if self.path and request.path == self.path:
+            return self.metrics_response(request)
+        # Connections are per thread, so this must be checked on each request.
+        count_queries()
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+            self.check_view_budget(request, metrics)
+        finally:
+            _current.reset(token)
+        duration = time.perf_counter() - started
+        match = request.resolver_match
+        view = match.view_name if match else "unresolved"
+        registry.record(view, metrics, duration)
+        if self.log:
+            site = getattr(request, "site", None)
+            logger.info(
+                "%s %s %s %.1fms %d queries",
+                request.method,
+                view,
+                response.status_code,
+                duration * 1000,
+                metrics.queries,
+                extra={
+                    "view": view,
+                    "site_id": site.pk if site is not None else None,
+                    "status": response.status_code,
+                    "duration_ms": round(duration * 1000, 3),
+                    "db_queries": metrics.queries,
+                    "db_ms": round(metrics.db_time * 1000, 3),
+                    "cache_calls": metrics.cache_calls,
+                    "render_ms": round(metrics.render_time * 1000, 3),
+                },
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.view_queries_start = metrics.queries
+            metrics.view_budgeted_start = metrics.budgeted_queries
+
+    def view_budget(self, match) -> int | None:
+        """Return the query budget of the view that served a request, if any."""
+        if match.url_name in self.budgets:
+            return self.budgets[match.url_name]
+        func = match.func
+        view_class = getattr(func, "view_class", None)
+        return getattr(view_class or func, "query_budget", None)
+
+    def check_view_budget(self, request, metrics: RequestMetrics) -> None:
+        match = request.resolver_match
+        if match is None or metrics.view_queries_start is None:
+            return
+        limit = self.view_budget(match)
+        queries = metrics.queries - metrics.view_queries_start
+        queries -= metrics.budgeted_queries - metrics.view_budgeted_start
+        if limit is not None and queries > limit:
+            budget_exceeded(match.view_name, queries, limit)
+
+    def metrics_response(self, request):
+        if request.META.get("REMOTE_ADDR") not in self.allowed_ips:
+            return HttpResponseNotFound()
+        return HttpResponse(
+            registry.prometheus(), content_type="text/plain; version=0.0.4"
+        )
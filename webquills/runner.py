@@ -0,0 +1,24 @@
+"""
+The test runner (see `TEST_RUNNER`), which makes query budgets fail tests.
+"""
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Runs tests with `WEBQUILLS_QUERY_BUDGET_ACTION` set to "raise", so that N+1
+    regressions fail tests rather than log warnings (see `webquills.metrics`).
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._query_budget_action = getattr(
+            settings, "WEBQUILLS_QUERY_BUDGET_ACTION", "log"
+        )
+        settings.WEBQUILLS_QUERY_BUDGET_ACTION = "raise"
+
+    def teardown_test_environment(self, **kwargs):
+        settings.WEBQUILLS_QUERY_BUDGET_ACTION = self._query_budget_action
+        super().teardown_test_environment(**kwargs)
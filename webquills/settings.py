@@ -72,7 +72,8 @@ MEDIA_ROOT = DATA_DIR / "media"
 MEDIA_ROOT.mkdir(parents=True, exist_ok=True)
 
 # ManifestStaticFilesStorage is recommended in production, to prevent outdated
-# Javascript / CSS assets being served from cache.
+# Javascript / CSS assets being served from cache. Our subclass also writes .gz (and
+# .br, if brotli is installed) siblings, for the web server to serve precompressed.
 # See https://docs.djangoproject.com/en/dev/ref/contrib/staticfiles/#manifeststaticfilesstorage
 # But for production, you almost certainly should be using a shared storage backend, like:
 # https://django-storages.readthedocs.io/en/latest/backends/amazon-S3.html
@@ -85,7 +86,7 @@ STORAGES = {
     "staticfiles": {
         "BACKEND": env(
             "STATICFILES_STORAGE",
-            default="django.contrib.staticfiles.storage.ManifestStaticFilesStorage",
+            default=f"{PROJECT}.storage.CompressedManifestStaticFilesStorage",
         ),
     },
 }
@@ -117,6 +118,12 @@ if DATABASES["default"]["ENGINE"] == "django.db.backends.sqlite3":
     DB_DIR.mkdir(parents=True, exist_ok=True)
 
 CACHES = {"default": env.cache("CACHE_URL", default="locmemcache://")}
+# Whether the default cache is shared between worker processes. Caches that must be
+# (see the WEBQUILLS section below) are off by default when it is not.
+CACHE_IS_SHARED = CACHES["default"]["BACKEND"] not in (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
 
 # Email settings don't use a dict. Add to local vars instead.
 # https://django-environ.readthedocs.io/en/latest/tips.html#email-settings
@@ -158,6 +165,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Health checks must come first, to skip sessions and site resolution for probes.
+    f"{PROJECT}.health.HealthCheckMiddleware",
+    # Measures everything below it, and serves the metrics endpoint if configured.
+    f"{PROJECT}.metrics.RequestMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -166,7 +177,13 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "webquills.sites.middleware.SitesMiddleware",
+    # Returns 429s to sites and clients over their budgets. Needs request.site.
+    "webquills.sites.middleware.RateLimitMiddleware",
     "allauth.account.middleware.AccountMiddleware",
+    # Answers revalidation of site pages with 304s, without rendering them.
+    "webquills.sites.middleware.ConditionalGetMiddleware",
+    # Serves cached site pages to anonymous readers, without rendering them.
+    "webquills.sites.middleware.PageCacheMiddleware",
 ]
 
 TEMPLATES = [
@@ -182,9 +199,9 @@ TEMPLATES = [
                 "django.template.context_processors.media",
                 "django.template.context_processors.static",
                 "django.template.context_processors.i18n",
-                # These are both required for commoncontent templates to work properly:
-                "commoncontent.apps.context_defaults",
-                "sitevars.context_processors.inject_sitevars",
+                # Required for commoncontent templates to work properly. Wraps the
+                # commoncontent and sitevars context processors.
+                f"{PROJECT}.sites.context_processors.site_context",
             ],
         },
     },
@@ -196,6 +213,9 @@ if DEBUG:
         "django.template.context_processors.debug"
     )
 
+# Makes query budgets fail tests (see webquills.metrics).
+TEST_RUNNER = f"{PROJECT}.runner.TestRunner"
+
 # Internationalization
 # https://docs.djangoproject.com/en/dev/topics/i18n/
 LANGUAGE_CODE = "en-us"
@@ -208,8 +228,10 @@ if find_spec("celery"):
     # If the environment has not provided settings, assume there is no broker
     # and run celery tasks in-process. This means you MUST provide
     # CELERY_TASK_ALWAYS_EAGER=False in your environment to actually use celery.
-    CELERY_TASK_ALWAYS_EAGER = env("CELERY_TASK_ALWAYS_EAGER", default=True)
-    CELERY_TASK_EAGER_PROPAGATES = env("CELERY_TASK_EAGER_PROPAGATES", default=True)
+    CELERY_TASK_ALWAYS_EAGER = env.bool("CELERY_TASK_ALWAYS_EAGER", default=True)
+    CELERY_TASK_EAGER_PROPAGATES = env.bool(
+        "CELERY_TASK_EAGER_PROPAGATES", default=True
+    )
     # For development setup, assume default of local redis.
     CELERY_BROKER_URL = env("CELERY_BROKER_URL", default="redis://localhost:6379/1")
     CELERY_RESULT_BACKEND = env("CELERY_RESULT_BACKEND", default="")
@@ -243,6 +265,8 @@ SESSION_SAVE_EVERY_REQUEST = False
 AUTHENTICATION_BACKENDS = [
     # Needed to login by username in Django admin, regardless of `allauth`
     "django.contrib.auth.backends.ModelBackend",
+    # Permissions on a single site, granted by membership of its group
+    "webquills.sites.backends.SitePermissionBackend",
     # `allauth` specific authentication methods, such as login by email
     "allauth.account.auth_backends.AuthenticationBackend",
 ]
@@ -493,7 +517,7 @@ WEBQUILLS_OPEN_REGISTRATION = env(
 )
 # These subdomains are expected to be used for other purposes, and should not
 # be used for sites.
-WEBQUILLS_RESERVED_SUBDOMAINS = env(
+WEBQUILLS_RESERVED_SUBDOMAINS = env.list(
     "WEBQUILLS_RESERVED_SUBDOMAINS",
     default=[
         "static",
@@ -501,8 +525,135 @@ WEBQUILLS_RESERVED_SUBDOMAINS = env(
         "assets",
     ],
 )
+# Subdomains must not contain these words anywhere (e.g. abuse terms). Large lists of
+# reserved names or blocked words (e.g. trademarks) can be kept in files, one per line.
+# Names that merely look like a reserved name or blocked word are also refused. See
+# webquills.sites.policy.
+WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS = env.list(
+    "WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS", default=[]
+)
+WEBQUILLS_RESERVED_SUBDOMAINS_FILES = env.list(
+    "WEBQUILLS_RESERVED_SUBDOMAINS_FILES", default=[]
+)
+WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS_FILES = env.list(
+    "WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS_FILES", default=[]
+)
 # REQUIRED. The root domain. All sites will be subdomains of this root domain.
 WEBQUILLS_ROOT_DOMAIN = env("WEBQUILLS_ROOT_DOMAIN")
+# Each worker process caches the mapping of host names to sites, so that most requests
+# can be routed without a database query. Entries expire after the TTL (in seconds),
+# and the least recently used entries are evicted beyond the size limit. Set the TTL to
+# zero to disable the cache.
+WEBQUILLS_DOMAIN_CACHE_TTL = env.int("WEBQUILLS_DOMAIN_CACHE_TTL", default=60)
+WEBQUILLS_DOMAIN_CACHE_SIZE = env.int("WEBQUILLS_DOMAIN_CACHE_SIZE", default=10_000)
+# Resolved hosts are also shared between workers through a Django cache backend (use
+# Redis in production), so a deploy does not cause a cold miss per worker per host.
+# Set the TTL to zero to disable the shared tier. It is disabled by default unless
+# CACHE_URL names a shared backend, since a per-process cache would keep serving
+# records that other workers have invalidated.
+WEBQUILLS_DOMAIN_SHARED_CACHE_TTL = env.int(
+    "WEBQUILLS_DOMAIN_SHARED_CACHE_TTL", default=300 if CACHE_IS_SHARED else 0
+)
+WEBQUILLS_DOMAIN_CACHE_ALIAS = env("WEBQUILLS_DOMAIN_CACHE_ALIAS", default="default")
+# Hosts that do not resolve to a site are also remembered per process, so that bot
+# scans of random host names don't cost a query each. Warnings about them are logged
+# at most once per interval (in seconds), with counts aggregated in between.
+WEBQUILLS_UNKNOWN_HOST_CACHE_TTL = env.int(
+    "WEBQUILLS_UNKNOWN_HOST_CACHE_TTL", default=60
+)
+WEBQUILLS_UNKNOWN_HOST_CACHE_SIZE = env.int(
+    "WEBQUILLS_UNKNOWN_HOST_CACHE_SIZE", default=10_000
+)
+WEBQUILLS_UNKNOWN_HOST_LOG_INTERVAL = env.int(
+    "WEBQUILLS_UNKNOWN_HOST_LOG_INTERVAL", default=60
+)
+# If true, request.domain and request.site are only built when a view uses them. The
+# host is still checked (and redirected if needed) on every request.
+WEBQUILLS_LAZY_SITE = env.bool("WEBQUILLS_LAZY_SITE", default=False)
+# Liveness and readiness probes for load balancers. Readiness checks the database and
+# cache, failing if either takes longer than the timeout (in seconds).
+WEBQUILLS_HEALTH_LIVENESS_PATH = env(
+    "WEBQUILLS_HEALTH_LIVENESS_PATH", default="/healthz"
+)
+WEBQUILLS_HEALTH_READINESS_PATH = env(
+    "WEBQUILLS_HEALTH_READINESS_PATH", default="/readyz"
+)
+WEBQUILLS_HEALTH_CHECK_TIMEOUT = env.float(
+    "WEBQUILLS_HEALTH_CHECK_TIMEOUT", default=1.0
+)
+# Per-view request metrics (queries, DB time, cache calls, render time) in the
+# Prometheus text format, served at this path to the allowed client IPs only. Each
+# worker process reports its own requests. Set METRICS_LOG to also log one line per
+# request, with the metrics as structured fields.
+WEBQUILLS_METRICS_PATH = env("WEBQUILLS_METRICS_PATH", default=None)
+WEBQUILLS_METRICS_ALLOWED_IPS = env.list(
+    "WEBQUILLS_METRICS_ALLOWED_IPS", default=["127.0.0.1", "::1"]
+)
+WEBQUILLS_METRICS_LOG = env.bool("WEBQUILLS_METRICS_LOG", default=False)
+# Maximum queries per view, by URL name (e.g. "site_list=3,home_page=20"), in addition
+# to the query_budget attributes declared on views. Exceeding a budget logs a warning,
+# or raises an error if the action is "raise" (as the test runner sets it).
+WEBQUILLS_QUERY_BUDGETS = env.dict(
+    "WEBQUILLS_QUERY_BUDGETS", cast={"value": int}, default={}
+)
+WEBQUILLS_QUERY_BUDGET_ACTION = env("WEBQUILLS_QUERY_BUDGET_ACTION", default="log")
+# If set, a map of every served host is written to this file (and rebuilt when domains
+# change), so that the edge web server can reject unknown hosts and redirect aliases
+# without calling Django. Format is "nginx" (a map include) or "caddy" (JSON routes).
+# Rebuilds run in a Celery worker, so they need a broker. Without one, run the
+# build_host_map command (e.g. from cron) instead.
+WEBQUILLS_HOST_MAP_PATH = env("WEBQUILLS_HOST_MAP_PATH", default=None)
+WEBQUILLS_HOST_MAP_FORMAT = env("WEBQUILLS_HOST_MAP_FORMAT", default="nginx")
+WEBQUILLS_HOST_MAP_DELAY = env.int("WEBQUILLS_HOST_MAP_DELAY", default=5)
+# Sites are published as static HTML to a directory per primary host under this root,
+# for the web server to serve directly. If PUBLISH_ON_CHANGE is true, a site is
+# republished (after a delay, to batch edits) whenever its content changes. That needs
+# a Celery broker. Without one, changes are recorded, and published by the next run
+# of the publish_sites command.
+WEBQUILLS_PUBLISH_ROOT = Path(env("WEBQUILLS_PUBLISH_ROOT", default=DATA_DIR / "sites"))
+WEBQUILLS_PUBLISH_ON_CHANGE = env.bool("WEBQUILLS_PUBLISH_ON_CHANGE", default=False)
+WEBQUILLS_PUBLISH_DELAY = env.int("WEBQUILLS_PUBLISH_DELAY", default=5)
+# Site pages rendered for anonymous readers are cached for the TTL (in seconds), and
+# invalidated per site when its content, variables or domains change. Use a shared
+# backend (e.g. Redis) in production. Pages vary by host, path, language and the
+# values of the listed cookies. Set the TTL to zero to disable the cache. Like the
+# shared domain cache, it is disabled by default unless CACHE_URL is shared.
+WEBQUILLS_PAGE_CACHE_TTL = env.int(
+    "WEBQUILLS_PAGE_CACHE_TTL", default=300 if CACHE_IS_SHARED else 0
+)
+WEBQUILLS_PAGE_CACHE_ALIAS = env("WEBQUILLS_PAGE_CACHE_ALIAS", default="default")
+WEBQUILLS_PAGE_CACHE_COOKIES = env.list("WEBQUILLS_PAGE_CACHE_COOKIES", default=[])
+# The permissions of each user on the sites they can access are cached in the domain
+# cache backend for the TTL (in seconds), and invalidated when group memberships,
+# permissions or sites change. Set the TTL to zero to disable the cache. It is
+# disabled by default unless CACHE_URL is shared, so that revoked access is not kept
+# by other workers.
+WEBQUILLS_USER_SITES_CACHE_TTL = env.int(
+    "WEBQUILLS_USER_SITES_CACHE_TTL", default=300 if CACHE_IS_SHARED else 0
+)
+# Subdomain availability checks answer from a per-process index of taken subdomains,
+# which picks up sites saved by other processes at this interval (in seconds). Set it
+# to zero to disable the index and query the database for every check.
+WEBQUILLS_SUBDOMAIN_INDEX_REFRESH = env.float(
+    "WEBQUILLS_SUBDOMAIN_INDEX_REFRESH", default=5
+)
+# Token bucket rate limits, per site and per client IP: a sustained rate (requests per
+# second) plus a burst allowance. Buckets are shared between workers when the cache
+# backend is Redis, and kept per process otherwise. Behind a reverse proxy, set the
+# IP header to the request.META key it sets (e.g. HTTP_X_REAL_IP). A rate of zero
+# disables that limit.
+WEBQUILLS_RATE_LIMIT_SITE_RATE = env.float("WEBQUILLS_RATE_LIMIT_SITE_RATE", default=0)
+WEBQUILLS_RATE_LIMIT_SITE_BURST = env.int(
+    "WEBQUILLS_RATE_LIMIT_SITE_BURST", default=500
+)
+WEBQUILLS_RATE_LIMIT_IP_RATE = env.float("WEBQUILLS_RATE_LIMIT_IP_RATE", default=0)
+WEBQUILLS_RATE_LIMIT_IP_BURST = env.int("WEBQUILLS_RATE_LIMIT_IP_BURST", default=50)
+WEBQUILLS_RATE_LIMIT_IP_HEADER = env(
+    "WEBQUILLS_RATE_LIMIT_IP_HEADER", default="REMOTE_ADDR"
+)
+WEBQUILLS_RATE_LIMIT_CACHE_ALIAS = env(
+    "WEBQUILLS_RATE_LIMIT_CACHE_ALIAS", default="default"
+)
 
 #######################################################################################
 # SECTION: DEVELOPMENT TOOLS
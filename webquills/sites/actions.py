@@ -8,15 +8,36 @@ easier to maintain and test.
 
 from __future__ import annotations
 
+import hashlib
+import json
+import os
+import tempfile
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from itertools import batched
+from pathlib import Path
+
 from django.apps import apps
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group, Permission
 from django.contrib.contenttypes.models import ContentType
-from django.db import transaction
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
 from django.db.models import Model
 
+from webquills.sites.availability import subdomain_index
+from webquills.sites.cache import (
+    invalidate_domains,
+    invalidate_pages,
+    invalidate_user_sites,
+)
 from webquills.sites.models import Domain, Site
-from webquills.sites.validators import normalize_domain, validate_subdomain
+from webquills.sites.validators import (
+    domain_not_available,
+    normalize_domain,
+    validate_subdomain,
+    validate_subdomains,
+)
 
 User = get_user_model()
 sites_config = apps.get_app_config("sites")
@@ -125,3 +146,393 @@ def update_site(
         site.save()
 
     return site
+
+
+def bulk_create_sites(
+    rows: Iterable[tuple[Model, str, str]],
+    batch_size: int = 500,
+) -> tuple[list[Site], list[tuple[int, str]]]:
+    """
+    Create many sites at once, as `create_site` would, but with batched inserts.
+
+    All subdomains are validated up front (including against each other and existing
+    sites). Valid rows are then inserted in chunks of `batch_size`, one transaction
+    per chunk, using `bulk_create` for the groups, sites, domains and group
+    memberships. Errors are reported per row rather than aborting the whole batch.
+
+    :param rows: (owner, name, subdomain) for each site to create.
+    :param batch_size: The number of sites to insert per transaction.
+    :return: A list of the created sites, and a list of (row index, error message)
+        for the rows that were not created.
+    """
+    errors: list[tuple[int, str]] = []
+    valid: list[tuple[int, Model, str, str, str]] = []
+    seen: set[str] = set()
+    rows = list(rows)
+    invalid = validate_subdomains(subdomain for _, _, subdomain in rows)
+    for index, (owner, name, subdomain) in enumerate(rows):
+        if subdomain in invalid:
+            errors.append((index, " ".join(invalid[subdomain].messages)))
+            continue
+        normalized_subdomain = normalize_domain(subdomain)
+        if normalized_subdomain in seen:
+            errors.append((index, str(domain_not_available)))
+            continue
+        seen.add(normalized_subdomain)
+        valid.append((index, owner, name, subdomain, normalized_subdomain))
+
+    # Check against existing sites in chunks, to keep the IN clauses bounded.
+    taken: set[str] = set()
+    for chunk in batched(seen, batch_size):
+        taken.update(
+            Site.objects.filter(normalized_subdomain__in=chunk).values_list(
+                "normalized_subdomain", flat=True
+            )
+        )
+        taken.update(
+            name.removeprefix("site:")
+            for name in Group.objects.filter(
+                name__in=[f"site:{s}" for s in chunk]
+            ).values_list("name", flat=True)
+        )
+    for row in valid:
+        if row[4] in taken:
+            errors.append((row[0], str(domain_not_available)))
+    valid = [row for row in valid if row[4] not in taken]
+
+    created: list[Site] = []
+    for chunk in batched(valid, batch_size):
+        try:
+            created.extend(_bulk_insert_sites(chunk))
+        except DatabaseError:
+            # Something changed since validation (e.g. a concurrent signup took a
+            # subdomain). Fall back to one transaction per row to find the culprits.
+            for index, owner, name, subdomain, _ in chunk:
+                try:
+                    created.append(create_site(owner, name, subdomain))
+                except (DatabaseError, ValidationError) as e:
+                    errors.append((index, str(e)))
+    errors.sort()
+    return created, errors
+
+
+def _bulk_insert_sites(rows) -> list[Site]:
+    root_domain = sites_config.root_domain
+    Membership = User.groups.through
+    with transaction.atomic():
+        groups = Group.objects.bulk_create(
+            [Group(name=f"site:{row[4]}") for row in rows]
+        )
+        sites = Site.objects.bulk_create(
+            [
+                Site(
+                    owner=owner,
+                    group=group,
+                    name=name,
+                    subdomain=subdomain,
+                    normalized_subdomain=normalized_subdomain,
+                )
+                for (_, owner, name, subdomain, normalized_subdomain), group in zip(
+                    rows, groups, strict=True
+                )
+            ]
+        )
+        # When a site is first created, its canonical domain is also primary.
+        domains = Domain.objects.bulk_create(
+            [
+                Domain(
+                    site=site,
+                    display_domain=f"{site.subdomain}.{root_domain}",
+                    normalized_domain=f"{site.normalized_subdomain}.{root_domain}",
+                    is_canonical=True,
+                    is_primary=True,
+                )
+                for site in sites
+            ]
+        )
+        Membership.objects.bulk_create(
+            [
+                Membership(user_id=site.owner_id, group_id=site.group_id)
+                for site in sites
+            ],
+            ignore_conflicts=True,
+        )
+    # bulk_create sends no signals, so evict any negative cache entries ourselves.
+    invalidate_domains(hosts=[d.normalized_domain for d in domains])
+    # Nor any pages cached for a deleted site that had the same primary key.
+    invalidate_pages(site.pk for site in sites)
+    # Nor the owners' cached site IDs, for their new memberships.
+    invalidate_user_sites({site.owner_id for site in sites})
+    subdomain_index.note_taken(
+        [site.normalized_subdomain for site in sites], created=True
+    )
+    # Imported here because tasks imports this module.
+    from webquills.sites.tasks import schedule_host_map_rebuild
+
+    schedule_host_map_rebuild([site.pk for site in sites])
+    return sites
+
+
+# Fields included for each site by export_sites.
+EXPORT_SITE_FIELDS = [
+    "id",
+    "name",
+    "subdomain",
+    "normalized_subdomain",
+    "owner_id",
+    "owner__email",
+    "group_id",
+    "create_date",
+    "modified_date",
+    "archive_date",
+    "block_reason__name",
+]
+# Fields included for each of a site's domains by export_sites.
+EXPORT_DOMAIN_FIELDS = [
+    "display_domain",
+    "normalized_domain",
+    "is_primary",
+    "is_canonical",
+]
+
+
+def export_sites(
+    since: datetime | None = None,
+    chunk_size: int = 2000,
+) -> Iterator[dict]:
+    """
+    Stream every site, with its domains, as plain dicts in primary key order.
+
+    Sites are read with a server-side cursor (where the database supports it) and
+    their domains fetched one chunk at a time, so memory use is constant regardless
+    of the number of sites.
+
+    :param since: If given, only export sites modified at or after this time. Domain
+        changes also update the site's modified date.
+    :param chunk_size: The number of sites to fetch per round trip.
+    :return: An iterator of dicts with the `EXPORT_SITE_FIELDS` (with "owner__email"
+        as "owner_email" and "block_reason__name" as "block_reason") and a "domains"
+        list of dicts with the `EXPORT_DOMAIN_FIELDS`.
+    """
+    sites = Site.objects.prefetch_related(None).order_by("pk")
+    if since is not None:
+        sites = sites.filter(modified_date__gte=since)
+    rows = sites.values(*EXPORT_SITE_FIELDS).iterator(chunk_size=chunk_size)
+    for chunk in batched(rows, chunk_size):
+        domains: dict[int, list[dict]] = {row["id"]: [] for row in chunk}
+        for domain in (
+            Domain.objects.filter(site_id__in=domains.keys())
+            .order_by("pk")
+            .values("site_id", *EXPORT_DOMAIN_FIELDS)
+        ):
+            domains[domain.pop("site_id")].append(domain)
+        for row in chunk:
+            row["owner_email"] = row.pop("owner__email")
+            row["block_reason"] = row.pop("block_reason__name")
+            row["domains"] = domains[row["id"]]
+            yield row
+
+
+# Hosts that the SitesMiddleware never redirects, for local development and testing.
+UNREDIRECTED_HOSTS = ("localhost", "testserver")
+
+
+def host_map_entries(
+    site_ids: Iterable[int] | None = None,
+) -> Iterator[tuple[str, int, str | None]]:
+    """
+    Stream every host that should be served, in sorted order.
+
+    :param site_ids: If given, only the hosts of these sites.
+    :return: An iterator of (normalized host, site ID, redirect target) tuples, where
+        the redirect target is the site's primary host if the SitesMiddleware would
+        redirect requests for this host, or None if it serves them.
+    """
+    domains = Domain.objects.servable()
+    if site_ids is not None:
+        domains = domains.filter(site_id__in=site_ids)
+    rows = (
+        domains.with_primary_host()
+        .order_by("normalized_domain")
+        .values_list("normalized_domain", "site_id", "is_primary", "primary_host")
+        .iterator(chunk_size=2000)
+    )
+    for host, site_id, is_primary, primary_host in rows:
+        redirect = None
+        if not is_primary and primary_host and host not in UNREDIRECTED_HOSTS:
+            redirect = primary_host
+        yield host, site_id, redirect
+
+
+def _nginx_host_map(entries) -> Iterator[str]:
+    # Two maps: $webquills_site_id is empty for unknown hosts, and
+    # $webquills_redirect holds the primary host for aliases.
+    yield "# Generated by WebQuills. Do not edit.\n"
+    yield 'map $host $webquills_site_id {\n    default "";\n'
+    redirects = []
+    for host, site_id, redirect in entries:
+        yield f"    {host} {site_id};\n"
+        if redirect:
+            redirects.append((host, redirect))
+    yield "}\n"
+    yield 'map $host $webquills_redirect {\n    default "";\n'
+    for host, redirect in redirects:
+        yield f"    {host} {redirect};\n"
+    yield "}\n"
+
+
+def _caddy_host_map(entries) -> Iterator[str]:
+    # A JSON array of routes for Caddy's http app: one redirect route per primary host
+    # with aliases, then a route rejecting all unknown hosts. Include these routes
+    # before the route that proxies to WebQuills.
+    hosts = []
+    aliases: dict[str, list[str]] = {}
+    for host, _, redirect in entries:
+        hosts.append(host)
+        if redirect:
+            aliases.setdefault(redirect, []).append(host)
+    routes = [
+        {
+            "match": [{"host": alias_hosts}],
+            "handle": [
+                {
+                    "handler": "static_response",
+                    "status_code": 301,
+                    "headers": {
+                        "Location": [
+                            f"{{http.request.scheme}}://{primary}{{http.request.uri}}"
+                        ]
+                    },
+                }
+            ],
+            "terminal": True,
+        }
+        for primary, alias_hosts in sorted(aliases.items())
+    ]
+    routes.append(
+        {
+            "match": [{"not": [{"host": hosts}]}],
+            "handle": [{"handler": "static_response", "status_code": 404}],
+            "terminal": True,
+        }
+    )
+    yield json.dumps(routes, indent=1)
+    yield "\n"
+
+
+HOST_MAP_FORMATS = {
+    "nginx": _nginx_host_map,
+    "caddy": _caddy_host_map,
+}
+
+
+def _parse_nginx_host_map(text: str) -> list[tuple[str, int, str | None]] | None:
+    # The inverse of _nginx_host_map, or None if the text was not written by it.
+    maps: list[dict[str, str]] = []
+    current = None
+    for line in text.splitlines():
+        if line.startswith("map $host "):
+            current = {}
+            maps.append(current)
+        elif line == "}":
+            current = None
+        elif current is not None and not line.startswith("    default "):
+            host, _, value = line.strip().rstrip(";").partition(" ")
+            current[host] = value
+    if len(maps) != 2:
+        return None
+    site_ids, redirects = maps
+    try:
+        return [
+            (host, int(site_id), redirects.get(host))
+            for host, site_id in site_ids.items()
+        ]
+    except ValueError:
+        return None
+
+
+# The formats that can be read back, for incremental rebuilds. Caddy's routes don't
+# record which site each host belongs to, so they are always rebuilt in full.
+HOST_MAP_PARSERS = {
+    "nginx": _parse_nginx_host_map,
+}
+
+# Beyond this many changed sites, rebuilding the whole host map costs about the same
+# (and keeps the number of query parameters down).
+HOST_MAP_INCREMENTAL_LIMIT = 500
+
+
+def _updated_host_map_entries(
+    path: Path, fmt: str, site_ids: set[int]
+) -> list[tuple[str, int, str | None]] | None:
+    """
+    Return the entries of an existing host map, with those of the given sites reloaded
+    from the database, or None if the map must be rebuilt in full (e.g. if it does not
+    exist yet, or its format can't be read back).
+    """
+    parse = HOST_MAP_PARSERS.get(fmt)
+    if parse is None or len(site_ids) > HOST_MAP_INCREMENTAL_LIMIT:
+        return None
+    try:
+        entries = parse(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    if entries is None or not site_ids:
+        return entries
+    changed = list(host_map_entries(site_ids))
+    # A host may also have moved from another site.
+    changed_hosts = {host for host, _, _ in changed}
+    entries = [
+        entry
+        for entry in entries
+        if entry[1] not in site_ids and entry[0] not in changed_hosts
+    ]
+    return sorted(entries + changed)
+
+
+def write_host_map(
+    path: str | Path, fmt: str = "nginx", site_ids: Iterable[int] | None = None
+) -> bool:
+    """
+    Write the host map, for the edge web server to route requests without Django.
+
+    The file is replaced atomically, and only if its content has changed, so that the
+    web server can be reloaded (or not) accordingly.
+
+    :param path: The path of the file to write.
+    :param fmt: The format of the file, one of `HOST_MAP_FORMATS`.
+    :param site_ids: The sites whose hosts changed since the file was last written.
+        If given, only their entries are reloaded from the database, where the format
+        allows (see `HOST_MAP_PARSERS`). Otherwise the whole map is rebuilt.
+    :return: True if the file was written, False if it was already up to date.
+    """
+    path = Path(path)
+    entries = None
+    if site_ids is not None:
+        entries = _updated_host_map_entries(path, fmt, set(site_ids))
+    if entries is None:
+        entries = host_map_entries()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f".{path.name}.", delete=False, encoding="utf-8"
+    ) as f:
+        try:
+            for chunk in HOST_MAP_FORMATS[fmt](entries):
+                f.write(chunk)
+                digest.update(chunk.encode())
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    try:
+        old_digest = hashlib.sha256(path.read_bytes()).digest()
+    except FileNotFoundError:
+        old_digest = None
+    if old_digest == digest.digest():
+        os.unlink(f.name)
+        return False
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+    return True
@@ -1,4 +1,6 @@
-from django.apps import AppConfig
+from pathlib import Path
+
+from django.apps import AppConfig, apps
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import gettext_lazy as _
@@ -12,7 +14,62 @@ class SitesConfig(AppConfig):
 
     def ready(self) -> None:
         # Once the ORM is initialized, connect signal handlers
-        pass
+        from django.contrib.auth import get_user_model
+        from django.contrib.auth.models import Group
+        from django.db.models.signals import m2m_changed, post_delete, post_save
+
+        from webquills.metrics import registry
+        from webquills.sites import signals
+        from webquills.sites.cache import domain_cache_metrics
+
+        Domain = self.get_model("Domain")
+        Site = self.get_model("Site")
+        post_save.connect(
+            signals.domain_changed, sender=Domain, dispatch_uid="sites_domain_saved"
+        )
+        post_delete.connect(
+            signals.domain_changed, sender=Domain, dispatch_uid="sites_domain_deleted"
+        )
+        post_save.connect(
+            signals.site_changed, sender=Site, dispatch_uid="sites_site_saved"
+        )
+        post_delete.connect(
+            signals.site_changed, sender=Site, dispatch_uid="sites_site_deleted"
+        )
+        post_delete.connect(
+            signals.domain_deleted, sender=Domain, dispatch_uid="sites_domain_unpublish"
+        )
+        # Report the domain cache's hits and misses on the metrics endpoint.
+        registry.add_collector(domain_cache_metrics)
+        User = get_user_model()
+        for through in (
+            User.groups.through,
+            User.user_permissions.through,
+            Group.permissions.through,
+        ):
+            m2m_changed.connect(
+                signals.site_access_changed,
+                sender=through,
+                dispatch_uid=f"sites_access_changed:{through._meta.label_lower}",
+            )
+        # Track changes to anything a site's pages are built from.
+        for app_label in ("commoncontent", "sitevars"):
+            if not apps.is_installed(app_label):
+                continue
+            for model in apps.get_app_config(app_label).get_models():
+                if not any(f.name == "site" for f in model._meta.concrete_fields):
+                    continue
+                label = model._meta.label_lower
+                post_save.connect(
+                    signals.content_changed,
+                    sender=model,
+                    dispatch_uid=f"sites_content_saved:{label}",
+                )
+                post_delete.connect(
+                    signals.content_changed,
+                    sender=model,
+                    dispatch_uid=f"sites_content_deleted:{label}",
+                )
 
     @property
     def root_domain(self) -> str:
@@ -33,17 +90,224 @@ class SitesConfig(AppConfig):
     @property
     def reserved_names(self) -> list[str]:
         """
-        Returns a list of reserved names that cannot be used as subdomains.
-        """
-        reserved = getattr(settings, "WEBQUILLS_RESERVED_SUBDOMAINS", [])
-        # This is a list of names that are reserved for use by the application.
-        # For example, "www" and "admin" are often reserved for use by the application.
-        # reserved += [
-        #     "www",
-        #     "admin",
-        #     "api",
-        #     "static",
-        #     "media",
-        #     "assets",
-        # ]
-        return reserved
+        Returns a list of reserved names that cannot be used as subdomains (see
+        `webquills.sites.policy`).
+        """
+        return getattr(settings, "WEBQUILLS_RESERVED_SUBDOMAINS", [])
+
+    @property
+    def reserved_names_files(self) -> list[str]:
+        """
+        Returns the paths of files of more reserved names, one per line.
+        """
+        return getattr(settings, "WEBQUILLS_RESERVED_SUBDOMAINS_FILES", [])
+
+    @property
+    def blocked_subdomain_words(self) -> list[str]:
+        """
+        Returns a list of words that subdomains must not contain anywhere (see
+        `webquills.sites.policy`).
+        """
+        return getattr(settings, "WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS", [])
+
+    @property
+    def blocked_subdomain_words_files(self) -> list[str]:
+        """
+        Returns the paths of files of more blocked words, one per line.
+        """
+        return getattr(settings, "WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS_FILES", [])
+
+    @property
+    def domain_cache_ttl(self) -> float:
+        """
+        Returns the number of seconds a resolved domain is kept in the per-process
+        domain cache. Zero disables the cache.
+        """
+        return getattr(settings, "WEBQUILLS_DOMAIN_CACHE_TTL", 60)
+
+    @property
+    def domain_cache_size(self) -> int:
+        """
+        Returns the maximum number of hosts kept in the per-process domain cache.
+        """
+        return getattr(settings, "WEBQUILLS_DOMAIN_CACHE_SIZE", 10_000)
+
+    @property
+    def domain_shared_cache_ttl(self) -> float:
+        """
+        Returns the number of seconds a resolved domain is kept in the shared cache
+        tier. Zero disables the shared tier.
+        """
+        return getattr(settings, "WEBQUILLS_DOMAIN_SHARED_CACHE_TTL", 0)
+
+    @property
+    def domain_cache_alias(self) -> str:
+        """
+        Returns the alias of the Django cache backend used for the shared domain cache.
+        """
+        return getattr(settings, "WEBQUILLS_DOMAIN_CACHE_ALIAS", "default")
+
+    @property
+    def unknown_host_cache_ttl(self) -> float:
+        """
+        Returns the number of seconds a host that failed to resolve is remembered, so
+        that repeated requests for it skip the database. Zero disables the cache.
+        """
+        return getattr(settings, "WEBQUILLS_UNKNOWN_HOST_CACHE_TTL", 60)
+
+    @property
+    def unknown_host_cache_size(self) -> int:
+        """
+        Returns the maximum number of unknown hosts remembered per process.
+        """
+        return getattr(settings, "WEBQUILLS_UNKNOWN_HOST_CACHE_SIZE", 10_000)
+
+    @property
+    def unknown_host_log_interval(self) -> float:
+        """
+        Returns the minimum number of seconds between log messages about requests for
+        unknown hosts. Requests in between are counted and reported in aggregate.
+        """
+        return getattr(settings, "WEBQUILLS_UNKNOWN_HOST_LOG_INTERVAL", 60)
+
+    @property
+    def lazy_site(self) -> bool:
+        """
+        Returns True if the SitesMiddleware should set `request.domain` and
+        `request.site` as lazy objects, built only when first accessed.
+        """
+        return getattr(settings, "WEBQUILLS_LAZY_SITE", False)
+
+    @property
+    def host_map_path(self) -> str | None:
+        """
+        Returns the path of the host map file for the edge web server, which is
+        rebuilt whenever domains or sites change, or None if there isn't one.
+        """
+        return getattr(settings, "WEBQUILLS_HOST_MAP_PATH", None)
+
+    @property
+    def host_map_format(self) -> str:
+        """
+        Returns the format of the host map file, "nginx" or "caddy".
+        """
+        return getattr(settings, "WEBQUILLS_HOST_MAP_FORMAT", "nginx")
+
+    @property
+    def host_map_delay(self) -> int:
+        """
+        Returns the number of seconds to wait after a change before rebuilding the
+        host map, so that a burst of changes causes only one rebuild.
+        """
+        return getattr(settings, "WEBQUILLS_HOST_MAP_DELAY", 5)
+
+    @property
+    def page_cache_ttl(self) -> int:
+        """
+        Returns the number of seconds a rendered site page is cached for anonymous
+        readers. Zero disables the page cache.
+        """
+        return getattr(settings, "WEBQUILLS_PAGE_CACHE_TTL", 0)
+
+    @property
+    def page_cache_alias(self) -> str:
+        """
+        Returns the alias of the Django cache backend used for the page cache.
+        """
+        return getattr(settings, "WEBQUILLS_PAGE_CACHE_ALIAS", "default")
+
+    @property
+    def page_cache_cookies(self) -> list[str]:
+        """
+        Returns the names of cookies whose values change how a site page renders, so
+        that each combination of their values is cached separately.
+        """
+        return getattr(settings, "WEBQUILLS_PAGE_CACHE_COOKIES", [])
+
+    @property
+    def user_sites_cache_ttl(self) -> int:
+        """
+        Returns the number of seconds the permissions of each user on the sites they
+        can access are kept in the shared cache (see `domain_cache_alias`). Zero
+        disables the cache.
+        """
+        return getattr(settings, "WEBQUILLS_USER_SITES_CACHE_TTL", 0)
+
+    @property
+    def subdomain_index_refresh(self) -> float:
+        """
+        Returns the number of seconds between refreshes of each process's index of
+        taken subdomains, from sites saved by other processes. Zero disables the
+        index, so that every availability check queries the database.
+        """
+        return getattr(settings, "WEBQUILLS_SUBDOMAIN_INDEX_REFRESH", 5)
+
+    @property
+    def rate_limit_site_rate(self) -> float:
+        """
+        Returns the sustained number of requests per second allowed for each site.
+        Zero disables the per-site limit.
+        """
+        return getattr(settings, "WEBQUILLS_RATE_LIMIT_SITE_RATE", 0)
+
+    @property
+    def rate_limit_site_burst(self) -> int:
+        """
+        Returns the number of requests a site may receive in a burst above its rate.
+        """
+        return getattr(settings, "WEBQUILLS_RATE_LIMIT_SITE_BURST", 500)
+
+    @property
+    def rate_limit_ip_rate(self) -> float:
+        """
+        Returns the sustained number of requests per second allowed for each client
+        IP. Zero disables the per-IP limit.
+        """
+        return getattr(settings, "WEBQUILLS_RATE_LIMIT_IP_RATE", 0)
+
+    @property
+    def rate_limit_ip_burst(self) -> int:
+        """
+        Returns the number of requests a client IP may send in a burst above its rate.
+        """
+        return getattr(settings, "WEBQUILLS_RATE_LIMIT_IP_BURST", 50)
+
+    @property
+    def rate_limit_ip_header(self) -> str:
+        """
+        Returns the `request.META` key holding the client IP, e.g. "HTTP_X_REAL_IP"
+        behind a reverse proxy.
+        """
+        return getattr(settings, "WEBQUILLS_RATE_LIMIT_IP_HEADER", "REMOTE_ADDR")
+
+    @property
+    def rate_limit_cache_alias(self) -> str:
+        """
+        Returns the alias of the Django cache backend holding the rate limit buckets.
+        Buckets are shared between workers only if it is a Redis backend.
+        """
+        return getattr(settings, "WEBQUILLS_RATE_LIMIT_CACHE_ALIAS", "default")
+
+    @property
+    def publish_root(self) -> Path:
+        """
+        Returns the directory under which each site is published as static HTML, in a
+        subdirectory named for its primary host.
+        """
+        default = Path(settings.DATA_DIR) / "sites"
+        return Path(getattr(settings, "WEBQUILLS_PUBLISH_ROOT", default))
+
+    @property
+    def publish_on_change(self) -> bool:
+        """
+        Returns True if sites should be republished whenever their content changes.
+        """
+        return getattr(settings, "WEBQUILLS_PUBLISH_ON_CHANGE", False)
+
+    @property
+    def publish_delay(self) -> int:
+        """
+        Returns the number of seconds to wait after a change before republishing a
+        site, so that a burst of edits causes only one rebuild.
+        """
+        return getattr(settings, "WEBQUILLS_PUBLISH_DELAY", 5)
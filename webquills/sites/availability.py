@@ -0,0 +1,220 @@
+"""
+An in-process index of taken subdomains, for as-you-type availability checks.
+
+Each process keeps the normalized subdomains of all sites in a sorted list, and a
+Bloom filter over them. A name the filter has never seen is certainly not in the
+index, so most checks of free names cost no query at all. A possible hit (a taken
+name, a false positive, or the old name of a renamed or deleted site) is confirmed
+against the database.
+
+The index is loaded once, and kept up to date:
+
+- in the process that saves a site, from the `post_save` signal;
+- in every other process, at most every `WEBQUILLS_SUBDOMAIN_INDEX_REFRESH` seconds,
+  by loading sites created since (an index scan of the primary key), or reloading in
+  full if another process saved a name that is not a new site's (e.g. a rename).
+
+The index is only a hint: the unique constraint on `Site.normalized_subdomain` still
+decides, so a stale index can at worst show a name as free until it is submitted.
+"""
+
+from __future__ import annotations
+
+import bisect
+import hashlib
+import math
+import re
+import threading
+import time
+from collections.abc import Iterable
+from itertools import count, islice
+
+from django.apps import apps
+from django.core.exceptions import ValidationError
+
+from webquills.sites.cache import (
+    get_subdomain_index_generation,
+    publish_subdomain_index_change,
+)
+from webquills.sites.validators import normalize_domain, validate_subdomain
+
+sites_config = apps.get_app_config("sites")
+
+
+class BloomFilter:
+    """
+    A set of strings that may report false positives (at about `error_rate` when
+    holding `capacity` items), but never false negatives.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.size = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class SubdomainIndex:
+    """The taken normalized subdomains known to this process. See the module docs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        """Forget everything, so that the next check reloads the index."""
+        with self._lock:
+            self._names: list[str] = []
+            self._bloom = BloomFilter(1)
+            self._max_pk = 0
+            self._generation = None
+            self._next_refresh = 0.0
+
+    def _rebuild_bloom(self) -> None:
+        bloom = BloomFilter(max(1024, 2 * len(self._names)))
+        for name in self._names:
+            bloom.add(name)
+        self._bloom = bloom
+
+    def _add(self, name: str) -> bool:
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            return False
+        self._names.insert(i, name)
+        if len(self._names) > self._bloom.capacity:
+            self._rebuild_bloom()
+        else:
+            self._bloom.add(name)
+        return True
+
+    def refresh(self) -> None:
+        """Bring the index up to date, if it is due."""
+        if time.monotonic() < self._next_refresh:
+            return
+        # Only one thread refreshes; the others carry on with the current index.
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            Site = apps.get_model("sites", "Site")
+            sites = Site._base_manager.order_by().values_list(
+                "pk", "normalized_subdomain"
+            )
+            generation = get_subdomain_index_generation()
+            if generation != self._generation:
+                names, max_pk = [], 0
+                for pk, name in sites.iterator():
+                    names.append(name)
+                    max_pk = max(max_pk, pk)
+                names.sort()
+                # Replaced whole, so that concurrent checks see either index.
+                self._names = names
+                self._rebuild_bloom()
+                self._max_pk = max_pk
+                self._generation = generation
+            else:
+                for pk, name in sites.filter(pk__gt=self._max_pk):
+                    self._add(name)
+                    self._max_pk = max(self._max_pk, pk)
+            self._next_refresh = time.monotonic() + sites_config.subdomain_index_refresh
+        finally:
+            self._lock.release()
+
+    def might_be_taken(self, name: str) -> bool:
+        """
+        Return False if no site has the normalized subdomain (as of the last refresh),
+        or True if one may have.
+        """
+        if sites_config.subdomain_index_refresh <= 0:
+            return True
+        self.refresh()
+        return name in self._bloom
+
+    def is_taken(self, name: str) -> bool:
+        """Return True if a site has the normalized subdomain."""
+        if not self.might_be_taken(name):
+            return False
+        Site = apps.get_model("sites", "Site")
+        return Site._base_manager.filter(normalized_subdomain=name).exists()
+
+    def note_taken(self, names: Iterable[str], created: bool = False) -> None:
+        """
+        Add names just given to sites in this process to the index. Unless they
+        belong to new sites (which other processes load by primary key), tell other
+        processes to reload, once the current transaction commits.
+
+        Only pass names that changed: each call for an existing site makes every
+        process reload the whole index.
+        """
+        names = list(names)
+        with self._lock:
+            # If not loaded yet, the names will be when it is.
+            if self._generation is not None:
+                for name in names:
+                    self._add(name)
+        if names and not created:
+            publish_subdomain_index_change()
+
+    def numbered(self, prefix: str) -> set[int]:
+        """Return the N of the taken names "<prefix>N" (e.g. "blog-2", "blog-3")."""
+        pattern = re.compile(rf"{re.escape(prefix)}(\d{{1,6}})")
+        names = self._names
+        taken = set()
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            match = pattern.fullmatch(names[i])
+            if match:
+                taken.add(int(match[1]))
+            i += 1
+        return taken
+
+
+subdomain_index = SubdomainIndex()
+
+# Patterns for suggested alternatives to a taken subdomain, after numbered ones.
+SUGGESTION_PATTERNS = ("{}-blog", "{}-site", "my-{}", "the-{}", "{}-online")
+
+
+def suggest_subdomains(subdomain: str, limit: int = 5) -> list[str]:
+    """
+    Return up to `limit` free alternatives to a subdomain, checked against the index
+    only (so without queries). Without the index, there are none.
+    """
+    base = subdomain.strip().lower().strip("-")[:50].rstrip("-")
+    if not base or sites_config.subdomain_index_refresh <= 0:
+        return []
+    subdomain_index.refresh()
+    numbered = set()
+    try:
+        if normalize_domain(base) == base:
+            numbered = subdomain_index.numbered(f"{base}-")
+    except UnicodeError:
+        return []
+    candidates = list(islice((f"{base}-{n}" for n in count(2) if n not in numbered), 2))
+    candidates += [pattern.format(base) for pattern in SUGGESTION_PATTERNS]
+    suggestions = []
+    for candidate in candidates:
+        try:
+            validate_subdomain(candidate)
+            if not subdomain_index.might_be_taken(normalize_domain(candidate)):
+                suggestions.append(candidate)
+        except (ValidationError, UnicodeError):
+            continue
+        if len(suggestions) == limit:
+            break
+    return suggestions
@@ -0,0 +1,35 @@
+"""
+An authentication backend for permission checks on a single Site, e.g.
+`user.has_perm("sites.change_site", site)`.
+
+Django's `ModelBackend` answers only model level checks (without an object). This
+backend answers object level checks from the map returned by
+`Site.objects.permissions_for(user)`, which is cached per user, so that any number of
+checks in a request costs at most one cache lookup.
+
+Note that `ModelBackend` (and allauth's backend, which extends it) also counts the
+permissions of site groups in model level checks, so views acting on a site should
+check permissions against the site.
+"""
+
+from django.contrib.auth.backends import BaseBackend
+
+from webquills.sites.models import Site
+
+
+class SitePermissionBackend(BaseBackend):
+    """
+    Grants a user, on each site whose group they belong to, their own permissions plus
+    those of the site's group. Grants nothing on other sites, or other objects.
+    """
+
+    def site_permissions(self, user_obj, obj) -> frozenset[str]:
+        if not isinstance(obj, Site) or not user_obj.is_active:
+            return frozenset()
+        return Site.objects.permissions_for(user_obj).get(obj.pk, frozenset())
+
+    def get_all_permissions(self, user_obj, obj=None) -> set[str]:
+        return set(self.site_permissions(user_obj, obj))
+
+    def has_perm(self, user_obj, perm, obj=None) -> bool:
+        return perm in self.site_permissions(user_obj, obj)
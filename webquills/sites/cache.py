@@ -0,0 +1,511 @@
+"""
+Caches for the hot path of the sites framework.
+
+Every request served by the `SitesMiddleware` must resolve its Host header to a Domain
+and Site. The set of hosts is small relative to the number of requests, and changes
+rarely, so we keep resolved domains in two cache tiers rather than querying the
+database for each request:
+
+1. A per-process LRU cache, checked first.
+2. A shared tier in a Django cache backend (e.g. Redis), so that a worker's cold miss
+   can be filled by another worker's earlier query.
+
+Cached values are compact records (tuples of field values), not model instances. Each
+hit builds fresh model instances from the record, so requests never share mutable
+objects.
+
+Writes publish their changes to the shared tier: the affected host keys are deleted,
+the site's version is replaced (invalidating shared records for all its hosts), and a
+global generation is replaced. Every worker compares the global generation on each
+lookup and drops its per-process tier when it changes.
+"""
+
+from __future__ import annotations
+
+import functools
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.apps import apps
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+sites_config = apps.get_app_config("sites")
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded mapping whose entries expire after `ttl` seconds.
+
+    When full, the least recently used entry is evicted. A `ttl` of zero (or less)
+    disables the cache entirely: `set` becomes a no-op and `get` always misses.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted, (_, evicted_value) = self._data.popitem(last=False)
+                self.on_evict(evicted, evicted_value)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def on_evict(self, key, value) -> None:
+        """Hook for subclasses, called (under the lock) when an entry is evicted."""
+        pass
+
+
+#######################################################################################
+# Domain resolution cache
+#######################################################################################
+class DomainCache(LRUCache):
+    """
+    Maps normalized host names to domain records. Also keeps a reverse index of the
+    hosts cached for each site, so that a change to a site evicts all of its hosts
+    (including hosts it no longer owns, e.g. after a subdomain change).
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self._site_hosts: dict[int, set[str]] = {}
+        # The shared generation this process's entries were loaded under.
+        self.generation = None
+
+    def set(self, key, value) -> None:
+        super().set(key, value)
+        if self.ttl > 0 and self.maxsize > 0:
+            site_id = record_site_id(value)
+            with self._lock:
+                self._site_hosts.setdefault(site_id, set()).add(key)
+
+    def on_evict(self, key, value) -> None:
+        hosts = self._site_hosts.get(record_site_id(value))
+        if hosts is not None:
+            hosts.discard(key)
+            if not hosts:
+                del self._site_hosts[record_site_id(value)]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._site_hosts.clear()
+
+    def invalidate(self, hosts: Iterable[str] = (), site_id: int | None = None) -> None:
+        """Evict the given hosts, and every host cached for the given site."""
+        with self._lock:
+            keys = set(hosts)
+            if site_id is not None:
+                keys |= self._site_hosts.pop(site_id, set())
+            for key in keys:
+                self._data.pop(key, None)
+
+
+domain_cache = DomainCache(
+    maxsize=sites_config.domain_cache_size, ttl=sites_config.domain_cache_ttl
+)
+# Hosts known NOT to resolve, so that repeated requests for junk hosts (e.g. bot scans)
+# skip the database. This is kept separate from the domain cache so that a flood of
+# unknown hosts can only evict other unknown hosts, never real ones.
+unknown_hosts = LRUCache(
+    maxsize=sites_config.unknown_host_cache_size,
+    ttl=sites_config.unknown_host_cache_ttl,
+)
+
+# Per-process hit/miss counters for the domain cache tiers, exported to the metrics
+# endpoint by `domain_cache_metrics`. "misses" counts lookups that fell through to the
+# database.
+domain_cache_stats = Counter(local_hits=0, shared_hits=0, negative_hits=0, misses=0)
+
+SHARED_PREFIX = "webquills:sites:"
+GENERATION_KEY = f"{SHARED_PREFIX}generation"
+
+
+def domain_cache_metrics() -> list[str]:
+    """
+    Return the domain cache counters and sizes of this process, in the Prometheus text
+    format (see `webquills.metrics`), for sizing the caches.
+    """
+    lines = [
+        "# HELP webquills_domain_cache_lookups_total Domain cache lookups, by result.",
+        "# TYPE webquills_domain_cache_lookups_total counter",
+    ]
+    for result, count in sorted(domain_cache_stats.items()):
+        lines.append(
+            f'webquills_domain_cache_lookups_total{{result="{result}"}} {count}'
+        )
+    lines += [
+        "# HELP webquills_domain_cache_entries Entries in the per-process caches.",
+        "# TYPE webquills_domain_cache_entries gauge",
+        f'webquills_domain_cache_entries{{cache="domains"}} {len(domain_cache)}',
+        f'webquills_domain_cache_entries{{cache="unknown_hosts"}} {len(unknown_hosts)}',
+    ]
+    return lines
+
+
+def _host_key(host: str) -> str:
+    return f"{SHARED_PREFIX}host:{_record_format()}:{host}"
+
+
+@functools.cache
+def _record_format() -> str:
+    # Records are positional, so workers running different code (e.g. during a deploy
+    # that adds a field) must not read each other's records.
+    Domain = apps.get_model("sites", "Domain")
+    Site = apps.get_model("sites", "Site")
+    layout = _concrete_attnames(Domain) + _concrete_attnames(Site) + ("primary_host",)
+    return f"{zlib.crc32(','.join(layout).encode()):08x}"
+
+
+def _site_version_key(site_id: int) -> str:
+    return f"{SHARED_PREFIX}site:{site_id}"
+
+
+def _new_version() -> int:
+    # Versions only need to be unique, not ordered, so a fresh value can be written
+    # without a read-modify-write. A key evicted by the backend is simply replaced by
+    # a new version, which safely invalidates anything tagged with the old one.
+    return time.time_ns()
+
+
+def _shared_cache():
+    return caches[sites_config.domain_cache_alias]
+
+
+def _sync_generation(shared) -> None:
+    """Drop the per-process tier if another process has published a change."""
+    generation = shared.get_or_set(GENERATION_KEY, _new_version, timeout=None)
+    if generation != domain_cache.generation:
+        domain_cache.clear()
+        unknown_hosts.clear()
+        domain_cache.generation = generation
+
+
+def get_domain_record(host: str) -> tuple | None:
+    """
+    Return the cached record for a normalized host, or None if neither tier has it.
+    """
+    shared = _shared_cache() if sites_config.domain_shared_cache_ttl > 0 else None
+    if shared is not None:
+        _sync_generation(shared)
+    record = domain_cache.get(host)
+    if record is not None:
+        domain_cache_stats["local_hits"] += 1
+        return record
+    if shared is not None:
+        entry = shared.get(_host_key(host))
+        if entry is not None:
+            version, record = entry
+            site_key = _site_version_key(record_site_id(record))
+            if version == shared.get(site_key):
+                domain_cache_stats["shared_hits"] += 1
+                domain_cache.set(host, record)
+                return record
+    domain_cache_stats["misses"] += 1
+    return None
+
+
+def is_unknown_host(host: str) -> bool:
+    """Return True if the normalized host recently failed to resolve."""
+    if host in unknown_hosts:
+        domain_cache_stats["negative_hits"] += 1
+        return True
+    return False
+
+
+def set_unknown_host(host: str) -> None:
+    """Remember that the normalized host does not resolve to a servable site."""
+    unknown_hosts.set(host, True)
+
+
+def get_domain_generation() -> int | None:
+    """
+    Return the current shared generation of domain records, or None if there is no
+    shared tier. Read it before querying the database for a record, and pass it to
+    `set_domain_record`.
+    """
+    if sites_config.domain_shared_cache_ttl <= 0:
+        return None
+    return _shared_cache().get_or_set(GENERATION_KEY, _new_version, timeout=None)
+
+
+def set_domain_record(host: str, record: tuple, generation: int | None) -> None:
+    """
+    Store a record for a normalized host in both cache tiers, unless a change has
+    been published since `generation` (from `get_domain_generation`) was read, in
+    which case the record may be stale.
+    """
+    ttl = sites_config.domain_shared_cache_ttl
+    if ttl <= 0:
+        domain_cache.set(host, record)
+        return
+    shared = _shared_cache()
+    site_key = _site_version_key(record_site_id(record))
+    version = shared.get_or_set(site_key, _new_version, timeout=None)
+    # Checked after reading the version, since changes publish the generation along
+    # with the version. A change published after this check replaces the version,
+    # which invalidates the record stored under it.
+    if shared.get(GENERATION_KEY) != generation:
+        return
+    domain_cache.set(host, record)
+    shared.set(_host_key(host), (version, record), timeout=ttl)
+
+
+@functools.cache
+def _concrete_attnames(model) -> tuple[str, ...]:
+    return tuple(f.attname for f in model._meta.concrete_fields)
+
+
+def domain_to_record(domain) -> tuple:
+    """Serialize a Domain (and its Site) into a compact tuple of field values.
+
+    The record also carries the normalized primary host of the site (the
+    `primary_host` annotation added by `DomainManager.get_for_host`), so that it
+    doubles as the mapping from an alias host to its redirect target.
+    """
+    return (
+        tuple(getattr(domain, name) for name in _concrete_attnames(type(domain))),
+        tuple(
+            getattr(domain.site, name) for name in _concrete_attnames(type(domain.site))
+        ),
+        domain.primary_host,
+    )
+
+
+def domain_from_record(record: tuple):
+    """Build fresh Domain and Site instances from a record, without a query."""
+    Domain = apps.get_model("sites", "Domain")
+    Site = apps.get_model("sites", "Site")
+    domain_values, site_values, primary_host = record
+    domain = Domain.from_db(DEFAULT_DB_ALIAS, _concrete_attnames(Domain), domain_values)
+    domain.primary_host = primary_host
+    site = Site.from_db(DEFAULT_DB_ALIAS, _concrete_attnames(Site), site_values)
+    Domain.site.field.set_cached_value(domain, site)
+    return domain
+
+
+def record_site_id(record: tuple) -> int:
+    """Return the primary key of the Site in a domain record."""
+    # The Site's primary key is its first concrete field.
+    return record[1][0]
+
+
+def record_domain_value(record: tuple, attname: str):
+    """Return the value of one of the Domain's fields from a domain record."""
+    Domain = apps.get_model("sites", "Domain")
+    return record[0][_concrete_attnames(Domain).index(attname)]
+
+
+def record_primary_host(record: tuple) -> str | None:
+    """Return the normalized primary host of the Site in a domain record."""
+    return record[2]
+
+
+def _publish_invalidation(hosts: tuple[str, ...], site_id: int | None) -> None:
+    domain_cache.invalidate(hosts=hosts, site_id=site_id)
+    for host in hosts:
+        unknown_hosts.delete(host)
+    if site_id is not None:
+        # We don't know which unknown hosts belong to the site (e.g. an un-archived
+        # site), and changes are rare, so forget them all.
+        unknown_hosts.clear()
+    if sites_config.domain_shared_cache_ttl <= 0:
+        return
+    shared = _shared_cache()
+    if hosts:
+        shared.delete_many([_host_key(host) for host in hosts])
+    versions = {GENERATION_KEY: _new_version()}
+    if site_id is not None:
+        versions[_site_version_key(site_id)] = _new_version()
+    shared.set_many(versions, timeout=None)
+
+
+def invalidate_domains(hosts: Iterable[str] = (), site_id: int | None = None) -> None:
+    """
+    Evict cached resolutions for the given hosts and/or site, in every process.
+
+    The change is published immediately, and again when the current transaction
+    commits, so that no worker can re-cache the pre-commit state from the database.
+    """
+    hosts = tuple(hosts)
+    _publish_invalidation(hosts, site_id)
+    transaction.on_commit(lambda: _publish_invalidation(hosts, site_id))
+
+
+#######################################################################################
+# Page cache generations
+#######################################################################################
+def _page_cache():
+    return caches[sites_config.page_cache_alias]
+
+
+def _page_generation_key(site_id: int) -> str:
+    return f"{SHARED_PREFIX}page_generation:{site_id}"
+
+
+def get_page_generation(site_id: int) -> int:
+    """
+    Return the current generation of a site's cached pages. Cached pages are keyed by
+    generation, so replacing it invalidates all of them without scanning keys.
+    """
+    return _page_cache().get_or_set(
+        _page_generation_key(site_id), _new_version, timeout=None
+    )
+
+
+def _publish_page_generations(site_ids: tuple[int, ...]) -> None:
+    _page_cache().set_many(
+        {_page_generation_key(site_id): _new_version() for site_id in site_ids},
+        timeout=None,
+    )
+
+
+def invalidate_pages(site_ids: Iterable[int]) -> None:
+    """
+    Invalidate the cached pages of the given sites, in every process.
+
+    Like `invalidate_domains`, the change is published immediately and again when the
+    current transaction commits, so that no request can cache pre-commit content under
+    the new generation.
+    """
+    site_ids = tuple(site_ids)
+    if not site_ids or sites_config.page_cache_ttl <= 0:
+        return
+    _publish_page_generations(site_ids)
+    transaction.on_commit(lambda: _publish_page_generations(site_ids))
+
+
+#######################################################################################
+# Site permissions per user
+#######################################################################################
+def _user_sites_key(user_id: int) -> str:
+    return f"{SHARED_PREFIX}user_site_perms:{user_id}"
+
+
+# Permissions already looked up in the current request, by user ID.
+_user_sites_memo: ContextVar[dict[int, dict[int, frozenset[str]]] | None] = ContextVar(
+    "webquills_user_sites_memo", default=None
+)
+
+
+@contextmanager
+def memoize_user_sites() -> Iterator[None]:
+    """
+    Remember the site permissions looked up within the block (e.g. a request, see
+    `SitesMiddleware`), so that repeated checks cost nothing. Invalidations in the
+    block are applied to it too.
+    """
+    token = _user_sites_memo.set({})
+    try:
+        yield
+    finally:
+        _user_sites_memo.reset(token)
+
+
+def get_user_site_permissions(
+    user_id: int, load: Callable[[], dict[int, frozenset[str]]]
+) -> dict[int, frozenset[str]]:
+    """
+    Return a user's permissions on each site they can access, from the current
+    request's memo, the shared cache, or from `load` (which is then cached) on a miss.
+    """
+    memo = _user_sites_memo.get()
+    if memo is not None and user_id in memo:
+        return memo[user_id]
+    ttl = sites_config.user_sites_cache_ttl
+    if ttl <= 0:
+        perms = load()
+    else:
+        perms = _shared_cache().get_or_set(_user_sites_key(user_id), load, timeout=ttl)
+    if memo is not None:
+        memo[user_id] = perms
+    return perms
+
+
+def _delete_user_site_permissions(user_ids: tuple[int, ...]) -> None:
+    _shared_cache().delete_many([_user_sites_key(user_id) for user_id in user_ids])
+
+
+def invalidate_user_sites(user_ids: Iterable[int]) -> None:
+    """
+    Forget the cached site permissions of the given users, in every process.
+
+    Like `invalidate_domains`, the change is published immediately and again when the
+    current transaction commits, so that no request can cache the pre-commit state.
+    """
+    user_ids = tuple(user_ids)
+    memo = _user_sites_memo.get()
+    if memo:
+        for user_id in user_ids:
+            memo.pop(user_id, None)
+    if not user_ids or sites_config.user_sites_cache_ttl <= 0:
+        return
+    _delete_user_site_permissions(user_ids)
+    transaction.on_commit(lambda: _delete_user_site_permissions(user_ids))
+
+
+#######################################################################################
+# Subdomain index generation
+#######################################################################################
+SUBDOMAIN_INDEX_GENERATION_KEY = f"{SHARED_PREFIX}subdomain_index:generation"
+
+
+def get_subdomain_index_generation() -> int:
+    """
+    Return the generation of the per-process subdomain indexes (see
+    `webquills.sites.availability`). Each process reloads its index when it changes.
+    """
+    return _shared_cache().get_or_set(
+        SUBDOMAIN_INDEX_GENERATION_KEY, _new_version, timeout=None
+    )
+
+
+def publish_subdomain_index_change() -> None:
+    """
+    Tell every process to reload its subdomain index, when the current transaction
+    commits.
+    """
+    transaction.on_commit(
+        lambda: _shared_cache().set(
+            SUBDOMAIN_INDEX_GENERATION_KEY, _new_version(), timeout=None
+        )
+    )
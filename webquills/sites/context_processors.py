@@ -0,0 +1,22 @@
+"""
+Template context processors for sites.
+"""
+
+from commoncontent.apps import context_defaults
+from sitevars.context_processors import inject_sitevars
+
+from webquills.metrics import query_budget
+
+# commoncontent looks up the three site variables that choose its templates, then
+# sitevars loads them all.
+SITE_CONTEXT_QUERY_BUDGET = 4
+
+
+def site_context(request):
+    """
+    Add commoncontent's defaults and the site's variables, which override them, to the
+    context. These are looked up on every page, so they have a query budget of their
+    own instead of counting towards each view's. See webquills.metrics.
+    """
+    with query_budget("site_context", SITE_CONTEXT_QUERY_BUDGET):
+        return {**context_defaults(request), **inject_sitevars(request)}
@@ -0,0 +1,35 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from webquills.sites.actions import HOST_MAP_FORMATS, write_host_map
+
+sites_config = apps.get_app_config("sites")
+
+
+class Command(BaseCommand):
+    help = (
+        "Write a map of every served host (with alias redirects) for the edge web "
+        "server, as an nginx map include or Caddy JSON routes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            type=str,
+            help="Path of the file to write. Defaults to WEBQUILLS_HOST_MAP_PATH.",
+        )
+        parser.add_argument(
+            "--format",
+            choices=sorted(HOST_MAP_FORMATS),
+            help="The file format. Defaults to WEBQUILLS_HOST_MAP_FORMAT.",
+        )
+
+    def handle(self, *args, **options):
+        path = options.get("output") or sites_config.host_map_path
+        if not path:
+            raise CommandError("No --output given and WEBQUILLS_HOST_MAP_PATH not set.")
+        fmt = options.get("format") or sites_config.host_map_format
+        if write_host_map(path, fmt):
+            self.stdout.write(f"Wrote host map to {path}")
+        else:
+            self.stdout.write(f"Host map {path} is up to date.")
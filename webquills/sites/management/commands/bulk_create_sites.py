@@ -0,0 +1,108 @@
+import csv
+import json
+import sys
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from webquills.sites.actions import bulk_create_sites
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Create many sites at once from a CSV or JSONL file. Each record must have a "
+        "'subdomain', and may have a 'name' and an 'owner' (email or ID)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "file",
+            type=str,
+            help="Path to the CSV or JSONL file, or '-' to read from stdin.",
+        )
+        parser.add_argument(
+            "--format",
+            choices=["csv", "jsonl"],
+            help="The input format. Defaults to the file extension, or CSV for stdin.",
+        )
+        parser.add_argument(
+            "--user",
+            type=str,
+            help="The email or ID of the user who will own sites with no 'owner'.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="The number of sites to insert per transaction. Defaults to 500.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["file"]
+        fmt = options.get("format")
+        if not fmt:
+            fmt = "jsonl" if Path(path).suffix in (".jsonl", ".json") else "csv"
+
+        self._users = {}
+        default_owner = None
+        if options.get("user"):
+            default_owner = self.get_user(options["user"])
+            if default_owner is None:
+                raise CommandError(f"User '{options['user']}' not found.")
+
+        if path == "-":
+            records = list(self.read_records(sys.stdin, fmt))
+        else:
+            with open(path, newline="", encoding="utf-8") as f:
+                records = list(self.read_records(f, fmt))
+
+        # Resolve owners first; rows with an unknown owner are reported, not created.
+        rows = []
+        row_numbers = []
+        errors = []
+        for number, record in enumerate(records, start=1):
+            subdomain = (record.get("subdomain") or "").strip()
+            owner_input = (str(record.get("owner") or "")).strip()
+            owner = self.get_user(owner_input) if owner_input else default_owner
+            if owner is None:
+                errors.append((number, f"Owner '{owner_input}' not found."))
+                continue
+            name = (record.get("name") or "").strip()
+            name = name or f"{subdomain}.{settings.WEBQUILLS_ROOT_DOMAIN}"
+            rows.append((owner, name, subdomain))
+            row_numbers.append(number)
+
+        created, row_errors = bulk_create_sites(rows, batch_size=options["batch_size"])
+        errors.extend((row_numbers[index], message) for index, message in row_errors)
+
+        for number, message in sorted(errors):
+            self.stderr.write(f"Row {number}: {message}")
+        self.stdout.write(
+            f"Created {len(created)} sites, {len(errors)} rows had errors."
+        )
+
+    def read_records(self, f, fmt):
+        if fmt == "csv":
+            yield from csv.DictReader(f)
+            return
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise CommandError(f"Invalid JSON on line {line_number}: {e}") from e
+
+    def get_user(self, user_input: str):
+        """Look up a user by email or ID, caching the result."""
+        if user_input not in self._users:
+            if user_input.isdigit():
+                user = User.objects.filter(id=int(user_input)).first()
+            else:
+                user = User.objects.filter(email=user_input).first()
+            self._users[user_input] = user
+        return self._users[user_input]
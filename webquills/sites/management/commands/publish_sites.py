@@ -0,0 +1,99 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from webquills.sites.models import Site
+from webquills.sites.publishing import publish_sites
+from webquills.sites.tasks import publish_site_task
+
+
+class Command(BaseCommand):
+    help = (
+        "Publish sites as static HTML under WEBQUILLS_PUBLISH_ROOT, for the web server "
+        "to serve directly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "subdomains",
+            nargs="*",
+            help="The subdomains of the sites to publish. Defaults to all sites.",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Rebuild every page, rather than only pages affected by changes.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="The number of worker processes. Use 0 for one per CPU. Defaults to 1.",
+        )
+        parser.add_argument(
+            "--max-sites-per-worker",
+            type=int,
+            default=50,
+            help="Replace each worker process after it publishes this many sites.",
+        )
+        parser.add_argument(
+            "--celery",
+            action="store_true",
+            help="Queue one Celery task per site instead, to spread work across nodes.",
+        )
+
+    def handle(self, *args, **options):
+        sites = Site.objects.order_by("pk")
+        if options["subdomains"]:
+            sites = sites.filter(subdomain__in=options["subdomains"])
+            missing = set(options["subdomains"]) - {s.subdomain for s in sites}
+            if missing:
+                raise CommandError(f"Sites not found: {', '.join(sorted(missing))}")
+        site_ids = sites.values_list("pk", flat=True).iterator(chunk_size=2000)
+        full = options["full"] or None
+
+        if options["celery"]:
+            if getattr(settings, "CELERY_TASK_ALWAYS_EAGER", True):
+                raise CommandError(
+                    "--celery requires a broker (set CELERY_TASK_ALWAYS_EAGER=False)."
+                )
+            count = 0
+            for site_id in site_ids:
+                publish_site_task.delay(site_id, full)
+                count += 1
+            self.stdout.write(f"Queued {count} sites for publishing.")
+            return
+
+        workers = options["workers"] or os.cpu_count() or 1
+        started = time.perf_counter()
+        count = failed = errors = 0
+        for site_id, result, elapsed in publish_sites(
+            site_ids,
+            workers=workers,
+            full=full,
+            max_sites_per_worker=options["max_sites_per_worker"],
+        ):
+            count += 1
+            label = f"Site {site_id}"
+            if result is None:
+                failed += 1
+                self.stderr.write(f"{label}: failed after {elapsed:.2f}s")
+                continue
+            for path, status in result["errors"]:
+                self.stderr.write(f"{label}{path}: HTTP {status}")
+            errors += len(result["errors"])
+            self.stdout.write(
+                f"{label}: {len(result['written'])} written, "
+                f"{len(result['unchanged'])} unchanged, "
+                f"{len(result['removed'])} removed in {elapsed:.2f}s"
+            )
+        self.stdout.write(
+            f"Published {count} sites in {time.perf_counter() - started:.2f}s "
+            f"with {workers} workers."
+        )
+        if failed or errors:
+            raise CommandError(
+                f"{failed} sites failed, {errors} pages failed to render."
+            )
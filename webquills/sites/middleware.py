@@ -1,12 +1,86 @@
+import hashlib
 import logging
-from urllib.parse import urlparse, urlunparse
+import threading
+import time
+from collections import Counter
 
-from django.http.response import HttpResponseNotFound
-from django.shortcuts import redirect
+from django.apps import apps
+from django.core.cache import caches
+from django.http.request import split_domain_port
+from django.http.response import (
+    HttpResponse,
+    HttpResponseNotFound,
+    HttpResponseRedirect,
+)
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, has_vary_header
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import http_date
+from django.utils.translation import get_language
 
+from webquills.metrics import query_budget
+
+from .cache import (
+    SHARED_PREFIX,
+    domain_from_record,
+    get_page_generation,
+    memoize_user_sites,
+    record_domain_value,
+    record_primary_host,
+)
 from .models import Domain
+from .publishing import (
+    PUBLISHED_URL_NAMES,
+    PUBLISHING_ENVIRON_KEY,
+    templates_fingerprint,
+    templates_modified,
+)
+from .ratelimit import (
+    Bucket,
+    get_token_buckets,
+    ip_bucket_key,
+    retry_after,
+    site_bucket_key,
+)
 
 logger = logging.getLogger(__name__)
+sites_config = apps.get_app_config("sites")
+
+
+class UnknownHostLog:
+    """
+    Aggregates warnings about requests for unknown hosts. At most one message is logged
+    per `interval` seconds, reporting the number of requests since the last message
+    and the most frequent hosts. This keeps a flood of junk Host headers from turning
+    into a flood of disk writes.
+    """
+
+    # Bound the number of distinct hosts tracked between reports.
+    max_hosts = 100
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._hosts: Counter = Counter()
+        self._requests = 0
+        self._next_report = 0.0
+
+    def record(self, host: str) -> None:
+        with self._lock:
+            self._requests += 1
+            if host in self._hosts or len(self._hosts) < self.max_hosts:
+                self._hosts[host] += 1
+            now = time.monotonic()
+            if now < self._next_report:
+                return
+            hosts, requests = self._hosts, self._requests
+            self._hosts, self._requests = Counter(), 0
+            self._next_report = now + self.interval
+        logger.warning(
+            "No domain found for requests to %s (%d requests since last report)",
+            ", ".join(f"{h[:255]!r} x{n}" for h, n in hosts.most_common(5)),
+            requests,
+        )
 
 
 class SitesMiddleware(object):
@@ -14,29 +88,269 @@ class SitesMiddleware(object):
     The SitesMiddleware looks up the Domain for this request and maps it to a Site,
     setting attributes on the request for both. If the Domain is not Primary for the
     Site, the middleware will redirect to the Primary Domain.
+
+    If `WEBQUILLS_LAZY_SITE` is set, `request.domain` and `request.site` are lazy
+    objects, only built if the view actually uses them.
     """
 
     def __init__(self, get_response):
         self.get_response = get_response
+        self.unknown_hosts = UnknownHostLog(sites_config.unknown_host_log_interval)
+        self.lazy = sites_config.lazy_site
 
     def __call__(self, request):
-        request.domain = Domain.objects.get_for_request(request)
+        # Users' site permissions are looked up at most once per request.
+        with memoize_user_sites():
+            if self.lazy:
+                return self.lazy_call(request)
+            return self.eager_call(request)
+
+    def eager_call(self, request):
+        """Look up the domain and site, and set them on the request."""
+        with query_budget("SitesMiddleware", 1):
+            request.domain = Domain.objects.get_for_request(request)
         if request.domain is None:
-            logger.warning(
-                "No domain found for request '%s'",
-                request.build_absolute_uri(),
-            )
+            self.unknown_hosts.record(request.get_host())
             return HttpResponseNotFound()
         request.site = request.domain.site
+        return self.route(
+            request,
+            request.domain.normalized_domain,
+            request.domain.is_primary,
+            request.domain.primary_host,
+        )
+
+    def lazy_call(self, request):
+        """
+        Check the host against the cached domain record only, and set `request.domain`
+        and `request.site` as lazy objects, built on first access.
+        """
+        host, port = split_domain_port(request.get_host())
+        with query_budget("SitesMiddleware", 1):
+            record = Domain.objects.get_record_for_host(host)
+        if record is None:
+            self.unknown_hosts.record(request.get_host())
+            return HttpResponseNotFound()
+        request.domain = SimpleLazyObject(lambda: domain_from_record(record))
+        request.site = SimpleLazyObject(lambda: request.domain.site)
+        return self.route(
+            request,
+            record_domain_value(record, "normalized_domain"),
+            record_domain_value(record, "is_primary"),
+            record_primary_host(record),
+        )
+
+    def route(self, request, normalized_domain, is_primary, primary_host):
+        """Serve the request, or redirect it to the site's primary domain."""
         # Special case, don't redirect for localhost or testserver
         # This is useful for testing and local development.
-        if request.domain.is_primary or request.domain.normalized_domain in [
-            "localhost",
-            "testserver",
-        ]:
+        if is_primary or normalized_domain in ["localhost", "testserver"]:
+            return self.get_response(request)
+        # A site without a primary domain is served from whichever domain it has.
+        if not primary_host:
             return self.get_response(request)
         # Redirect to primary domain if not already there
-        to = urlparse(request.build_absolute_uri())
-        to = to._replace(netloc=request.site.primary_domain.normalized_domain)
-        to = urlunparse(to)
-        return redirect(to)
+        return HttpResponseRedirect(
+            f"{request.scheme}://{primary_host}{request.get_full_path()}"
+        )
+
+
+class RateLimitMiddleware:
+    """
+    Refuses requests with 429 Too Many Requests when their site or client IP has
+    exhausted its token bucket (see `ratelimit`), so that no single site or client can
+    occupy the whole worker pool. Each request costs at most one cache round trip.
+
+    Requests from the publisher (see `publishing.render_path`) are not limited, so
+    that publishing a large site neither fails nor starves its readers.
+
+    Place this after the SitesMiddleware, which sets `request.site`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.site_rate = sites_config.rate_limit_site_rate
+        self.site_burst = sites_config.rate_limit_site_burst
+        self.ip_rate = sites_config.rate_limit_ip_rate
+        self.ip_burst = sites_config.rate_limit_ip_burst
+        self.ip_header = sites_config.rate_limit_ip_header
+        self.buckets = None
+        self._page = None
+        if self.site_rate > 0 or self.ip_rate > 0:
+            self.buckets = get_token_buckets(sites_config.rate_limit_cache_alias)
+
+    def __call__(self, request):
+        if self.buckets is None or request.META.get(PUBLISHING_ENVIRON_KEY):
+            return self.get_response(request)
+        buckets = []
+        site = getattr(request, "site", None)
+        if self.site_rate > 0 and site is not None:
+            buckets.append(
+                Bucket(site_bucket_key(site.pk), self.site_rate, self.site_burst)
+            )
+        ip = request.META.get(self.ip_header, "")
+        if self.ip_rate > 0 and ip:
+            # A forwarding header may list several hops; the client is the first.
+            ip = ip.split(",")[0].strip()
+            buckets.append(Bucket(ip_bucket_key(ip), self.ip_rate, self.ip_burst))
+        wait = self.buckets.take(buckets) if buckets else None
+        if wait is None:
+            return self.get_response(request)
+        # The page is the same for every request, and refusals must stay cheap.
+        if self._page is None:
+            self._page = render_to_string("429.html")
+        response = HttpResponse(self._page, status=429)
+        response.headers["Retry-After"] = str(retry_after(wait))
+        # Don't turn a flood of requests into a flood of log messages.
+        response._has_been_logged = True
+        return response
+
+
+class ConditionalGetMiddleware:
+    """
+    Answers conditional requests for a site's public pages (see
+    `publishing.PUBLISHED_URL_NAMES`) before the view runs, so that revalidation by
+    crawlers and CDNs returns 304 Not Modified without rendering any template.
+
+    The validators are derived from the site's `modified_date` (which changes with its
+    content, see `signals.content_changed`) and the deployed templates, so checking
+    them needs no database query beyond resolving the site. HTML pages get weak ETags,
+    since only their meaning is guaranteed to be unchanged; feeds get strong ETags.
+
+    Pages for logged-in users may differ per user, so they are always rendered. Place
+    this after the SitesMiddleware and AuthenticationMiddleware.
+    """
+
+    strong_etag_url_names = frozenset({"site_feed", "section_feed", "author_feed"})
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        validators = getattr(request, "_webquills_validators", None)
+        if validators is not None and response.status_code == 200:
+            etag, last_modified = validators
+            if not response.has_header("ETag"):
+                response.headers["ETag"] = etag
+            if not response.has_header("Last-Modified"):
+                response.headers["Last-Modified"] = http_date(last_modified)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return None
+        match = request.resolver_match
+        if match.namespace or match.url_name not in PUBLISHED_URL_NAMES:
+            return None
+        site = getattr(request, "site", None)
+        if site is None or request.user.is_authenticated:
+            return None
+        last_modified = max(site.modified_date.timestamp(), templates_modified())
+        tag = hashlib.md5(
+            f"{site.pk}:{last_modified}:{templates_fingerprint()}".encode(),
+            usedforsecurity=False,
+        ).hexdigest()
+        if match.url_name in self.strong_etag_url_names:
+            etag = f'"{tag}"'
+        else:
+            etag = f'W/"{tag}"'
+        last_modified = int(last_modified)
+        request._webquills_validators = (etag, last_modified)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is not None:
+            response.headers["ETag"] = etag
+            response.headers["Last-Modified"] = http_date(last_modified)
+        return response
+
+
+class PageCacheMiddleware:
+    """
+    Serves a site's public pages (see `publishing.PUBLISHED_URL_NAMES`) to anonymous
+    readers from the `WEBQUILLS_PAGE_CACHE_ALIAS` cache, so that an unchanged page
+    costs no template rendering and no database query.
+
+    Pages are cached per normalized host, path (with query string), language and the
+    values of the `WEBQUILLS_PAGE_CACHE_COOKIES`. Keys also include the site's page
+    generation (see `cache.invalidate_pages`), which is replaced whenever the site's
+    content, variables or domains change, and the template fingerprint, so stale pages
+    are never looked up again and simply expire.
+
+    The publisher (see `publishing.render_path`) renders every page itself, so its
+    requests neither use nor fill the cache.
+
+    Place this after the ConditionalGetMiddleware, so that revalidation is answered
+    first and cached pages still get validators.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.ttl = sites_config.page_cache_ttl
+        self.cookies = sorted(sites_config.page_cache_cookies)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        key = getattr(request, "_webquills_page_key", None)
+        if key is not None and self.is_cacheable(request, response):
+            caches[sites_config.page_cache_alias].set(
+                key,
+                (response.status_code, list(response.items()), response.content),
+                timeout=self.ttl,
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.ttl <= 0 or request.method not in ("GET", "HEAD"):
+            return None
+        if request.META.get(PUBLISHING_ENVIRON_KEY):
+            return None
+        match = request.resolver_match
+        if match.namespace or match.url_name not in PUBLISHED_URL_NAMES:
+            return None
+        site = getattr(request, "site", None)
+        if site is None or request.user.is_authenticated:
+            return None
+        variant = "\n".join(
+            [
+                request.domain.normalized_domain,
+                request.get_full_path(),
+                get_language() or "",
+                *(request.COOKIES.get(name, "") for name in self.cookies),
+            ]
+        )
+        key = "{}page:{}:{}:{}:{}".format(
+            SHARED_PREFIX,
+            site.pk,
+            get_page_generation(site.pk),
+            templates_fingerprint()[:12],
+            hashlib.md5(variant.encode(), usedforsecurity=False).hexdigest(),
+        )
+        cached = caches[sites_config.page_cache_alias].get(key)
+        if cached is None:
+            request._webquills_page_key = key
+            return None
+        status, headers, content = cached
+        response = HttpResponse(content, status=status)
+        for header, value in headers:
+            response.headers[header] = value
+        return response
+
+    @staticmethod
+    def is_cacheable(request, response) -> bool:
+        """
+        Return True if the response is the same for every anonymous reader, e.g. it
+        does not set a cookie or include a CSRF token.
+        """
+        if response.status_code != 200 or response.streaming or response.cookies:
+            return False
+        if request.META.get("CSRF_COOKIE_NEEDS_UPDATE") or has_vary_header(
+            response, "*"
+        ):
+            return False
+        cache_control = response.get("Cache-Control", "").lower()
+        return not any(
+            directive in cache_control
+            for directive in ("private", "no-cache", "no-store")
+        )
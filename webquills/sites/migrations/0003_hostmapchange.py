@@ -0,0 +1,21 @@
+# Generated by Django 6.0.9 on 2026-10-17 00:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0002_publishchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostMapChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site_id', models.BigIntegerField()),
+                ('create_date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
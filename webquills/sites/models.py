@@ -1,12 +1,25 @@
 from __future__ import annotations
 
+from collections.abc import Set
+
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
 from django.db import models, transaction
 from django.http.request import split_domain_port
 from django.urls import reverse
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
+from webquills.sites.cache import (
+    domain_from_record,
+    domain_to_record,
+    get_domain_generation,
+    get_domain_record,
+    get_user_site_permissions,
+    is_unknown_host,
+    set_domain_record,
+    set_unknown_host,
+)
 from webquills.sites.validators import normalize_domain, validate_subdomain
 
 User = get_user_model()
@@ -31,19 +44,38 @@ class BlockReason(models.Model):
 # Site Model and support classes
 #######################################################################################
 class SiteQuerySet(models.QuerySet):
+    def permissions_for(self, user) -> dict[int, frozenset[str]]:
+        """Return the given user's permissions on each site they have access to.
+
+        A user has access to the sites whose groups they belong to. On each of them,
+        they have the permissions granted to them and to their other groups, plus any
+        granted to the site's group, as "app_label.codename" strings. The map is
+        cached across requests, and memoized within each request (see
+        `webquills.sites.cache.get_user_site_permissions`), so repeated checks in a
+        request cost nothing.
+        """
+        if not user.is_authenticated:
+            return {}
+        return get_user_site_permissions(
+            user.pk, lambda: _load_site_permissions(self.model, user.pk)
+        )
+
+    def accessible_ids(self, user) -> Set[int]:
+        """Return the set of IDs of all sites that the given user has access to.
+
+        Use this for authorization checks. See `permissions_for`.
+        """
+        return self.permissions_for(user).keys()
+
     def ids_for_user(self, user) -> list[int]:
-        """Return a list of site IDs that the given user has access to.
+        """Return a sorted list of site IDs that the given user has access to.
 
         Use this when you need to filter a queryset of sites based on user permissions,
         but do not otherwise need to instantiate the Site objects.
         """
-        # A user may have access to sites they do not own. Access permission is
-        # determined by group membership.
-        return list(
-            self.filter(group__in=user.groups.all())
-            .values_list("id", flat=True)
-            .distinct()
-        )
+        if not self.query.has_filters():
+            return sorted(self.accessible_ids(user))
+        return list(self.for_user(user).order_by("pk").values_list("pk", flat=True))
 
     def for_user(self, user) -> SiteQuerySet:
         """Return a queryset of sites that the given user has access to.
@@ -52,9 +84,58 @@ class SiteQuerySet(models.QuerySet):
         and you do need to instantiate the Site objects.
         """
         # A user may have access to sites they do not own. Access permission is
-        # determined by group membership.
+        # determined by group membership. A subquery, rather than the cached IDs, so
+        # that users with many sites don't need as many query parameters.
         return self.filter(group__in=user.groups.all())
 
+    def with_domain_names(self) -> SiteQuerySet:
+        """Annotate each site with its primary and canonical domain names.
+
+        Adds `primary_domain_name` and `canonical_domain_name` (display domains, or
+        None) in the same query as the sites, which `Site.domain` uses if present.
+        Since the names make it unnecessary, this clears the prefetch of domains (and
+        any other prefetches) set by the manager.
+        """
+        return self.prefetch_related(None).annotate(
+            primary_domain_name=models.Subquery(
+                Domain.objects.filter(site=models.OuterRef("pk"), is_primary=True)
+                .order_by()
+                .values("display_domain")[:1]
+            ),
+            canonical_domain_name=models.Subquery(
+                Domain.objects.filter(site=models.OuterRef("pk"), is_canonical=True)
+                .order_by()
+                .values("display_domain")[:1]
+            ),
+        )
+
+
+def _load_site_permissions(model, user_id: int) -> dict[int, frozenset[str]]:
+    own = frozenset(
+        f"{app_label}.{codename}"
+        for app_label, codename in Permission.objects.filter(
+            # The site groups' permissions apply only to their own sites.
+            models.Q(user=user_id) | models.Q(group__user=user_id, group__site=None)
+        )
+        .order_by()
+        .values_list("content_type__app_label", "codename")
+        .distinct()
+    )
+    # Sites whose groups grant nothing more share the same set, which is pickled once.
+    perms = {}
+    for site_id, app_label, codename in model._base_manager.filter(
+        group__user=user_id
+    ).values_list(
+        "pk",
+        "group__permissions__content_type__app_label",
+        "group__permissions__codename",
+    ):
+        if codename is None:
+            perms.setdefault(site_id, own)
+        else:
+            perms[site_id] = perms.get(site_id, own) | {f"{app_label}.{codename}"}
+    return perms
+
 
 class SiteManager(models.Manager):
     def get_queryset(self):
@@ -118,17 +199,47 @@ class Site(models.Model):
     def get_absolute_url(self):
         return reverse("site_update", kwargs={"pk": self.pk})
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # As loaded, so that saving can tell whether the subdomain changed.
+        instance._loaded_normalized_subdomain = instance.__dict__.get(
+            "normalized_subdomain"
+        )
+        return instance
+
+    def subdomain_changed(self, update_fields=None) -> bool:
+        """
+        Return True if the normalized subdomain differs from the one loaded from the
+        database (or if it is not known, e.g. for instances not loaded from it).
+        """
+        if update_fields is not None and "normalized_subdomain" not in update_fields:
+            return False
+        loaded = getattr(self, "_loaded_normalized_subdomain", None)
+        return loaded is None or loaded != self.normalized_subdomain
+
     @cached_property
     def canonical_domain(self) -> Domain:
-        return self.domains.filter(is_canonical=True).first()
+        return self._get_flagged_domain("is_canonical")
 
     @cached_property
     def primary_domain(self) -> Domain:
-        return self.domains.filter(is_primary=True).first()
+        return self._get_flagged_domain("is_primary")
+
+    def _get_flagged_domain(self, flag: str) -> Domain | None:
+        # Use prefetched domains if available (SiteManager prefetches them), to avoid
+        # a query per site.
+        prefetched = getattr(self, "_prefetched_objects_cache", {}).get("domains")
+        if prefetched is not None:
+            return next((d for d in prefetched if getattr(d, flag)), None)
+        return self.domains.filter(**{flag: True}).first()
 
     @property
     def domain(self) -> str:
         """For compatibility with Django's RequestSite (returns primary domain string)"""
+        # Annotated by SiteQuerySet.with_domain_names()
+        if hasattr(self, "primary_domain_name"):
+            return self.primary_domain_name or ""
         if self.primary_domain:
             return self.primary_domain.display_domain
         return ""
@@ -144,6 +255,23 @@ class Site(models.Model):
 #######################################################################################
 # Domain Model and support classes
 #######################################################################################
+class DomainQuerySet(models.QuerySet):
+    def servable(self) -> DomainQuerySet:
+        """Exclude domains of sites that are archived or blocked."""
+        return self.filter(site__archive_date=None, site__block_reason=None)
+
+    def with_primary_host(self) -> DomainQuerySet:
+        """Annotate each domain with `primary_host`, the normalized primary domain of
+        its site (or None if the site has no primary domain)."""
+        return self.annotate(
+            primary_host=models.Subquery(
+                Domain.objects.filter(site=models.OuterRef("site"), is_primary=True)
+                .order_by()
+                .values("normalized_domain")[:1]
+            )
+        )
+
+
 class DomainManager(models.Manager):
     def get_queryset(self):
         return super().get_queryset().select_related("site")
@@ -158,17 +286,62 @@ class DomainManager(models.Manager):
         If the domain is not found, returns None.
         """
         host, port = split_domain_port(request.get_host())
-        domain = normalize_domain(host)
+        return self.get_for_host(host)
+
+    def get_for_host(self, host: str) -> Domain | None:
+        """
+        Returns the Domain object for the given host name, or None if not found.
+
+        The Domain is annotated with `primary_host`, the normalized primary domain of
+        its site (or None if the site has no primary domain), so that redirects from
+        alias domains need no further query.
+
+        Resolutions are cached per process and in the shared cache (see
+        `webquills.sites.cache`), so the steady state requires no database query.
+        """
+        record = self.get_record_for_host(host)
+        if record is None:
+            return None
+        return domain_from_record(record)
+
+    def get_record_for_host(self, host: str) -> tuple | None:
+        """
+        Returns the cached record (see `webquills.sites.cache`) for the given host
+        name, querying the database on a cache miss, or None if not found.
+
+        Use this instead of `get_for_host` when you only need a few values and want to
+        avoid building model instances.
+        """
+        try:
+            domain = normalize_domain(host)
+        except UnicodeError:
+            # get_host() accepts some hosts that IDNA does not (e.g. "ab--cd.com", or
+            # labels over 63 characters), which can't be any site's.
+            if not is_unknown_host(host):
+                set_unknown_host(host)
+            return None
+        record = get_domain_record(domain)
+        if record is not None:
+            return record
+        if is_unknown_host(domain):
+            return None
+        # Read before querying, so that a change committed during the query does not
+        # leave a stale record in the cache.
+        generation = get_domain_generation()
         # We don't want to return a Domain for sites that are archived or blocked.
-        return (
+        found = (
             self.get_queryset()
-            .filter(
-                normalized_domain=domain,
-                site__archive_date=None,
-                site__block_reason=None,
-            )
+            .servable()
+            .with_primary_host()
+            .filter(normalized_domain=domain)
             .first()
         )
+        if found is None:
+            set_unknown_host(domain)
+            return None
+        record = domain_to_record(found)
+        set_domain_record(domain, record, generation)
+        return record
 
 
 class Domain(models.Model):
@@ -179,7 +352,7 @@ class Domain(models.Model):
     is_primary = models.BooleanField(default=False)
     is_canonical = models.BooleanField(default=False)
 
-    objects = DomainManager()
+    objects = DomainManager.from_queryset(DomainQuerySet)()
 
     class Meta:
         constraints = [
@@ -222,3 +395,37 @@ class Domain(models.Model):
                 qs.update(is_canonical=False)
 
             super().save(*args, **kwargs)
+
+
+#######################################################################################
+# Publishing support
+#######################################################################################
+class PublishChange(models.Model):
+    """
+    A change to something a site's published pages may depend on, recorded so that
+    the next incremental publish of the site knows which pages to rebuild.
+    """
+
+    site = models.ForeignKey(
+        Site, on_delete=models.CASCADE, related_name="publish_changes"
+    )
+    # The changed object, as "app_label.model_name:pk" (see publishing.change_key).
+    key = models.CharField(max_length=255)
+    create_date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return self.key
+
+
+class HostMapChange(models.Model):
+    """
+    A change to a site's hosts, recorded so that the next rebuild of the host map only
+    reloads that site's entries.
+    """
+
+    # Not a foreign key, since the hosts of deleted sites must be removed too.
+    site_id = models.BigIntegerField()
+    create_date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return str(self.site_id)
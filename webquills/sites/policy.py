@@ -0,0 +1,242 @@
+"""
+The subdomain policy: names that sites may not use.
+
+A policy has two kinds of rules:
+
+- reserved names, which a subdomain may not be (e.g. "static", or a trademark), and
+- blocked words, which a subdomain may not contain anywhere (e.g. abuse terms).
+
+Both are matched on "skeletons" of the names, in which characters that look alike are
+the same (e.g. Cyrillic "а" and Latin "a", "0" and "o", "rn" and "m"), accents are
+removed and hyphens are ignored. So if "paypal" is blocked, so are "pay-pal",
+"pаypal" (with a Cyrillic "а") and "my-paypa1-login".
+
+Rules come from settings (`WEBQUILLS_RESERVED_SUBDOMAINS` and
+`WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS`) and from files (`..._FILES`, one rule per line,
+with blank lines and lines starting with "#" ignored). They are compiled once, into a
+frozenset of reserved skeletons and an Aho-Corasick automaton of blocked words, so
+that checking a name takes a few microseconds however many rules there are. The
+policy is recompiled when the settings change, but not when the files do: restart
+the processes to apply changed files.
+"""
+
+from __future__ import annotations
+
+import threading
+import unicodedata
+from array import array
+from collections import deque
+from collections.abc import Iterable
+from pathlib import Path
+
+import idna
+from django.apps import apps
+
+sites_config = apps.get_app_config("sites")
+
+# Characters that look like (lowercase) Latin letters, and digits that look like
+# letters. Fullwidth and other compatibility forms are handled by NFKD.
+CONFUSABLES = str.maketrans(
+    {
+        # Cyrillic
+        "а": "a",
+        "в": "b",
+        "е": "e",
+        "һ": "h",
+        "і": "i",
+        "ј": "j",
+        "к": "k",
+        "ӏ": "l",
+        "о": "o",
+        "р": "p",
+        "ԛ": "q",
+        "с": "c",
+        "ѕ": "s",
+        "у": "y",
+        "х": "x",
+        "ԁ": "d",
+        "ԝ": "w",
+        # Greek
+        "α": "a",
+        "ι": "i",
+        "κ": "k",
+        "ν": "v",
+        "ο": "o",
+        "ρ": "p",
+        "υ": "u",
+        "χ": "x",
+        # Latin
+        "ı": "i",
+        "ȷ": "j",
+        "ɡ": "g",
+        "ł": "l",
+        "ø": "o",
+        # Digits
+        "0": "o",
+        "1": "l",
+        # Ignored
+        "-": None,
+    }
+)
+# Sequences of letters that look like another letter.
+CONFUSABLE_SEQUENCES = (("rn", "m"), ("vv", "w"))
+
+
+def skeleton(name: str) -> str:
+    """Reduce a name to its skeleton, the same for names that look alike."""
+    if name.startswith("xn--"):
+        try:
+            name = idna.decode(name)
+        except idna.IDNAError:
+            pass
+    name = unicodedata.normalize("NFKD", name.casefold())
+    if not name.isascii():
+        name = "".join(c for c in name if not unicodedata.combining(c))
+    name = name.translate(CONFUSABLES)
+    for sequence, replacement in CONFUSABLE_SEQUENCES:
+        if sequence in name:
+            name = name.replace(sequence, replacement)
+    return name
+
+
+class AhoCorasick:
+    """
+    An Aho-Corasick automaton, which finds any of a set of words in a string in one
+    pass over the string, however many words there are.
+
+    Transitions are kept in a single dict keyed by state and character, rather than a
+    dict per state, to keep large sets of words compact.
+    """
+
+    def __init__(self, words: Iterable[str]):
+        self._goto: dict[int, int] = {}
+        self._output: dict[int, str] = {}
+        children: list[list[int]] = [[]]
+        for word in words:
+            if not word:
+                continue
+            state = 0
+            for char in word:
+                key = self._key(state, char)
+                next_state = self._goto.get(key)
+                if next_state is None:
+                    next_state = len(children)
+                    self._goto[key] = next_state
+                    children.append([])
+                    children[state].append(next_state)
+                state = next_state
+            self._output.setdefault(state, word)
+        # Failure links, in breadth-first order, so that each state's link is known
+        # before its children's. Each state also outputs its link's word, if it has
+        # none of its own, so that a search needs one lookup per character.
+        self._fail = array("q", bytes(8 * len(children)))
+        chars = {state: key & 0x1FFFFF for key, state in self._goto.items()}
+        queue = deque(children[0])
+        while queue:
+            state = queue.popleft()
+            for child in children[state]:
+                char = chars[child]
+                fail = self._fail[state]
+                while True:
+                    target = self._goto.get((fail << 21) | char)
+                    if target is not None:
+                        break
+                    if fail == 0:
+                        target = 0
+                        break
+                    fail = self._fail[fail]
+                self._fail[child] = target
+                if child not in self._output and target in self._output:
+                    self._output[child] = self._output[target]
+                queue.append(child)
+
+    @staticmethod
+    def _key(state: int, char: str) -> int:
+        return (state << 21) | ord(char)
+
+    def __len__(self) -> int:
+        return len(self._fail)
+
+    def search(self, text: str) -> str | None:
+        """Return a word found in the text, or None."""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in text:
+            code = ord(char)
+            while True:
+                next_state = goto.get((state << 21) | code)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            if state in output:
+                return output[state]
+        return None
+
+
+class SubdomainPolicy:
+    """A compiled set of subdomain rules. See the module docs."""
+
+    def __init__(self, reserved: Iterable[str] = (), blocked_words: Iterable[str] = ()):
+        self.reserved = frozenset(skeleton(name) for name in reserved)
+        self.blocked_words = AhoCorasick(skeleton(word) for word in blocked_words)
+
+    def violation(self, subdomain: str) -> str | None:
+        """
+        Return why the policy forbids a subdomain ("reserved" or "blocked"), or None
+        if it allows it.
+        """
+        name = skeleton(subdomain)
+        if name in self.reserved:
+            return "reserved"
+        if self.blocked_words.search(name) is not None:
+            return "blocked"
+        return None
+
+
+def read_rules(paths: Iterable[str | Path]) -> Iterable[str]:
+    """Yield the rules in the given files, one per line."""
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+
+
+_compiled: tuple[tuple, SubdomainPolicy] | None = None
+_compile_lock = threading.Lock()
+
+
+def subdomain_policy() -> SubdomainPolicy:
+    """
+    Return the policy compiled from the current settings, compiling it if the
+    settings have changed since it was last compiled.
+    """
+    global _compiled
+    sources = (
+        sites_config.reserved_names,
+        sites_config.reserved_names_files,
+        sites_config.blocked_subdomain_words,
+        sites_config.blocked_subdomain_words_files,
+    )
+    compiled = _compiled
+    if compiled is None or _changed(compiled[0], sources):
+        with _compile_lock:
+            compiled = _compiled
+            if compiled is None or _changed(compiled[0], sources):
+                reserved, reserved_files, words, words_files = sources
+                policy = SubdomainPolicy(
+                    reserved=[*reserved, *read_rules(reserved_files)],
+                    blocked_words=[*words, *read_rules(words_files)],
+                )
+                _compiled = compiled = (sources, policy)
+    return compiled[1]
+
+
+def _changed(old: tuple, new: tuple) -> bool:
+    # Settings are compared by identity, which is cheap, since changes (including
+    # override_settings) replace the objects.
+    return any(a is not b for a, b in zip(old, new, strict=True))
@@ -0,0 +1,597 @@
+"""
+Static publishing: render a Site's public pages to files that a web server can serve
+directly, so that content is rendered once per change instead of once per request.
+
+Pages are rendered by the same Django request handler (middleware, views, templates
+and `request.site`) that serves them dynamically, using the site's primary host. The
+output for each site goes to `<WEBQUILLS_PUBLISH_ROOT>/<primary host>/`, laid out so
+that a web server can map the request path directly onto it:
+
+- `/` and other paths ending in a slash are written to `index.html` in that directory.
+- Any other path (e.g. `/section/article.html`, `/index.rss`) is written as is.
+
+For example, in nginx:
+
+    root /path/to/publish_root/$host;
+    try_files $uri $uri/index.html @webquills;
+    gzip_static on;
+    brotli_static on;
+
+Compressible pages also get precompressed `.gz` (and `.br`) siblings, see
+`webquills.storage`.
+
+Static and media files are not copied; serve `STATIC_URL` and `MEDIA_URL` from
+`STATIC_ROOT` and `MEDIA_ROOT` as usual.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextvars import ContextVar
+from html.parser import HTMLParser
+from multiprocessing import get_context
+from pathlib import Path
+from urllib.parse import urljoin, urlsplit
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler, WSGIRequest
+from django.db import close_old_connections, connection
+from django.db.models.signals import post_init
+from django.template import engines
+from django.urls import NoReverseMatch, Resolver404, resolve, reverse
+
+from webquills.sites.models import Domain, PublishChange, Site
+from webquills.storage import compress_files, remove_compressed
+
+logger = logging.getLogger(__name__)
+sites_config = apps.get_app_config("sites")
+
+# The commoncontent URL names that render public pages. Other URLs (e.g. the CMS,
+# accounts and redirects) are never published.
+PUBLISHED_URL_NAMES = frozenset(
+    {
+        "home_page",
+        "home_paginated",
+        "site_feed",
+        "author_list",
+        "author_page",
+        "author_page_paginated",
+        "author_feed",
+        "section_page",
+        "section_paginated",
+        "section_feed",
+        "article_page",
+        "article_series_page",
+        "landing_page",
+    }
+)
+# Set in the WSGI environ of requests made by the publisher, which must always render
+# pages (to record their dependencies) rather than serve them from the page cache.
+PUBLISHING_ENVIRON_KEY = "webquills.publishing"
+
+
+class _LinkParser(HTMLParser):
+    """Collects the href attributes of a document."""
+
+    def __init__(self):
+        super().__init__()
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if name == "href" and value:
+                self.hrefs.append(value)
+
+
+@functools.cache
+def _handler() -> WSGIHandler:
+    # Loading the middleware is relatively expensive, so reuse one handler.
+    return WSGIHandler()
+
+
+def site_output_dir(host: str) -> Path:
+    """Return the directory that the site with the given primary host is written to."""
+    return Path(sites_config.publish_root) / host
+
+
+def output_path(path: str) -> str:
+    """Return the file path, relative to the site's output directory, for a URL path."""
+    if path.endswith("/"):
+        path += "index.html"
+    return path.lstrip("/")
+
+
+def is_published_path(path: str) -> bool:
+    """Return True if the URL path is one of the site's public pages."""
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return False
+    return not match.namespace and match.url_name in PUBLISHED_URL_NAMES
+
+
+def site_seed_paths(site: Site) -> list[str]:
+    """
+    Return the paths of the site's known pages. Other pages (e.g. pagination) are
+    found by following links from these.
+    """
+    from commoncontent.sitemaps import sitemaps
+
+    paths = [reverse("home_page"), reverse("site_feed"), reverse("author_list")]
+    for name, sitemap_class in sitemaps.items():
+        if name == "home":
+            continue
+        sitemap = sitemap_class()
+        sitemap.site = site
+        for item in sitemap.items():
+            paths.append(item.get_absolute_url())
+            if name == "sections":
+                paths.append(reverse("section_feed", args=[item.slug]))
+            elif name == "authors":
+                paths.append(reverse("author_feed", args=[item.slug]))
+    return paths
+
+
+def render_path(host: str, path: str):
+    """Render a GET request for the path on the host, returning the response."""
+    https = settings.SECURE_SSL_REDIRECT
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": host,
+        "SERVER_PORT": "443" if https else "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": host,
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "https" if https else "http",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        PUBLISHING_ENVIRON_KEY: True,
+    }
+    if https and getattr(settings, "SECURE_PROXY_SSL_HEADER", None):
+        header, value = settings.SECURE_PROXY_SSL_HEADER
+        environ[header] = value
+    # get_response() rather than the WSGI call, to skip the request_started and
+    # request_finished signals (which would close the caller's database connection).
+    return _handler().get_response(WSGIRequest(environ))
+
+
+def _links(host: str, path: str, content: bytes, charset: str) -> set[str]:
+    """Return the paths of the links in an HTML page that point to the same host."""
+    parser = _LinkParser()
+    parser.feed(content.decode(charset, errors="replace"))
+    base = f"//{host}{path}"
+    links = set()
+    for href in parser.hrefs:
+        url = urlsplit(urljoin(base, href))
+        if url.netloc in ("", host) and url.path.startswith("/"):
+            links.add(url.path)
+    return links
+
+
+def write_file(path: Path, content: bytes) -> bool:
+    """
+    Atomically replace the file with the content, unless it already has that content.
+
+    :return: True if the file was written, False if it was already up to date.
+    """
+    try:
+        if path.read_bytes() == content:
+            return False
+    except (FileNotFoundError, IsADirectoryError):
+        pass
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as f:
+        try:
+            f.write(content)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+    return True
+
+
+def change_key(instance) -> str:
+    """Return the dependency key of a model instance, e.g. "commoncontent.article:1"."""
+    return f"{instance._meta.label_lower}:{instance.pk}"
+
+
+class _DependencyRecorder:
+    """
+    Records what a page depends on while it renders: the model instances it loads
+    (keyed like `change_key`), and the models whose tables it queries (keyed by model
+    label), since a new or changed row in those tables may change its query results.
+    """
+
+    def __init__(self):
+        self.keys = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip()[:6].upper() == "SELECT":
+            tables = _model_tables()
+            self.keys.update(
+                tables[name] for name in _quoted_name.findall(sql) if name in tables
+            )
+        return execute(sql, params, many, context)
+
+
+_quoted_name = re.compile(r'["`]([^"`]+)["`]')
+_recorder: ContextVar[_DependencyRecorder | None] = ContextVar(
+    "publishing_recorder", default=None
+)
+
+
+@functools.cache
+def _model_tables() -> dict[str, str]:
+    return {m._meta.db_table: m._meta.label_lower for m in apps.get_models()}
+
+
+def _record_instance(sender, instance, **kwargs):
+    recorder = _recorder.get()
+    if recorder is not None and instance.pk is not None:
+        recorder.keys.add(change_key(instance))
+
+
+@functools.cache
+def _template_stats() -> tuple[tuple[str, int, int], ...]:
+    # Templates only change on deploy, so this is computed once per process.
+    files = [Path(settings.STATIC_ROOT) / "staticfiles.json"]
+    for engine in engines.all():
+        for directory in engine.template_dirs:
+            files.extend(sorted(Path(directory).rglob("*")))
+    stats = []
+    for file in files:
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            continue
+        stats.append((str(file), stat.st_mtime_ns, stat.st_size))
+    return tuple(stats)
+
+
+@functools.cache
+def templates_fingerprint() -> str:
+    """
+    Return a fingerprint of every template and of the static files manifest. Pages
+    are not tracked per template: if any changes, every page is rebuilt.
+    """
+    digest = hashlib.sha256()
+    for file, mtime, size in _template_stats():
+        digest.update(f"{file}:{mtime}:{size}\n".encode())
+    return digest.hexdigest()
+
+
+@functools.cache
+def templates_modified() -> float:
+    """Return the time the templates or static files manifest last changed."""
+    return max((mtime for _, mtime, _ in _template_stats()), default=0) / 1e9
+
+
+# Detail pages look up their own object by slug, so they do not depend on the other
+# rows of its table.
+DETAIL_URL_MODELS = {
+    "article_page": "commoncontent.article",
+    "article_series_page": "commoncontent.article",
+    "landing_page": "commoncontent.page",
+}
+
+
+def render_page(host: str, path: str) -> tuple[int, bytes, str | None, list[str]]:
+    """
+    Render a published page, recording what it depends on.
+
+    :return: A tuple of (status code, content, charset if the content is HTML or else
+        None, sorted dependency keys).
+    """
+    recorder = _DependencyRecorder()
+    token = _recorder.set(recorder)
+    try:
+        with connection.execute_wrapper(recorder):
+            response = render_path(host, path)
+            try:
+                if response.streaming:
+                    content = b"".join(response.streaming_content)
+                else:
+                    content = response.content
+            finally:
+                response.close()
+    finally:
+        _recorder.reset(token)
+    recorder.keys.discard(DETAIL_URL_MODELS.get(resolve(path).url_name))
+    charset = None
+    if response.get("Content-Type", "").startswith("text/html"):
+        charset = response.charset
+    return response.status_code, content, charset, sorted(recorder.keys)
+
+
+MANIFEST_NAME = ".manifest.json"
+MANIFEST_VERSION = 1
+
+
+def load_manifest(out_dir: Path) -> dict | None:
+    """Return the site's build manifest, or None if it is missing or unusable."""
+    try:
+        manifest = json.loads((out_dir / MANIFEST_NAME).read_bytes())
+    except (FileNotFoundError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def publish_site(site: Site, full: bool | None = None) -> dict:
+    """
+    Render a site's public pages to its output directory.
+
+    A full build renders every page, starting from the site's known pages and
+    following links. Each page's dependencies (content it loaded, tables it queried)
+    and content hash are kept in a manifest in the output directory, so that an
+    incremental build only renders pages that depend on a pending `PublishChange`,
+    plus any new pages they link to. Unchanged pages are never rewritten.
+
+    Pages that render successfully are written (if changed), and files for pages that
+    no longer exist are removed. If a page fails to render, its previously published
+    file is kept. A site that cannot be served (e.g. archived or blocked) is
+    unpublished.
+
+    :param site: The site to publish.
+    :param full: Whether to rebuild every page. By default, builds are incremental if
+        changes are being recorded (see `WEBQUILLS_PUBLISH_ON_CHANGE`). A full build
+        is always done if the manifest is missing or the templates have changed.
+    :return: A dict with lists of the URL paths that were "written", "unchanged",
+        "removed", and the (path, status code) pairs of "errors".
+    """
+    result = {"written": [], "unchanged": [], "removed": [], "errors": []}
+    domain = Domain.objects.servable().filter(site=site, is_primary=True).first()
+    if domain is None:
+        logger.debug("Site %s cannot be served, unpublishing", site.pk)
+        unpublish_site(site)
+        PublishChange.objects.filter(site=site).delete()
+        return result
+    host = domain.normalized_domain
+    out_dir = site_output_dir(host)
+
+    if full is None:
+        full = not sites_config.publish_on_change
+    changes = dict(PublishChange.objects.filter(site=site).values_list("pk", "key"))
+    manifest = load_manifest(out_dir)
+    if (
+        manifest is None
+        or manifest["host"] != host
+        or manifest["templates"] != templates_fingerprint()
+    ):
+        full = True
+    pages = {} if full else manifest["pages"]
+
+    if full:
+        queue = [p for p in site_seed_paths(site) if is_published_path(p)]
+    else:
+        queue = _dirty_paths(pages, set(changes.values()))
+    keep = set()
+    seen = set()
+    rendered = []
+    post_init.connect(_record_instance, dispatch_uid="sites_publishing")
+    try:
+        while queue:
+            path = queue.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            status, content, charset, deps = render_page(host, path)
+            if status in (404, 410):
+                if pages.pop(path, None) is not None:
+                    file = out_dir / output_path(path)
+                    file.unlink(missing_ok=True)
+                    remove_compressed(file)
+                    result["removed"].append(path)
+                continue
+            # Keep the previous version of pages that fail to render.
+            keep.add(output_path(path))
+            if status != 200:
+                result["errors"].append((path, status))
+                continue
+            digest = hashlib.sha256(content).hexdigest()
+            file = out_dir / output_path(path)
+            previous = pages.get(path)
+            if previous and previous["hash"] == digest and file.exists():
+                written = False
+            else:
+                written = write_file(file, content)
+            result["written" if written else "unchanged"].append(path)
+            rendered.append(file)
+            pages[path] = {"hash": digest, "deps": deps}
+            if charset:
+                for link in _links(host, path, content, charset):
+                    # Incremental builds only follow links to pages not yet built.
+                    if link in seen or (not full and link in pages):
+                        continue
+                    if is_published_path(link):
+                        queue.append(link)
+    finally:
+        post_init.disconnect(dispatch_uid="sites_publishing")
+
+    # Siblings are only rewritten for pages whose content changed.
+    compress_files(rendered)
+    if full:
+        result["removed"] = _remove_stale_files(out_dir, keep)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "host": host,
+        "templates": templates_fingerprint(),
+        "pages": pages,
+    }
+    write_file(out_dir / MANIFEST_NAME, json.dumps(manifest).encode())
+    PublishChange.objects.filter(pk__in=changes).delete()
+    logger.debug(
+        "Published site %s to %s (%s): %d written, %d unchanged, %d removed, %d errors",
+        site.pk,
+        out_dir,
+        "full" if full else f"{len(changes)} changes",
+        len(result["written"]),
+        len(result["unchanged"]),
+        len(result["removed"]),
+        len(result["errors"]),
+    )
+    return result
+
+
+def _dirty_paths(pages: dict, changed: set[str]) -> list[str]:
+    """Return the paths of pages affected by the changed keys, plus the changed
+    objects' own pages (which may be new)."""
+    index: dict[str, set[str]] = {}
+    for path, page in pages.items():
+        for dep in page["deps"]:
+            index.setdefault(dep, set()).add(path)
+    dirty = set()
+    for key in changed:
+        label, _, pk = key.partition(":")
+        dirty |= index.get(key, set())
+        dirty |= index.get(label, set())
+        try:
+            model = apps.get_model(label)
+        except (LookupError, ValueError):
+            continue
+        if hasattr(model, "get_absolute_url"):
+            instance = model._default_manager.filter(pk=pk).first()
+            if instance is not None:
+                try:
+                    path = instance.get_absolute_url()
+                except NoReverseMatch:
+                    continue
+                if is_published_path(path):
+                    dirty.add(path)
+    return sorted(dirty)
+
+
+def _remove_stale_files(out_dir: Path, keep: set[str]) -> list[str]:
+    removed = []
+    if not out_dir.is_dir():
+        return removed
+    for dirpath, _, filenames in os.walk(out_dir, topdown=False):
+        for filename in filenames:
+            file = Path(dirpath) / filename
+            relative = file.relative_to(out_dir).as_posix()
+            # Dotfiles are in-progress writes or bookkeeping, not pages.
+            if filename.startswith(".") or relative in keep:
+                continue
+            page = relative.removesuffix(".gz").removesuffix(".br")
+            if page != relative:
+                # A compressed sibling, removed with (or kept with) its page.
+                if page not in keep:
+                    file.unlink()
+                continue
+            file.unlink()
+            removed.append("/" + relative.removesuffix("index.html"))
+        if dirpath != str(out_dir) and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    return removed
+
+
+def unpublish_site(site: Site) -> None:
+    """Remove the published output of every host of the site."""
+    for host in site.domains.values_list("normalized_domain", flat=True):
+        shutil.rmtree(site_output_dir(host), ignore_errors=True)
+
+
+#######################################################################################
+# Publishing many sites
+#######################################################################################
+def publish_site_by_id(
+    site_id: int, full: bool | None = None
+) -> tuple[dict | None, float]:
+    """
+    Publish one site, for use in worker processes and tasks. Errors are logged rather
+    than raised, so that one broken site does not stop a platform-wide publish.
+
+    :return: A tuple of (the result of `publish_site`, or None if the site does not
+        exist or publishing failed, elapsed seconds).
+    """
+    started = time.perf_counter()
+    # Workers are long-lived, so treat each site like a request.
+    close_old_connections()
+    try:
+        site = Site.objects.filter(pk=site_id).first()
+        result = None if site is None else publish_site(site, full=full)
+    except Exception:
+        logger.exception("Failed to publish site %s", site_id)
+        result = None
+    finally:
+        close_old_connections()
+    elapsed = time.perf_counter() - started
+    logger.debug("Finished publishing site %s in %.2fs", site_id, elapsed)
+    return result, elapsed
+
+
+def _publish_in_worker(
+    site_id: int, full: bool | None
+) -> tuple[int, dict | None, float]:
+    return (site_id, *publish_site_by_id(site_id, full=full))
+
+
+def publish_sites(
+    site_ids: Iterable[int],
+    workers: int = 1,
+    full: bool | None = None,
+    max_sites_per_worker: int = 50,
+) -> Iterator[tuple[int, dict | None, float]]:
+    """
+    Publish many sites, sharded by site across a pool of worker processes.
+
+    Sites are submitted as workers become free, so memory in the parent stays bounded
+    however many sites there are, and each worker process is replaced after
+    publishing `max_sites_per_worker` sites, bounding its memory too.
+
+    :param site_ids: The IDs of the sites to publish. May be a lazy iterator.
+    :param workers: The number of worker processes. With 1, sites are published in
+        this process.
+    :param full: Passed to `publish_site`.
+    :param max_sites_per_worker: The number of sites each worker publishes before it
+        is replaced.
+    :return: An iterator of (site ID, result or None, elapsed seconds) tuples, in
+        order of completion.
+    """
+    if workers <= 1:
+        for site_id in site_ids:
+            yield _publish_in_worker(site_id, full)
+        return
+    # Workers are spawned, not forked, so that they share no connections, locks or
+    # memory with this process. Each sets up Django before unpickling any work.
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=get_context("spawn"),
+        initializer=django.setup,
+        max_tasks_per_child=max_sites_per_worker,
+    ) as pool:
+        pending = set()
+        for site_id in site_ids:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(pool.submit(_publish_in_worker, site_id, full))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
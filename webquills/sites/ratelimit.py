@@ -0,0 +1,163 @@
+"""
+Token bucket rate limiting, so that one abusive client or one busy site cannot take
+the whole worker pool from every other tenant.
+
+Each bucket holds up to `burst` tokens and refills at `rate` tokens per second. A
+request takes one token from each of its buckets (e.g. its site's and its client
+IP's), and is refused if any of them is empty.
+
+With a Redis cache backend, buckets are shared by all workers and checked by a Lua
+script, atomically and in a single round trip for all of a request's buckets. With
+any other backend, or if Redis is unavailable, each process keeps its own buckets.
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import logging
+import math
+import threading
+import time
+from typing import NamedTuple
+
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+
+from .cache import SHARED_PREFIX, LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class Bucket(NamedTuple):
+    key: str
+    rate: float
+    burst: int
+
+
+def site_bucket_key(site_id: int) -> str:
+    return f"{SHARED_PREFIX}ratelimit:site:{site_id}"
+
+
+def ip_bucket_key(ip: str) -> str:
+    """
+    Return the bucket key for a client IP. IPv6 clients are limited per /64 network,
+    since a single client is usually assigned a whole /64.
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return f"{SHARED_PREFIX}ratelimit:ip:{ip[:64]}"
+    if address.version == 6 and address.ipv4_mapped is None:
+        ip = str(ipaddress.IPv6Network((address, 64), strict=False).network_address)
+    elif address.version == 6:
+        ip = str(address.ipv4_mapped)
+    return f"{SHARED_PREFIX}ratelimit:ip:{ip}"
+
+
+class LocalTokenBuckets:
+    """Token buckets kept in this process, for backends other than Redis."""
+
+    def __init__(self, maxsize: int = 100_000):
+        # An evicted bucket is as good as full, so only the least recently used go.
+        self._buckets = LRUCache(maxsize=maxsize, ttl=float("inf"))
+        self._lock = threading.Lock()
+
+    def take(self, buckets: list[Bucket], now: float | None = None) -> float | None:
+        """
+        Take a token from each bucket, or none if any is empty.
+
+        :return: None if the request is allowed, otherwise the number of seconds until
+            it would be.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            levels = []
+            wait = 0.0
+            for bucket in buckets:
+                tokens, updated = self._buckets.get(bucket.key, (bucket.burst, now))
+                tokens = min(
+                    bucket.burst, tokens + max(0.0, now - updated) * bucket.rate
+                )
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / bucket.rate)
+                levels.append(tokens)
+            for bucket, tokens in zip(buckets, levels, strict=True):
+                self._buckets.set(bucket.key, (tokens if wait else tokens - 1, now))
+        return wait or None
+
+
+# KEYS are the buckets; ARGV is the current time followed by (rate, burst) for each.
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call("HMGET", key, "tokens", "updated")
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call("HSET", key, "tokens", tostring(tokens), "updated", ARGV[1])
+    redis.call("EXPIRE", key, math.ceil(burst / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+class RedisTokenBuckets:
+    """Token buckets shared by all workers through a Django `RedisCache`."""
+
+    def __init__(self, cache: RedisCache):
+        self.cache = cache
+        self.fallback = LocalTokenBuckets()
+        self._script = None
+        self._failing = False
+
+    def take(self, buckets: list[Bucket], now: float | None = None) -> float | None:
+        """See `LocalTokenBuckets.take`."""
+        now = time.time() if now is None else now
+        keys = [self.cache.make_key(bucket.key) for bucket in buckets]
+        args = [repr(now)]
+        for bucket in buckets:
+            args += [repr(float(bucket.rate)), str(bucket.burst)]
+        try:
+            if self._script is None:
+                client = self.cache._cache.get_client(keys[0], write=True)
+                self._script = client.register_script(TAKE_SCRIPT)
+            wait = float(self._script(keys=keys, args=args))
+        except Exception:
+            # Log once per outage, not once per request.
+            if not self._failing:
+                logger.warning(
+                    "Rate limiting per process until Redis is back", exc_info=True
+                )
+                self._failing = True
+            return self.fallback.take(buckets, now)
+        self._failing = False
+        return wait or None
+
+
+def get_token_buckets(alias: str) -> LocalTokenBuckets | RedisTokenBuckets:
+    """Return the token buckets for the cache backend with the given alias."""
+    cache = caches[alias]
+    if isinstance(cache, RedisCache):
+        return RedisTokenBuckets(cache)
+    return LocalTokenBuckets()
+
+
+def retry_after(wait: float) -> int:
+    """Return the Retry-After header value, in whole seconds, for a wait."""
+    return max(1, math.ceil(wait))
@@ -0,0 +1,106 @@
+"""
+Signal handlers for the sites framework. These are connected in `SitesConfig.ready`.
+"""
+
+import shutil
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from webquills.sites.availability import subdomain_index
+from webquills.sites.cache import (
+    invalidate_domains,
+    invalidate_pages,
+    invalidate_user_sites,
+)
+from webquills.sites.models import Site
+from webquills.sites.publishing import change_key, site_output_dir
+from webquills.sites.tasks import schedule_host_map_rebuild, schedule_site_publish
+
+
+def domain_changed(sender, instance, **kwargs):
+    """Evict cached resolutions when a Domain is saved or deleted."""
+    # Saving a domain may also change sibling domains (e.g. clearing is_primary), so
+    # evict every host cached for the site, not just this one.
+    invalidate_domains(hosts=[instance.normalized_domain], site_id=instance.site_id)
+    # Pages include links built from the primary domain.
+    invalidate_pages([instance.site_id])
+    # A site's domains are part of the site, for consumers of incremental exports.
+    # Using update() avoids sending the Site's post_save signal again.
+    Site.objects.filter(pk=instance.site_id).update(modified_date=timezone.now())
+    schedule_host_map_rebuild([instance.site_id])
+    # A new primary domain changes where the site is published.
+    schedule_site_publish(instance.site_id, change_key(instance))
+
+
+def domain_deleted(sender, instance, **kwargs):
+    """Remove anything published for a deleted Domain's host."""
+    path = site_output_dir(instance.normalized_domain)
+    transaction.on_commit(lambda: shutil.rmtree(path, ignore_errors=True))
+
+
+def site_changed(sender, instance, created=False, **kwargs):
+    """Evict cached resolutions when a Site is saved or deleted (e.g. archived or
+    blocked)."""
+    if kwargs["signal"] is post_save and (
+        created or instance.subdomain_changed(kwargs["update_fields"])
+    ):
+        subdomain_index.note_taken([instance.normalized_subdomain], created=created)
+        instance._loaded_normalized_subdomain = instance.normalized_subdomain
+    invalidate_domains(site_id=instance.pk)
+    invalidate_pages([instance.pk])
+    Membership = get_user_model().groups.through
+    invalidate_user_sites(
+        Membership.objects.filter(group_id=instance.group_id).values_list(
+            "user_id", flat=True
+        )
+    )
+    schedule_host_map_rebuild([instance.pk])
+    schedule_site_publish(instance.pk, change_key(instance))
+
+
+def site_access_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Forget the cached site permissions of users whose groups or permissions
+    changed."""
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    User = get_user_model()
+    if sender is not Group.permissions.through:
+        # A user's groups or permissions changed, or a group's or permission's users.
+        if not reverse:
+            user_ids = [instance.pk]
+        elif action == "pre_clear":
+            # pk_set is not given when clearing.
+            user_ids = instance.user_set.values_list("pk", flat=True)
+        else:
+            user_ids = pk_set
+    else:
+        # A group's permissions changed, or a permission's groups.
+        if not reverse:
+            group_ids = [instance.pk]
+        elif action == "pre_clear":
+            group_ids = instance.group_set.values_list("pk", flat=True)
+        else:
+            group_ids = pk_set
+        user_ids = (
+            User.groups.through.objects.filter(group__in=group_ids)
+            .values_list("user_id", flat=True)
+            .distinct()
+        )
+    invalidate_user_sites(user_ids)
+
+
+def content_changed(sender, instance, **kwargs):
+    """Republish a site when a piece of its content is saved or deleted."""
+    if instance.site_id is None:
+        return
+    # Conditional GETs are validated against the site's modified_date, which must be
+    # in the database (rather than a cache) for every worker to see the change. Using
+    # update() avoids sending the Site's post_save signal.
+    Site.objects.filter(pk=instance.site_id).update(modified_date=timezone.now())
+    invalidate_domains(site_id=instance.site_id)
+    invalidate_pages([instance.site_id])
+    schedule_site_publish(instance.site_id, change_key(instance))
@@ -0,0 +1,127 @@
+"""
+Celery tasks for the sites framework. These are thin wrappers around actions.
+"""
+
+import functools
+import logging
+from collections.abc import Iterable
+
+from celery import shared_task
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+
+from webquills.sites.actions import write_host_map
+from webquills.sites.models import HostMapChange, PublishChange
+from webquills.sites.publishing import publish_site_by_id
+
+logger = logging.getLogger(__name__)
+sites_config = apps.get_app_config("sites")
+
+HOST_MAP_PENDING_KEY = "webquills:sites:host_map_pending"
+PUBLISH_PENDING_KEY = "webquills:sites:publish_pending:{}"
+
+
+def tasks_are_queued() -> bool:
+    """
+    Return True if Celery tasks are sent to a broker. Otherwise they run eagerly, in
+    the process (and request) that scheduled them, so work that is scheduled on
+    every change is skipped instead.
+    """
+    return not getattr(settings, "CELERY_TASK_ALWAYS_EAGER", True)
+
+
+@functools.cache
+def _warn_not_queued(setting: str, command: str) -> None:
+    logger.warning(
+        "%s is set, but Celery tasks run eagerly (CELERY_TASK_ALWAYS_EAGER), so "
+        "changes are not applied until the %s command is run.",
+        setting,
+        command,
+    )
+
+
+@shared_task
+def rebuild_host_map(full: bool = False) -> bool:
+    """
+    Rebuild the configured host map file. Returns True if it changed.
+
+    :param full: Whether to rebuild every entry. By default, only the entries of sites
+        with a pending `HostMapChange` are reloaded.
+    """
+    cache.delete(HOST_MAP_PENDING_KEY)
+    changes = dict(HostMapChange.objects.values_list("pk", "site_id"))
+    path = sites_config.host_map_path
+    written = False
+    if path:
+        site_ids = None if full else set(changes.values())
+        written = write_host_map(path, sites_config.host_map_format, site_ids)
+    if changes:
+        HostMapChange.objects.filter(pk__lte=max(changes)).delete()
+    return written
+
+
+def schedule_host_map_rebuild(site_ids: Iterable[int]) -> None:
+    """
+    Update the host map after the current transaction commits, if one is configured.
+
+    Changes are coalesced: while a rebuild is pending, further changes schedule
+    nothing, since the pending rebuild will include them. Requires a Celery broker;
+    without one, run the build_host_map command instead.
+
+    :param site_ids: The IDs of the sites whose hosts may have changed.
+    """
+    if not sites_config.host_map_path:
+        return
+    if not tasks_are_queued():
+        _warn_not_queued("WEBQUILLS_HOST_MAP_PATH", "build_host_map")
+        return
+    site_ids = set(site_ids)
+    delay = sites_config.host_map_delay
+
+    def schedule():
+        HostMapChange.objects.bulk_create(
+            [HostMapChange(site_id=site_id) for site_id in site_ids]
+        )
+        if cache.add(HOST_MAP_PENDING_KEY, True, timeout=delay + 60):
+            rebuild_host_map.apply_async(countdown=delay)
+
+    transaction.on_commit(schedule)
+
+
+@shared_task
+def publish_site_task(site_id: int, full: bool | None = None) -> None:
+    """Publish the site with the given ID as static HTML."""
+    cache.delete(PUBLISH_PENDING_KEY.format(site_id))
+    publish_site_by_id(site_id, full=full)
+
+
+def schedule_site_publish(site_id: int, key: str | None = None) -> None:
+    """
+    Republish a site after the current transaction commits, if publishing on change
+    is enabled. Changes are coalesced per site, as for the host map. Requires a
+    Celery broker; without one, changes are recorded for the publish_sites command.
+
+    :param site_id: The ID of the site to republish.
+    :param key: The changed object (see `publishing.change_key`), recorded so that
+        the republish only rebuilds the pages that depend on it.
+    """
+    if not sites_config.publish_on_change:
+        return
+    delay = sites_config.publish_delay
+
+    def schedule():
+        if key is not None:
+            try:
+                PublishChange.objects.create(site_id=site_id, key=key)
+            except IntegrityError:
+                # The site has been deleted, so there is nothing to republish.
+                return
+        if not tasks_are_queued():
+            _warn_not_queued("WEBQUILLS_PUBLISH_ON_CHANGE", "publish_sites")
+            return
+        if cache.add(PUBLISH_PENDING_KEY.format(site_id), True, timeout=delay + 60):
+            publish_site_task.apply_async((site_id,), countdown=delay)
+
+    transaction.on_commit(schedule)
@@ -1,3 +1,8 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
@@ -5,11 +10,15 @@ from django.db import IntegrityError
 from django.test import TestCase, override_settings
 
 from webquills.sites.actions import (
+    bulk_create_sites,
     create_default_groups_and_perms,
     create_site,
+    export_sites,
     update_site,
+    write_host_map,
 )
-from webquills.sites.models import Domain
+from webquills.sites.models import Domain, HostMapChange, Site
+from webquills.sites.tasks import _warn_not_queued, rebuild_host_map
 from webquills.sites.validators import ValidationError
 
 User = get_user_model()
@@ -78,3 +87,200 @@ class TestActions(TestCase):
         create_site(self.user, "Site 1", "duplicate")
         with self.assertRaises(IntegrityError):
             create_site(self.user, "Site 2", "duplicate")
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="testserver")
+class TestBulkCreateSites(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password")
+
+    def test_bulk_create_sites(self):
+        rows = [(self.user, f"Site {i}", f"site{i}") for i in range(5)]
+        created, errors = bulk_create_sites(rows, batch_size=2)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(created), 5)
+        for i in range(5):
+            site = Site.objects.get(subdomain=f"site{i}")
+            self.assertEqual(site.name, f"Site {i}")
+            self.assertEqual(site.owner, self.user)
+            self.assertEqual(site.group.name, f"site:site{i}")
+            self.assertTrue(site.group.user_set.filter(id=self.user.id).exists())
+            self.assertEqual(site.primary_domain, site.canonical_domain)
+            self.assertEqual(site.primary_domain.display_domain, f"site{i}.testserver")
+            self.assertIsNotNone(site.create_date)
+
+    def test_query_count_does_not_grow_per_site(self):
+        rows = [(self.user, f"Site {i}", f"site{i}") for i in range(50)]
+        # Validation (sites, groups) and one insert per table, plus savepoints.
+        with self.assertNumQueries(8):
+            bulk_create_sites(rows)
+
+    def test_reports_errors_per_row(self):
+        create_site(self.user, "Existing", "existing")
+        rows = [
+            (self.user, "Good", "good"),
+            (self.user, "Invalid", "invalid_subdomain!"),
+            (self.user, "Existing", "existing"),
+            (self.user, "Duplicate", "GOOD"),
+            (self.user, "Also good", "alsogood"),
+        ]
+        created, errors = bulk_create_sites(rows)
+        self.assertEqual([s.subdomain for s in created], ["good", "alsogood"])
+        self.assertEqual([index for index, message in errors], [1, 2, 3])
+
+    def test_falls_back_to_per_row_on_database_error(self):
+        rows = [(self.user, "One", "one"), (self.user, "Two", "two")]
+        with patch(
+            "webquills.sites.actions._bulk_insert_sites", side_effect=IntegrityError
+        ):
+            created, errors = bulk_create_sites(rows)
+        self.assertEqual(len(created), 2)
+        self.assertEqual(errors, [])
+
+    def test_new_hosts_are_not_negatively_cached(self):
+        self.assertIsNone(Domain.objects.get_for_host("new.testserver"))
+        bulk_create_sites([(self.user, "New", "new")])
+        self.assertIsNotNone(Domain.objects.get_for_host("new.testserver"))
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="testserver")
+class TestExportSites(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", email="t@x.com")
+        bulk_create_sites([(self.user, f"Site {i}", f"site{i}") for i in range(5)])
+
+    def test_export_sites(self):
+        rows = list(export_sites(chunk_size=2))
+        self.assertEqual(
+            [row["subdomain"] for row in rows], [f"site{i}" for i in range(5)]
+        )
+        self.assertEqual(rows[0]["owner_email"], "t@x.com")
+        self.assertIsNone(rows[0]["block_reason"])
+        self.assertEqual(
+            rows[0]["domains"],
+            [
+                {
+                    "display_domain": "site0.testserver",
+                    "normalized_domain": "site0.testserver",
+                    "is_primary": True,
+                    "is_canonical": True,
+                }
+            ],
+        )
+
+    def test_queries_per_chunk(self):
+        # One query for the sites, plus one per chunk for the domains.
+        with self.assertNumQueries(4):
+            list(export_sites(chunk_size=2))
+
+    def test_export_since(self):
+        site = Site.objects.get(subdomain="site3")
+        Domain.objects.create(site=site, display_domain="alias.testserver")
+        site.refresh_from_db()
+        rows = list(export_sites(since=site.modified_date))
+        self.assertEqual([row["subdomain"] for row in rows], ["site3"])
+        self.assertEqual(len(rows[0]["domains"]), 2)
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="testserver")
+class TestWriteHostMap(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "hosts.map"
+        user = User.objects.create_user(username="testuser")
+        self.site = create_site(user, "Site", "site")
+        Domain.objects.create(site=self.site, display_domain="alias.example.com")
+        archived = create_site(user, "Archived", "archived")
+        archived.archive_date = "2023-01-01T00:00:00Z"
+        archived.save()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_nginx(self):
+        self.assertTrue(write_host_map(self.path, "nginx"))
+        content = self.path.read_text()
+        site_map, redirect_map = content.split("map $host $webquills_redirect")
+        self.assertIn(f"    site.testserver {self.site.pk};", site_map)
+        self.assertIn(f"    alias.example.com {self.site.pk};", site_map)
+        self.assertNotIn("archived.testserver", content)
+        self.assertIn("    alias.example.com site.testserver;", redirect_map)
+        self.assertNotIn("    site.testserver", redirect_map)
+
+    def test_caddy(self):
+        self.assertTrue(write_host_map(self.path, "caddy"))
+        redirect, reject = json.loads(self.path.read_text())
+        self.assertEqual(redirect["match"], [{"host": ["alias.example.com"]}])
+        self.assertEqual(
+            redirect["handle"][0]["headers"]["Location"],
+            ["{http.request.scheme}://site.testserver{http.request.uri}"],
+        )
+        self.assertEqual(
+            reject["match"],
+            [{"not": [{"host": ["alias.example.com", "site.testserver"]}]}],
+        )
+
+    def test_unchanged_file_is_not_rewritten(self):
+        self.assertTrue(write_host_map(self.path))
+        self.assertFalse(write_host_map(self.path))
+        self.assertEqual(list(self.path.parent.iterdir()), [self.path])
+
+    def assertMatchesFullRebuild(self, fmt="nginx"):
+        full = self.path.with_name("full.map")
+        write_host_map(full, fmt)
+        self.assertEqual(self.path.read_text(), full.read_text())
+
+    def test_incremental(self):
+        write_host_map(self.path)
+        other = create_site(User.objects.create_user(username="other"), "O", "other")
+        moved = Domain.objects.get(normalized_domain="alias.example.com")
+        moved.site = other
+        moved.save()
+        with self.assertNumQueries(1):
+            self.assertTrue(write_host_map(self.path, site_ids=[other.pk]))
+        # The moved host is no longer an alias of the first site, though that site's
+        # entries were not reloaded.
+        self.assertMatchesFullRebuild()
+        site_id = self.site.pk
+        self.site.delete()
+        self.assertTrue(write_host_map(self.path, site_ids=[site_id]))
+        self.assertMatchesFullRebuild()
+
+    def test_incremental_reloads_only_changed_sites(self):
+        write_host_map(self.path)
+        Domain.objects.create(site=self.site, display_domain="new.example.com")
+        self.assertFalse(write_host_map(self.path, site_ids=[]))
+        self.assertTrue(write_host_map(self.path, site_ids=[self.site.pk]))
+        self.assertMatchesFullRebuild()
+
+    def test_incremental_needs_readable_format(self):
+        write_host_map(self.path, "caddy")
+        Domain.objects.create(site=self.site, display_domain="new.example.com")
+        self.assertTrue(write_host_map(self.path, "caddy", site_ids=[]))
+        self.assertMatchesFullRebuild("caddy")
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
+    def test_rebuilt_when_domains_change(self):
+        write_host_map(self.path)
+        with (
+            override_settings(WEBQUILLS_HOST_MAP_PATH=str(self.path)),
+            patch.object(rebuild_host_map, "apply_async") as apply_async,
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                Domain.objects.create(site=self.site, display_domain="new.example.com")
+                Domain.objects.create(site=self.site, display_domain="new2.example.com")
+            apply_async.assert_called_once_with(countdown=5)
+            self.assertTrue(rebuild_host_map())
+        self.assertIn("new2.example.com", self.path.read_text())
+        self.assertFalse(HostMapChange.objects.exists())
+
+    def test_not_rebuilt_when_tasks_run_eagerly(self):
+        _warn_not_queued.cache_clear()
+        with (
+            override_settings(WEBQUILLS_HOST_MAP_PATH=str(self.path)),
+            self.assertLogs("webquills.sites.tasks", "WARNING"),
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                Domain.objects.create(site=self.site, display_domain="new.example.com")
+        self.assertFalse(self.path.exists())
+        self.assertFalse(HostMapChange.objects.exists())
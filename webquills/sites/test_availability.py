@@ -0,0 +1,158 @@
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from webquills.sites import actions
+from webquills.sites.availability import (
+    BloomFilter,
+    subdomain_index,
+    suggest_subdomains,
+)
+from webquills.sites.cache import (
+    get_subdomain_index_generation,
+    publish_subdomain_index_change,
+)
+from webquills.sites.models import Domain, Site
+
+
+class TestBloomFilter(SimpleTestCase):
+    def test_no_false_negatives_and_few_false_positives(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(f"site{i}")
+        self.assertTrue(all(f"site{i}" in bloom for i in range(1000)))
+        false_positives = sum(f"other{i}" in bloom for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="example.com")
+class TestSubdomainIndex(TestCase):
+    def setUp(self):
+        cache.clear()
+        subdomain_index.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Blog", "blog")
+
+    def expire(self):
+        subdomain_index._next_refresh = 0
+
+    def test_free_names_cost_no_queries(self):
+        self.assertTrue(subdomain_index.is_taken("blog"))
+        with self.assertNumQueries(0):
+            self.assertFalse(subdomain_index.is_taken("free"))
+
+    def test_saved_sites_are_added(self):
+        subdomain_index.refresh()
+        actions.create_site(self.user, "New", "new")
+        with self.assertNumQueries(1):
+            self.assertTrue(subdomain_index.is_taken("new"))
+
+    def test_loads_sites_created_by_other_processes(self):
+        subdomain_index.refresh()
+        # bulk_create sends no signals, as if the site was created elsewhere.
+        Site.objects.bulk_create(
+            [
+                Site(
+                    owner=self.user,
+                    group=Group.objects.create(name="site:elsewhere"),
+                    name="Elsewhere",
+                    subdomain="elsewhere",
+                    normalized_subdomain="elsewhere",
+                )
+            ]
+        )
+        self.assertFalse(subdomain_index.might_be_taken("elsewhere"))
+        self.expire()
+        self.assertTrue(subdomain_index.might_be_taken("elsewhere"))
+
+    def test_reloads_after_renames_elsewhere(self):
+        subdomain_index.refresh()
+        Site.objects.filter(pk=self.site.pk).update(normalized_subdomain="renamed")
+        self.expire()
+        self.assertFalse(subdomain_index.might_be_taken("renamed"))
+        with self.captureOnCommitCallbacks(execute=True):
+            publish_subdomain_index_change()
+        self.expire()
+        self.assertTrue(subdomain_index.might_be_taken("renamed"))
+
+    def test_renames_are_published(self):
+        subdomain_index.refresh()
+        generation = get_subdomain_index_generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            actions.update_site(self.site, "Blog", "renamed")
+        self.assertTrue(subdomain_index.might_be_taken("renamed"))
+        self.assertNotEqual(get_subdomain_index_generation(), generation)
+
+    def test_other_saves_are_not_published(self):
+        generation = get_subdomain_index_generation()
+        site = Site.objects.get(pk=self.site.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            site.name = "Renamed"
+            site.save()
+            site.save(update_fields=["name"])
+            Site.objects.select_related(None).only("pk", "name").get(pk=site.pk).save()
+        self.assertEqual(get_subdomain_index_generation(), generation)
+
+    def test_renames_are_published_when_not_loaded(self):
+        generation = get_subdomain_index_generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            actions.update_site(Site.objects.get(pk=self.site.pk), "Blog", "renamed")
+        self.assertNotEqual(get_subdomain_index_generation(), generation)
+
+    def test_suggestions_skip_taken_names(self):
+        actions.create_site(self.user, "Blog 2", "blog-2")
+        actions.create_site(self.user, "Blog Blog", "blog-blog")
+        self.assertEqual(
+            suggest_subdomains("blog"),
+            ["blog-3", "blog-4", "blog-site", "my-blog", "the-blog"],
+        )
+
+    @override_settings(WEBQUILLS_SUBDOMAIN_INDEX_REFRESH=0)
+    def test_disabled(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(subdomain_index.is_taken("free"))
+        self.assertEqual(suggest_subdomains("blog"), [])
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="testserver")
+class TestSubdomainAvailabilityView(TestCase):
+    def setUp(self):
+        cache.clear()
+        subdomain_index.clear()
+        self.user = User.objects.create_user(username="testuser")
+        site = actions.create_site(self.user, "Blog", "blog")
+        Domain.objects.create(
+            site=site, display_domain="testserver", normalized_domain="testserver"
+        )
+        self.client.force_login(self.user)
+        self.url = reverse("subdomain_availability")
+
+    def test_free_subdomain(self):
+        response = self.client.get(self.url, {"subdomain": "Free"})
+        self.assertEqual(
+            response.json(),
+            {
+                "subdomain": "Free",
+                "available": True,
+                "message": None,
+                "suggestions": [],
+            },
+        )
+
+    def test_taken_subdomain(self):
+        data = self.client.get(self.url, {"subdomain": "BLOG"}).json()
+        self.assertFalse(data["available"])
+        self.assertEqual(data["message"], "This domain name is not available.")
+        self.assertIn("blog-2", data["suggestions"])
+
+    def test_invalid_subdomain(self):
+        data = self.client.get(self.url, {"subdomain": "a.b"}).json()
+        self.assertFalse(data["available"])
+        self.assertEqual(data["message"], "Subdomains must not contain dots.")
+
+    def test_requires_login(self):
+        self.client.logout()
+        with self.assertLogs("django.request", "WARNING"):
+            response = self.client.get(self.url, {"subdomain": "free"})
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,92 @@
+from django.contrib.auth.models import AnonymousUser, Group, Permission, User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from webquills.sites import actions
+from webquills.sites.models import Domain
+
+
+@override_settings(
+    WEBQUILLS_ROOT_DOMAIN="example.com", WEBQUILLS_USER_SITES_CACHE_TTL=300
+)
+class TestSitePermissionBackend(TestCase):
+    def setUp(self):
+        cache.clear()
+        actions.create_default_groups_and_perms()
+        self.regular_user = Group.objects.get(name="regular_user")
+        self.user = User.objects.create_user(username="testuser")
+        self.user.groups.add(self.regular_user)
+        self.site = actions.create_site(self.user, "Test Site", "test")
+        other = User.objects.create_user(username="other")
+        self.other = actions.create_site(other, "Other Site", "other")
+        self.delete_site = Permission.objects.get(codename="delete_site")
+
+    def fresh_user(self):
+        # A fresh user object, as each request gets.
+        return User.objects.get(pk=self.user.pk)
+
+    def test_own_permissions_on_own_sites(self):
+        user = self.fresh_user()
+        self.assertTrue(user.has_perm("sites.change_site", self.site))
+        self.assertFalse(user.has_perm("sites.change_site", self.other))
+        self.assertFalse(user.has_perm("sites.delete_site", self.site))
+        self.assertEqual(
+            user.get_all_permissions(self.site),
+            {"sites.add_site", "sites.change_site", "sites.view_site"},
+        )
+
+    def test_site_group_permissions_apply_to_its_site(self):
+        self.site.group.permissions.add(self.delete_site)
+        self.user.groups.add(self.other.group)
+        user = self.fresh_user()
+        self.assertTrue(user.has_perm("sites.delete_site", self.site))
+        self.assertFalse(user.has_perm("sites.delete_site", self.other))
+
+    def test_checks_are_cached(self):
+        self.fresh_user().has_perm("sites.change_site", self.site)
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm("sites.change_site", self.site))
+            self.assertTrue(user.has_perm("sites.view_site", self.site))
+            self.assertFalse(user.has_perm("sites.change_site", self.other))
+
+    def test_permission_changes_invalidate(self):
+        self.assertFalse(self.fresh_user().has_perm("sites.delete_site", self.site))
+        self.regular_user.permissions.add(self.delete_site)
+        self.assertTrue(self.fresh_user().has_perm("sites.delete_site", self.site))
+        self.delete_site.group_set.clear()
+        self.assertFalse(self.fresh_user().has_perm("sites.delete_site", self.site))
+        self.user.user_permissions.add(self.delete_site)
+        self.assertTrue(self.fresh_user().has_perm("sites.delete_site", self.site))
+        self.delete_site.user_set.remove(self.user)
+        self.assertFalse(self.fresh_user().has_perm("sites.delete_site", self.site))
+
+    def test_inactive_and_anonymous_users_have_no_permissions(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertFalse(self.fresh_user().has_perm("sites.view_site", self.site))
+        self.assertFalse(AnonymousUser().has_perm("sites.view_site", self.site))
+
+    def test_update_view_checks_the_site(self):
+        Domain.objects.create(
+            site=self.site, display_domain="testserver", normalized_domain="testserver"
+        )
+        self.user.groups.remove(self.regular_user)
+        self.client.force_login(self.user)
+        url = reverse("site_update", args=[self.site.pk])
+        with self.assertLogs("django.request", "WARNING"):
+            self.assertEqual(self.client.get(url).status_code, 403)
+        self.site.group.permissions.add(Permission.objects.get(codename="change_site"))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_update_view_redirects_anonymous_users_to_log_in(self):
+        Domain.objects.create(
+            site=self.site, display_domain="testserver", normalized_domain="testserver"
+        )
+        url = reverse("site_update", args=[self.site.pk])
+        response = self.client.get(url)
+        self.assertRedirects(
+            response,
+            f"{reverse('account_login')}?next={url}",
+            fetch_redirect_response=False,
+        )
@@ -0,0 +1,283 @@
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import models
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from webquills.sites import actions
+from webquills.sites.cache import (
+    GENERATION_KEY,
+    LRUCache,
+    _host_key,
+    domain_cache,
+    domain_cache_stats,
+    domain_to_record,
+    get_domain_generation,
+    invalidate_domains,
+    memoize_user_sites,
+    set_domain_record,
+    unknown_hosts,
+)
+from webquills.sites.models import BlockReason, Domain, Site
+
+
+class TestLRUCache(SimpleTestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("b", "default"), "default")
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")  # "b" is now least recently used
+        cache.set("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_entries_expire(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        with patch("webquills.sites.cache.time.monotonic", return_value=1000):
+            cache.set("a", 1)
+        with patch("webquills.sites.cache.time.monotonic", return_value=1059):
+            self.assertEqual(cache.get("a"), 1)
+        with patch("webquills.sites.cache.time.monotonic", return_value=1061):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_zero_ttl_disables_cache(self):
+        cache = LRUCache(maxsize=2, ttl=0)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="example.com")
+class TestDomainCache(TestCase):
+    def setUp(self):
+        domain_cache.clear()
+        unknown_hosts.clear()
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+
+    def test_cached_lookup_makes_no_queries(self):
+        domain = Domain.objects.get_for_host("test.example.com")
+        with self.assertNumQueries(0):
+            cached = Domain.objects.get_for_host("test.example.com")
+            self.assertEqual(cached, domain)
+            self.assertEqual(cached.site, self.site)
+            self.assertEqual(cached.site.name, "Test Site")
+
+    def test_cached_lookup_returns_fresh_instances(self):
+        Domain.objects.get_for_host("test.example.com")
+        first = Domain.objects.get_for_host("test.example.com")
+        second = Domain.objects.get_for_host("test.example.com")
+        self.assertIsNot(first, second)
+        self.assertIsNot(first.site, second.site)
+
+    def test_domain_save_invalidates(self):
+        Domain.objects.get_for_host("test.example.com")
+        Domain.objects.create(
+            site=self.site, display_domain="alias.example.com", is_primary=True
+        )
+        domain = Domain.objects.get_for_host("test.example.com")
+        self.assertFalse(domain.is_primary)
+
+    def test_update_site_invalidates(self):
+        Domain.objects.get_for_host("test.example.com")
+        actions.update_site(self.site, "Renamed Site", "renamed")
+        self.assertIsNone(Domain.objects.get_for_host("test.example.com"))
+        domain = Domain.objects.get_for_host("renamed.example.com")
+        self.assertEqual(domain.site.name, "Renamed Site")
+
+    def test_archive_invalidates(self):
+        Domain.objects.get_for_host("test.example.com")
+        self.site.archive_date = "2023-01-01T00:00:00Z"
+        self.site.save()
+        self.assertIsNone(Domain.objects.get_for_host("test.example.com"))
+
+    def test_block_invalidates(self):
+        Domain.objects.get_for_host("test.example.com")
+        self.site.block_reason = BlockReason.objects.create(name="Testing")
+        self.site.save()
+        self.assertIsNone(Domain.objects.get_for_host("test.example.com"))
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="example.com")
+class TestUnknownHostCache(TestCase):
+    def setUp(self):
+        domain_cache.clear()
+        unknown_hosts.clear()
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+
+    def test_repeated_unknown_host_makes_no_queries(self):
+        self.assertIsNone(Domain.objects.get_for_host("junk.example.com"))
+        hits = domain_cache_stats["negative_hits"]
+        with self.assertNumQueries(0):
+            self.assertIsNone(Domain.objects.get_for_host("junk.example.com"))
+        self.assertEqual(domain_cache_stats["negative_hits"], hits + 1)
+
+    def test_creating_domain_invalidates(self):
+        self.assertIsNone(Domain.objects.get_for_host("new.example.com"))
+        Domain.objects.create(site=self.site, display_domain="new.example.com")
+        self.assertEqual(Domain.objects.get_for_host("new.example.com").site, self.site)
+
+    def test_unarchiving_site_invalidates(self):
+        self.site.archive_date = "2023-01-01T00:00:00Z"
+        self.site.save()
+        self.assertIsNone(Domain.objects.get_for_host("test.example.com"))
+        self.site.archive_date = None
+        self.site.save()
+        self.assertEqual(
+            Domain.objects.get_for_host("test.example.com").site, self.site
+        )
+
+
+# The test cache is per process, but so is the test run.
+@override_settings(
+    WEBQUILLS_ROOT_DOMAIN="example.com", WEBQUILLS_DOMAIN_SHARED_CACHE_TTL=300
+)
+class TestSharedDomainCache(TestCase):
+    def setUp(self):
+        domain_cache.clear()
+        unknown_hosts.clear()
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+
+    def test_shared_tier_fills_cold_process(self):
+        domain = Domain.objects.get_for_host("test.example.com")
+        # Simulate another worker process, whose local tier is empty.
+        domain_cache.clear()
+        hits = domain_cache_stats["shared_hits"]
+        with self.assertNumQueries(0):
+            cached = Domain.objects.get_for_host("test.example.com")
+        self.assertEqual(cached, domain)
+        self.assertEqual(domain_cache_stats["shared_hits"], hits + 1)
+
+    def test_shared_records_are_not_model_instances(self):
+        Domain.objects.get_for_host("test.example.com")
+        version, record = cache.get(_host_key("test.example.com"))
+        for values in record:
+            for value in values:
+                self.assertNotIsInstance(value, models.Model)
+
+    def test_generation_change_drops_local_tier(self):
+        Domain.objects.get_for_host("test.example.com")
+        self.assertIn("test.example.com", domain_cache)
+        # Another process publishes a change.
+        cache.set(GENERATION_KEY, "changed elsewhere")
+        Domain.objects.get_for_host("other.example.com")
+        self.assertNotIn("test.example.com", domain_cache)
+
+    def test_records_queried_before_a_change_are_not_cached(self):
+        generation = get_domain_generation()
+        record = domain_to_record(
+            Domain.objects.with_primary_host().get(normalized_domain="test.example.com")
+        )
+        # Another process changes the site while the record is being queried.
+        invalidate_domains(site_id=self.site.pk)
+        set_domain_record("test.example.com", record, generation)
+        self.assertNotIn("test.example.com", domain_cache)
+        self.assertIsNone(cache.get(_host_key("test.example.com")))
+        set_domain_record("test.example.com", record, get_domain_generation())
+        self.assertIn("test.example.com", domain_cache)
+        self.assertIsNotNone(cache.get(_host_key("test.example.com")))
+
+    def test_update_site_invalidates_shared_tier(self):
+        Domain.objects.get_for_host("test.example.com")
+        actions.update_site(self.site, "Renamed Site", "renamed")
+        domain_cache.clear()
+        self.assertIsNone(Domain.objects.get_for_host("test.example.com"))
+
+    def test_archive_invalidates_shared_tier(self):
+        Domain.objects.get_for_host("test.example.com")
+        self.site.archive_date = "2023-01-01T00:00:00Z"
+        self.site.save()
+        domain_cache.clear()
+        self.assertIsNone(Domain.objects.get_for_host("test.example.com"))
+
+
+@override_settings(
+    WEBQUILLS_ROOT_DOMAIN="example.com", WEBQUILLS_USER_SITES_CACHE_TTL=300
+)
+class TestUserSitesCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+        self.other = actions.create_site(
+            User.objects.create_user(username="other"), "Other Site", "other"
+        )
+
+    def ids(self):
+        # A fresh user object, as each request gets.
+        user = User.objects.get(pk=self.user.pk)
+        return Site.objects.accessible_ids(user)
+
+    def test_cached_across_requests(self):
+        self.assertEqual(self.ids(), {self.site.pk})
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(Site.objects.accessible_ids(user), {self.site.pk})
+
+    def test_memoized_within_request(self):
+        with memoize_user_sites():
+            Site.objects.accessible_ids(self.user)
+            cache.clear()
+            with self.assertNumQueries(0):
+                self.assertEqual(Site.objects.accessible_ids(self.user), {self.site.pk})
+        with self.assertNumQueries(2):
+            self.assertEqual(Site.objects.accessible_ids(self.user), {self.site.pk})
+
+    def test_changes_within_request_are_seen(self):
+        with memoize_user_sites():
+            Site.objects.accessible_ids(self.user)
+            site = actions.create_site(self.user, "New Site", "new")
+            self.assertEqual(
+                Site.objects.accessible_ids(self.user), {self.site.pk, site.pk}
+            )
+            self.site.group.user_set.remove(self.user)
+            self.assertEqual(Site.objects.accessible_ids(self.user), {site.pk})
+            self.assertEqual(list(Site.objects.for_user(self.user)), [site])
+
+    def test_user_object_is_not_memoized(self):
+        Site.objects.accessible_ids(self.user)
+        self.site.group.user_set.remove(self.user)
+        self.assertEqual(Site.objects.accessible_ids(self.user), set())
+        self.assertEqual(Site.objects.ids_for_user(self.user), [])
+
+    def test_joining_group_invalidates(self):
+        self.ids()
+        self.user.groups.add(self.other.group)
+        self.assertEqual(self.ids(), {self.site.pk, self.other.pk})
+        self.user.groups.remove(self.other.group)
+        self.assertEqual(self.ids(), {self.site.pk})
+
+    def test_group_membership_changes_invalidate(self):
+        self.ids()
+        self.other.group.user_set.add(self.user)
+        self.assertEqual(self.ids(), {self.site.pk, self.other.pk})
+        self.other.group.user_set.clear()
+        self.assertEqual(self.ids(), {self.site.pk})
+
+    def test_new_sites_invalidate(self):
+        self.ids()
+        site = actions.create_site(self.user, "New Site", "new")
+        (bulk,), _ = actions.bulk_create_sites([(self.user, "Bulk Site", "bulk")])
+        self.assertEqual(self.ids(), {self.site.pk, site.pk, bulk.pk})
+
+    @override_settings(WEBQUILLS_USER_SITES_CACHE_TTL=0)
+    def test_disabled(self):
+        self.ids()
+        # The user, their permissions, and their sites.
+        with self.assertNumQueries(3):
+            self.assertEqual(self.ids(), {self.site.pk})
@@ -1,10 +1,18 @@
 from unittest.mock import MagicMock, patch
 from urllib.parse import urlparse
 
+from commoncontent.models import HomePage, Status
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.http import HttpResponse, HttpResponseNotFound
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
 
+from webquills.sites import actions
+from webquills.sites.cache import domain_cache, unknown_hosts
 from webquills.sites.middleware import SitesMiddleware
+from webquills.sites.models import Domain, Site
 
 
 class TestSitesMiddleware(TestCase):
@@ -29,6 +37,32 @@ class TestSitesMiddleware(TestCase):
         self.assertIsInstance(response, HttpResponseNotFound)
         mock_get_for_request.assert_called_once_with(request)
 
+    @patch("webquills.sites.models.Domain.objects.get_for_request")
+    def test_unknown_host_logging_is_aggregated(self, mock_get_for_request):
+        mock_get_for_request.return_value = None
+
+        with self.assertLogs("webquills.sites.middleware", "WARNING"):
+            self.middleware(self.factory.get("/", HTTP_HOST="junk1.com"))
+        # Further requests within the interval are counted, not logged.
+        with self.assertNoLogs("webquills.sites.middleware", "WARNING"):
+            for _ in range(3):
+                self.middleware(self.factory.get("/", HTTP_HOST="junk2.com"))
+        # The next report summarizes everything since the last one.
+        self.middleware.unknown_hosts._next_report = 0
+        with self.assertLogs("webquills.sites.middleware", "WARNING") as log:
+            self.middleware(self.factory.get("/", HTTP_HOST="junk3.com"))
+        self.assertIn("'junk2.com' x3", log.output[0])
+        self.assertIn("4 requests since last report", log.output[0])
+
+    def test_invalid_idna_hosts_are_not_found(self):
+        for host in ["ab--cd.example.com", "xn--zzzz.example.com", "a" * 64 + ".com"]:
+            with self.subTest(host=host):
+                self.middleware.unknown_hosts._next_report = 0
+                with self.assertLogs("webquills.sites.middleware", "WARNING"):
+                    response = self.middleware(self.factory.get("/", HTTP_HOST=host))
+                self.assertIsInstance(response, HttpResponseNotFound)
+                self.assertIn(host, unknown_hosts)
+
     @patch("webquills.sites.models.Domain.objects.get_for_request")
     def test_primary_domain(self, mock_get_for_request):
         # Simulate a primary domain
@@ -51,12 +85,281 @@ class TestSitesMiddleware(TestCase):
         mock_domain = MagicMock()
         mock_domain.is_primary = False
         mock_domain.site = MagicMock()
-        mock_domain.site.primary_domain.normalized_domain = "primary.com"
+        mock_domain.primary_host = "primary.com"
         mock_get_for_request.return_value = mock_domain
 
-        request = self.factory.get("/", HTTP_HOST="nonprimary.com")
+        request = self.factory.get("/path/?q=1", HTTP_HOST="nonprimary.com")
         response = self.middleware(request)
 
         self.assertEqual(response.status_code, 302)
         self.assertEqual(urlparse(response.url).netloc, "primary.com")
+        self.assertEqual(response.url, "http://primary.com/path/?q=1")
         mock_get_for_request.assert_called_once_with(request)
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="example.com")
+class TestSitesMiddlewareRedirect(TestCase):
+    def setUp(self):
+        domain_cache.clear()
+        cache.clear()
+        self.factory = RequestFactory()
+        self.get_response = MagicMock(return_value=HttpResponse("OK"))
+        self.middleware = SitesMiddleware(self.get_response)
+        user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(user, "Test Site", "test")
+        Domain.objects.create(site=self.site, display_domain="alias.example.com")
+
+    def test_alias_redirect_is_single_query(self):
+        request = self.factory.get("/", HTTP_HOST="alias.example.com")
+        with self.assertNumQueries(1):
+            response = self.middleware(request)
+        self.assertEqual(response.url, "http://test.example.com/")
+
+    def test_cached_alias_redirect_makes_no_queries(self):
+        self.middleware(self.factory.get("/", HTTP_HOST="alias.example.com"))
+        request = self.factory.get("/a.html", HTTP_HOST="alias.example.com")
+        with self.assertNumQueries(0):
+            response = self.middleware(request)
+        self.assertEqual(response.url, "http://test.example.com/a.html")
+
+    def test_primary_change_updates_redirect(self):
+        self.middleware(self.factory.get("/", HTTP_HOST="alias.example.com"))
+        Domain.objects.create(
+            site=self.site, display_domain="new.example.com", is_primary=True
+        )
+        request = self.factory.get("/", HTTP_HOST="alias.example.com")
+        response = self.middleware(request)
+        self.assertEqual(response.url, "http://new.example.com/")
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="example.com", WEBQUILLS_LAZY_SITE=True)
+class TestLazySitesMiddleware(TestCase):
+    def setUp(self):
+        domain_cache.clear()
+        cache.clear()
+        self.factory = RequestFactory()
+        self.get_response = MagicMock(return_value=HttpResponse("OK"))
+        self.middleware = SitesMiddleware(self.get_response)
+        user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(user, "Test Site", "test")
+        Domain.objects.create(site=self.site, display_domain="alias.example.com")
+
+    @patch("webquills.sites.middleware.domain_from_record")
+    def test_site_not_built_unless_used(self, mock_from_record):
+        request = self.factory.get("/", HTTP_HOST="test.example.com")
+        response = self.middleware(request)
+        self.assertEqual(response.status_code, 200)
+        mock_from_record.assert_not_called()
+
+    def test_site_built_on_access(self):
+        request = self.factory.get("/", HTTP_HOST="test.example.com")
+        self.middleware(request)
+        self.assertEqual(request.site, self.site)
+        self.assertEqual(request.site.name, "Test Site")
+        self.assertEqual(request.domain.normalized_domain, "test.example.com")
+
+    def test_alias_redirect(self):
+        request = self.factory.get("/a.html", HTTP_HOST="alias.example.com")
+        response = self.middleware(request)
+        self.assertEqual(response.url, "http://test.example.com/a.html")
+        self.get_response.assert_not_called()
+
+    def test_unknown_host(self):
+        request = self.factory.get("/", HTTP_HOST="junk.example.com")
+        with self.assertLogs("webquills.sites.middleware", "WARNING"):
+            response = self.middleware(request)
+        self.assertIsInstance(response, HttpResponseNotFound)
+
+
+@override_settings(
+    WEBQUILLS_ROOT_DOMAIN="example.com",
+    STORAGES={
+        **settings.STORAGES,
+        "staticfiles": {
+            "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+        },
+    },
+)
+class TestConditionalGetMiddleware(TestCase):
+    def setUp(self):
+        domain_cache.clear()
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+        self.home = HomePage.objects.create(
+            site=self.site,
+            owner=self.user,
+            title="Home",
+            slug="home",
+            admin_name="home",
+            status=Status.USABLE,
+            date_published=timezone.now(),
+        )
+        self.client.defaults["HTTP_HOST"] = "test.example.com"
+
+    def test_html_has_weak_etag(self):
+        response = self.client.get("/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["ETag"].startswith('W/"'))
+        self.assertIn("Last-Modified", response)
+
+    def test_feed_has_strong_etag(self):
+        response = self.client.get("/index.rss")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["ETag"].startswith('"'))
+
+    def test_revalidation_skips_rendering(self):
+        etag = self.client.get("/")["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get("/", headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get("/")["Last-Modified"]
+        response = self.client.get("/", headers={"if-modified-since": last_modified})
+        self.assertEqual(response.status_code, 304)
+
+    def test_content_change_changes_etag(self):
+        etag = self.client.get("/")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.home.title = "Changed"
+            self.home.save()
+        response = self.client.get("/", headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_content_change_is_seen_by_other_processes(self):
+        modified = Site.objects.get(pk=self.site.pk).modified_date
+        self.home.title = "Changed"
+        self.home.save()
+        # Recorded in the database, rather than this process's cache.
+        self.assertGreater(Site.objects.get(pk=self.site.pk).modified_date, modified)
+
+    def test_logged_in_users_are_not_validated(self):
+        self.client.force_login(self.user)
+        response = self.client.get("/")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+
+    def test_cms_pages_are_not_validated(self):
+        response = self.client.get("/accounts/login/")
+        self.assertNotIn("ETag", response)
+
+
+@override_settings(
+    WEBQUILLS_ROOT_DOMAIN="example.com",
+    WEBQUILLS_PAGE_CACHE_TTL=300,
+    STORAGES={
+        **settings.STORAGES,
+        "staticfiles": {
+            "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+        },
+    },
+)
+class TestPageCacheMiddleware(TestCase):
+    def setUp(self):
+        domain_cache.clear()
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+        self.home = HomePage.objects.create(
+            site=self.site,
+            owner=self.user,
+            title="Original Title",
+            slug="home",
+            admin_name="home",
+            status=Status.USABLE,
+            date_published=timezone.now(),
+        )
+        self.client.defaults["HTTP_HOST"] = "test.example.com"
+
+    def change_title_silently(self):
+        # update() sends no signals, so only a cache miss would show the new title.
+        HomePage.objects.filter(pk=self.home.pk).update(title="Silent Title")
+
+    def test_cached_page_needs_no_queries(self):
+        first = self.client.get("/")
+        with self.assertNumQueries(0):
+            second = self.client.get("/")
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["ETag"], first["ETag"])
+
+    def test_content_change_invalidates_site_pages(self):
+        self.client.get("/")
+        self.home.title = "Changed Title"
+        self.home.save()
+        self.assertContains(self.client.get("/"), "Changed Title")
+
+    def test_site_change_invalidates_site_pages(self):
+        self.client.get("/")
+        self.change_title_silently()
+        self.site.name = "Renamed"
+        self.site.save()
+        self.assertContains(self.client.get("/"), "Silent Title")
+
+    def test_logged_in_users_bypass_cache(self):
+        self.client.get("/")
+        self.change_title_silently()
+        self.assertContains(self.client.get("/"), "Original Title")
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get("/"), "Silent Title")
+
+    @override_settings(WEBQUILLS_PAGE_CACHE_COOKIES=["theme"])
+    def test_pages_vary_by_cookie(self):
+        self.client.get("/")
+        self.change_title_silently()
+        self.assertContains(self.client.get("/"), "Original Title")
+        self.client.cookies["theme"] = "dark"
+        self.assertContains(self.client.get("/"), "Silent Title")
+
+    @override_settings(WEBQUILLS_PAGE_CACHE_TTL=0)
+    def test_disabled(self):
+        self.client.get("/")
+        self.change_title_silently()
+        self.assertContains(self.client.get("/"), "Silent Title")
+
+
+@override_settings(
+    WEBQUILLS_ROOT_DOMAIN="example.com",
+    STORAGES={
+        **settings.STORAGES,
+        "staticfiles": {
+            "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+        },
+    },
+)
+class TestRateLimitMiddleware(TestCase):
+    def setUp(self):
+        domain_cache.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+        self.client.defaults["HTTP_HOST"] = "test.example.com"
+
+    @override_settings(WEBQUILLS_RATE_LIMIT_IP_RATE=1, WEBQUILLS_RATE_LIMIT_IP_BURST=2)
+    def test_ip_limit(self):
+        self.assertEqual(self.client.get("/accounts/login/").status_code, 200)
+        self.assertEqual(self.client.get("/accounts/login/").status_code, 200)
+        response = self.client.get("/accounts/login/")
+        self.assertContains(response, "Too Many Requests", status_code=429)
+        self.assertEqual(response["Retry-After"], "1")
+        # Other clients are unaffected.
+        response = self.client.get("/accounts/login/", REMOTE_ADDR="192.0.2.1")
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(
+        WEBQUILLS_RATE_LIMIT_SITE_RATE=1, WEBQUILLS_RATE_LIMIT_SITE_BURST=1
+    )
+    def test_site_limit(self):
+        actions.create_site(self.user, "Other Site", "other")
+        self.assertEqual(self.client.get("/accounts/login/").status_code, 200)
+        response = self.client.get("/accounts/login/", REMOTE_ADDR="192.0.2.1")
+        self.assertEqual(response.status_code, 429)
+        # Other sites are unaffected.
+        response = self.client.get("/accounts/login/", HTTP_HOST="other.example.com")
+        self.assertEqual(response.status_code, 200)
+
+    def test_disabled_by_default(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get("/accounts/login/").status_code, 200)
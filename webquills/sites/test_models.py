@@ -90,6 +90,43 @@ class TestSiteQuerySet(TestCase):
         sites = Site.objects.all().for_user(self.user)
         self.assertCountEqual(sites, [self.site1, self.site2])
 
+    def test_with_domain_names(self):
+        Domain.objects.create(
+            site=self.site1, display_domain="Alias.Example.com", is_primary=True
+        )
+        with self.assertNumQueries(1):
+            sites = {s.pk: s for s in Site.objects.with_domain_names()}
+            self.assertEqual(
+                sites[self.site1.pk].primary_domain_name, "Alias.Example.com"
+            )
+            self.assertEqual(
+                sites[self.site1.pk].canonical_domain_name, "site1.example.com"
+            )
+            self.assertEqual(sites[self.site2.pk].domain, "site2.example.com")
+            self.assertEqual(str(sites[self.site3.pk]), "Site 3 (site3.example.com)")
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="example.com")
+class TestSiteModel(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser")
+        for i in range(3):
+            actions.create_site(self.user, f"Site {i}", f"site{i}")
+
+    def test_listing_sites_uses_prefetched_domains(self):
+        # One query for the sites, one to prefetch all their domains.
+        with self.assertNumQueries(2):
+            names = [str(site) for site in Site.objects.all()]
+        self.assertIn("Site 1 (site1.example.com)", names)
+        with self.assertNumQueries(2):
+            for site in Site.objects.all():
+                self.assertTrue(site.primary_domain.is_primary)
+                self.assertTrue(site.canonical_domain.is_canonical)
+
+    def test_primary_domain_without_prefetch(self):
+        site = Site.objects.prefetch_related(None).get(subdomain="site1")
+        self.assertEqual(site.primary_domain.display_domain, "site1.example.com")
+
 
 @override_settings(WEBQUILLS_ROOT_DOMAIN="example.com")
 class TestDomainManager(TestCase):
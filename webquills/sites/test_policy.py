@@ -0,0 +1,89 @@
+import tempfile
+from pathlib import Path
+
+from django.core.exceptions import ValidationError
+from django.test import SimpleTestCase, override_settings
+
+from webquills.sites.policy import (
+    AhoCorasick,
+    SubdomainPolicy,
+    skeleton,
+    subdomain_policy,
+)
+from webquills.sites.validators import validate_subdomain, validate_subdomains
+
+
+class TestSkeleton(SimpleTestCase):
+    def test_lookalikes_have_the_same_skeleton(self):
+        for name in ["paypal", "PayPal", "pay-pal", "pаypаl", "ｐａｙｐａｌ", "paypa1"]:
+            with self.subTest(name=name):
+                self.assertEqual(skeleton(name), "paypal")
+
+    def test_accents_and_sequences(self):
+        self.assertEqual(skeleton("café"), "cafe")
+        self.assertEqual(skeleton("rnodern"), "modem")
+        self.assertEqual(skeleton("xn--caf-dma"), "cafe")
+
+
+class TestAhoCorasick(SimpleTestCase):
+    def test_finds_any_word(self):
+        automaton = AhoCorasick(["he", "she", "his", "hers", ""])
+        self.assertEqual(automaton.search("ushers"), "she")
+        self.assertEqual(automaton.search("this"), "his")
+        self.assertEqual(automaton.search("ahishers"), "his")
+        self.assertIsNone(automaton.search("xyz"))
+        self.assertIsNone(automaton.search(""))
+
+    def test_finds_words_through_failure_links(self):
+        automaton = AhoCorasick(["abcd", "bce"])
+        self.assertEqual(automaton.search("abce"), "bce")
+        self.assertIsNone(AhoCorasick([]).search("abc"))
+
+
+class TestSubdomainPolicy(SimpleTestCase):
+    def test_reserved_names_match_exactly(self):
+        policy = SubdomainPolicy(reserved=["admin"])
+        self.assertEqual(policy.violation("admin"), "reserved")
+        self.assertEqual(policy.violation("аdmin"), "reserved")
+        self.assertIsNone(policy.violation("admins"))
+
+    def test_blocked_words_match_anywhere(self):
+        policy = SubdomainPolicy(blocked_words=["paypal"])
+        self.assertEqual(policy.violation("my-paypa1-login"), "blocked")
+        self.assertIsNone(policy.violation("payments"))
+
+    def test_compiled_once_per_settings(self):
+        with override_settings(WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS=["spam"]):
+            policy = subdomain_policy()
+            self.assertIs(subdomain_policy(), policy)
+            self.assertEqual(policy.violation("spammy"), "blocked")
+        self.assertIsNot(subdomain_policy(), policy)
+        self.assertIsNone(subdomain_policy().violation("spammy"))
+
+    def test_rules_from_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reserved = Path(tmpdir) / "reserved.txt"
+            reserved.write_text("# Trademarks\nacme\n\n")
+            words = Path(tmpdir) / "words.txt"
+            words.write_text("scam\n")
+            with override_settings(
+                WEBQUILLS_RESERVED_SUBDOMAINS_FILES=[reserved],
+                WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS_FILES=[words],
+            ):
+                self.assertEqual(subdomain_policy().violation("acme"), "reserved")
+                self.assertIsNone(subdomain_policy().violation("acme-blog"))
+                self.assertIsNone(subdomain_policy().violation("not-a-sc4m"))
+                self.assertEqual(subdomain_policy().violation("no-scam"), "blocked")
+
+
+@override_settings(WEBQUILLS_BLOCKED_SUBDOMAIN_WORDS=["casino"])
+class TestValidateSubdomains(SimpleTestCase):
+    def test_blocked_subdomain(self):
+        with self.assertRaises(ValidationError) as context:
+            validate_subdomain("free-cаsino")
+        self.assertEqual(context.exception.code, "domain_not_available")
+
+    def test_batch(self):
+        errors = validate_subdomains(["blog", "online-casino", "a.b", "blog"])
+        self.assertEqual(set(errors), {"online-casino", "a.b"})
+        self.assertEqual(errors["a.b"].code, "subdomain_contains_dots")
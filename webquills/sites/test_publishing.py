@@ -0,0 +1,390 @@
+import os
+import subprocess
+import sys
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest.mock import patch
+
+from commoncontent.models import Article, HomePage, Section, Status
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from webquills.sites import actions
+from webquills.sites.models import Domain, PublishChange
+from webquills.sites.publishing import (
+    MANIFEST_NAME,
+    _handler,
+    change_key,
+    load_manifest,
+    output_path,
+    publish_site,
+    publish_sites,
+)
+from webquills.sites.tasks import _warn_not_queued, publish_site_task
+
+STORAGES = {
+    **settings.STORAGES,
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+}
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="example.com", STORAGES=STORAGES)
+class TestPublishSite(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(WEBQUILLS_PUBLISH_ROOT=self.tmpdir.name))
+        self.out_dir = Path(self.tmpdir.name) / "test.example.com"
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+        kwargs = {
+            "site": self.site,
+            "owner": self.user,
+            "status": Status.USABLE,
+            "date_published": timezone.now(),
+        }
+        HomePage.objects.create(title="Home", slug="home", admin_name="home", **kwargs)
+        self.section = Section.objects.create(title="News", slug="news", **kwargs)
+        self.article = Article.objects.create(
+            title="Hello", slug="hello", section=self.section, **kwargs
+        )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_output_path(self):
+        self.assertEqual(output_path("/"), "index.html")
+        self.assertEqual(output_path("/news/"), "news/index.html")
+        self.assertEqual(output_path("/news/hello.html"), "news/hello.html")
+        self.assertEqual(output_path("/index.rss"), "index.rss")
+
+    def test_publishes_pages(self):
+        result = publish_site(self.site)
+        self.assertEqual(result["errors"], [])
+        for path in ("/", "/news/", "/news/hello.html", "/index.rss"):
+            self.assertIn(path, result["written"])
+        html = (self.out_dir / "news" / "hello.html").read_text()
+        self.assertIn("Hello", html)
+        self.assertTrue((self.out_dir / "news" / "index.rss").exists())
+        self.assertTrue((self.out_dir / "news" / "hello.html.gz").exists())
+
+    def test_follows_pagination(self):
+        self.site.vars.create(name="paginate_by", value="1")
+        Article.objects.create(
+            title="Second",
+            slug="second",
+            section=self.section,
+            site=self.site,
+            owner=self.user,
+            status=Status.USABLE,
+            date_published=timezone.now(),
+        )
+        result = publish_site(self.site)
+        self.assertIn("/news/page_2.html", result["written"])
+
+    def test_unchanged_pages_are_not_rewritten(self):
+        publish_site(self.site)
+        result = publish_site(self.site)
+        self.assertEqual(result["written"], [])
+        self.assertIn("/news/hello.html", result["unchanged"])
+
+    def test_publisher_bypasses_page_cache(self):
+        publish_site(self.site)
+        Article.objects.filter(pk=self.article.pk).update(title="Silent")
+        publish_site(self.site, full=True)
+        self.assertIn("Silent", (self.out_dir / "news" / "hello.html").read_text())
+
+    @override_settings(
+        WEBQUILLS_RATE_LIMIT_SITE_RATE=1, WEBQUILLS_RATE_LIMIT_SITE_BURST=2
+    )
+    def test_publisher_is_not_rate_limited(self):
+        # The handler keeps the middleware it was built with.
+        _handler.cache_clear()
+        self.addCleanup(_handler.cache_clear)
+        result = publish_site(self.site)
+        self.assertEqual(result["errors"], [])
+        self.assertGreater(len(result["written"]), 2)
+        # Readers still have the site's whole bucket.
+        for _ in range(2):
+            response = self.client.get("/", HTTP_HOST="test.example.com")
+            self.assertEqual(response.status_code, 200)
+
+    def test_removed_pages_are_deleted(self):
+        publish_site(self.site)
+        self.article.delete()
+        result = publish_site(self.site)
+        self.assertEqual(result["removed"], ["/news/hello.html"])
+        self.assertFalse((self.out_dir / "news" / "hello.html").exists())
+        self.assertFalse((self.out_dir / "news" / "hello.html.gz").exists())
+
+    def test_archived_site_is_unpublished(self):
+        publish_site(self.site)
+        self.site.archive_date = timezone.now()
+        self.site.save()
+        publish_site(self.site)
+        self.assertFalse(self.out_dir.exists())
+
+    @override_settings(WEBQUILLS_PUBLISH_ON_CHANGE=True, CELERY_TASK_ALWAYS_EAGER=False)
+    def test_republished_on_change(self):
+        with patch.object(publish_site_task, "apply_async") as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.article.title = "Changed"
+                self.article.save()
+            apply_async.assert_called_once_with((self.site.pk,), countdown=5)
+            publish_site_task(self.site.pk)
+        self.assertIn("Changed", (self.out_dir / "news" / "hello.html").read_text())
+
+    @override_settings(WEBQUILLS_PUBLISH_ON_CHANGE=True)
+    def test_changes_wait_for_command_when_tasks_run_eagerly(self):
+        publish_site(self.site)
+        _warn_not_queued.cache_clear()
+        with self.assertLogs("webquills.sites.tasks", "WARNING"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.article.title = "Changed"
+                self.article.save()
+        page = self.out_dir / "news" / "hello.html"
+        self.assertNotIn("Changed", page.read_text())
+        self.assertTrue(PublishChange.objects.filter(site=self.site).exists())
+        call_command("publish_sites", self.site.subdomain, stdout=StringIO())
+        self.assertIn("Changed", page.read_text())
+
+    def test_deleted_domain_is_unpublished(self):
+        Domain.objects.create(
+            site=self.site, display_domain="alias.example.com", is_primary=True
+        )
+        publish_site(self.site)
+        alias_dir = Path(self.tmpdir.name) / "alias.example.com"
+        self.assertTrue(alias_dir.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            Domain.objects.get(normalized_domain="alias.example.com").delete()
+        self.assertFalse(alias_dir.exists())
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="example.com", STORAGES=STORAGES)
+class TestIncrementalPublish(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(WEBQUILLS_PUBLISH_ROOT=self.tmpdir.name))
+        self.out_dir = Path(self.tmpdir.name) / "test.example.com"
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+        self.kwargs = {
+            "site": self.site,
+            "owner": self.user,
+            "status": Status.USABLE,
+            "date_published": timezone.now(),
+        }
+        HomePage.objects.create(
+            title="Home", slug="home", admin_name="home", **self.kwargs
+        )
+        self.news = Section.objects.create(title="News", slug="news", **self.kwargs)
+        self.blog = Section.objects.create(title="Blog", slug="blog", **self.kwargs)
+        self.article = Article.objects.create(
+            title="Hello", slug="hello", section=self.news, **self.kwargs
+        )
+        self.other = Article.objects.create(
+            title="Other", slug="other", section=self.blog, **self.kwargs
+        )
+        publish_site(self.site, full=True)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def publish_changes(self, *instances):
+        for instance in instances:
+            PublishChange.objects.create(site=self.site, key=change_key(instance))
+        result = publish_site(self.site, full=False)
+        self.assertFalse(PublishChange.objects.filter(site=self.site).exists())
+        return result
+
+    def test_manifest_records_dependencies(self):
+        pages = load_manifest(self.out_dir)["pages"]
+        self.assertIn(change_key(self.article), pages["/news/"]["deps"])
+        self.assertIn(change_key(self.article), pages["/news/hello.html"]["deps"])
+        self.assertNotIn(change_key(self.article), pages["/blog/other.html"]["deps"])
+        # Detail pages don't depend on the rest of their table.
+        self.assertNotIn("commoncontent.article", pages["/blog/other.html"]["deps"])
+        self.assertIn("commoncontent.article", pages["/"]["deps"])
+
+    def test_no_changes_renders_nothing(self):
+        result = self.publish_changes()
+        self.assertEqual(
+            result, {"written": [], "unchanged": [], "removed": [], "errors": []}
+        )
+
+    def test_changed_article_rebuilds_only_dependents(self):
+        self.article.title = "Changed"
+        self.article.save()
+        result = self.publish_changes(self.article)
+        rendered = result["written"] + result["unchanged"]
+        self.assertIn("/news/hello.html", result["written"])
+        self.assertIn("/news/", result["written"])
+        self.assertIn("/index.rss", rendered)
+        self.assertNotIn("/blog/other.html", rendered)
+        self.assertIn("Changed", (self.out_dir / "news" / "hello.html").read_text())
+
+    def test_unchanged_output_is_not_rewritten(self):
+        result = self.publish_changes(self.article)
+        self.assertEqual(result["written"], [])
+        self.assertIn("/news/hello.html", result["unchanged"])
+
+    def test_new_article_is_published(self):
+        article = Article.objects.create(
+            title="New", slug="new", section=self.news, **self.kwargs
+        )
+        result = self.publish_changes(article)
+        self.assertIn("/news/new.html", result["written"])
+        self.assertIn("/news/", result["written"])
+        self.assertNotIn("/blog/other.html", result["written"] + result["unchanged"])
+        self.assertIn("/news/new.html", load_manifest(self.out_dir)["pages"])
+
+    def test_deleted_article_is_removed(self):
+        key = change_key(self.article)
+        self.article.delete()
+        PublishChange.objects.create(site=self.site, key=key)
+        result = publish_site(self.site, full=False)
+        self.assertIn("/news/hello.html", result["removed"])
+        self.assertFalse((self.out_dir / "news" / "hello.html").exists())
+        self.assertNotIn("/news/hello.html", load_manifest(self.out_dir)["pages"])
+
+    def test_template_change_forces_full_build(self):
+        with patch(
+            "webquills.sites.publishing.templates_fingerprint", return_value="new"
+        ):
+            result = self.publish_changes()
+        self.assertIn("/blog/other.html", result["unchanged"])
+
+    def test_missing_manifest_forces_full_build(self):
+        (self.out_dir / MANIFEST_NAME).unlink()
+        result = self.publish_changes()
+        self.assertIn("/blog/other.html", result["unchanged"])
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="example.com", STORAGES=STORAGES)
+class TestPublishSites(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(WEBQUILLS_PUBLISH_ROOT=self.tmpdir.name))
+        self.user = User.objects.create_user(username="testuser")
+        self.sites = [
+            actions.create_site(self.user, f"Site {i}", f"site{i}") for i in range(3)
+        ]
+        for site in self.sites:
+            HomePage.objects.create(
+                site=site,
+                owner=self.user,
+                title="Home",
+                slug="home",
+                admin_name=f"home {site.pk}",
+                status=Status.USABLE,
+                date_published=timezone.now(),
+            )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_publishes_each_site(self):
+        site_ids = [site.pk for site in self.sites] + [0]
+        results = {site_id: result for site_id, result, _ in publish_sites(site_ids)}
+        self.assertEqual(set(results), set(site_ids))
+        self.assertIsNone(results[0])
+        for site in self.sites:
+            self.assertIn("/", results[site.pk]["written"])
+            self.assertTrue(
+                (Path(self.tmpdir.name) / f"{site.subdomain}.example.com").exists()
+            )
+
+    def test_failing_site_does_not_stop_others(self):
+        with patch(
+            "webquills.sites.publishing.publish_site",
+            side_effect=[RuntimeError("boom"), {"errors": []}, {"errors": []}],
+        ):
+            with self.assertLogs("webquills.sites.publishing", "ERROR"):
+                results = list(publish_sites(site.pk for site in self.sites))
+        self.assertEqual(
+            [r for _, r, _ in results], [None, {"errors": []}, {"errors": []}]
+        )
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command("publish_sites", "site0", "site1", stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn(f"Site {self.sites[0].pk}: ", output)
+        self.assertIn("Published 2 sites", output)
+
+
+# Run in a separate process, to set up the database for TestPublishSitesInWorkers.
+WORKERS_SETUP = """
+from commoncontent.models import HomePage, Status
+from django.contrib.auth.models import User
+from django.utils import timezone
+from webquills.sites import actions
+
+user = User.objects.create_user(username="testuser")
+for i in range(3):
+    site = actions.create_site(user, f"Site {i}", f"site{i}")
+    HomePage.objects.create(
+        site=site,
+        owner=user,
+        title="Home",
+        slug="home",
+        admin_name=f"home {i}",
+        status=Status.USABLE,
+        date_published=timezone.now(),
+    )
+"""
+
+
+class TestPublishSitesInWorkers(SimpleTestCase):
+    """
+    Publishes with a pool of worker processes. Workers are spawned, so they can't see
+    the test database (in memory, or in an uncommitted transaction): they get their
+    own, and their settings, from the environment.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        root = Path(self.tmpdir.name)
+        self.publish_root = root / "sites"
+        env = {
+            "DJANGO_SETTINGS_MODULE": "webquills.settings",
+            "IGNORE_ENV_FILE": "true",
+            "SECRET_KEY": settings.SECRET_KEY,
+            "DATABASE_URL": f"sqlite:///{root / 'db.sqlite3'}",
+            "CACHE_URL": "locmemcache://",
+            "STATICFILES_STORAGE": STORAGES["staticfiles"]["BACKEND"],
+            "WEBQUILLS_ROOT_DOMAIN": "example.com",
+            "WEBQUILLS_PUBLISH_ROOT": str(self.publish_root),
+        }
+        self.enterContext(patch.dict(os.environ, env))
+        for command in (["migrate", "-v0"], ["shell", "-c", WORKERS_SETUP]):
+            subprocess.run(
+                [sys.executable, "manage.py", *command],
+                cwd=settings.BASE_DIR,
+                check=True,
+                capture_output=True,
+            )
+
+    def test_publishes_each_site(self):
+        # The IDs of the sites in the workers' database, and a missing one.
+        site_ids = [1, 2, 3, 4]
+        results = {
+            site_id: result
+            for site_id, result, _ in publish_sites(
+                site_ids, workers=2, max_sites_per_worker=2
+            )
+        }
+        self.assertEqual(set(results), set(site_ids))
+        self.assertIsNone(results[4])
+        for i, site_id in enumerate(site_ids[:3]):
+            self.assertEqual(results[site_id]["errors"], [])
+            self.assertIn("/", results[site_id]["written"])
+            self.assertTrue(
+                (self.publish_root / f"site{i}.example.com" / "index.html").exists()
+            )
@@ -0,0 +1,69 @@
+from unittest.mock import MagicMock
+
+from django.core.cache.backends.redis import RedisCache
+from django.test import SimpleTestCase
+
+from webquills.sites.ratelimit import (
+    Bucket,
+    LocalTokenBuckets,
+    RedisTokenBuckets,
+    ip_bucket_key,
+    retry_after,
+)
+
+
+class TestLocalTokenBuckets(SimpleTestCase):
+    def test_burst_then_refuse(self):
+        buckets = LocalTokenBuckets()
+        bucket = Bucket("a", rate=1, burst=3)
+        self.assertEqual(
+            [buckets.take([bucket], now=100) for _ in range(3)], [None] * 3
+        )
+        self.assertEqual(buckets.take([bucket], now=100), 1.0)
+
+    def test_refills_at_rate(self):
+        buckets = LocalTokenBuckets()
+        bucket = Bucket("a", rate=2, burst=1)
+        self.assertIsNone(buckets.take([bucket], now=100))
+        self.assertEqual(buckets.take([bucket], now=100.25), 0.25)
+        self.assertIsNone(buckets.take([bucket], now=100.5))
+
+    def test_refused_request_takes_no_tokens(self):
+        buckets = LocalTokenBuckets()
+        empty = Bucket("empty", rate=1, burst=1)
+        other = Bucket("other", rate=1, burst=1)
+        buckets.take([empty], now=100)
+        self.assertIsNotNone(buckets.take([empty, other], now=100))
+        self.assertIsNone(buckets.take([other], now=100))
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(0.1), 1)
+        self.assertEqual(retry_after(2.5), 3)
+
+
+class TestRedisTokenBuckets(SimpleTestCase):
+    def test_falls_back_to_local_buckets(self):
+        cache = MagicMock(spec=RedisCache)
+        cache.make_key.side_effect = lambda key: key
+        cache._cache.get_client.side_effect = ConnectionError("down")
+        buckets = RedisTokenBuckets(cache)
+        bucket = Bucket("a", rate=1, burst=1)
+        with self.assertLogs("webquills.sites.ratelimit", "WARNING") as logs:
+            self.assertIsNone(buckets.take([bucket], now=100))
+            self.assertEqual(buckets.take([bucket], now=100), 1.0)
+        # Only the first failure of an outage is logged.
+        self.assertEqual(len(logs.records), 1)
+
+
+class TestIpBucketKey(SimpleTestCase):
+    def test_ipv4(self):
+        self.assertTrue(ip_bucket_key("192.0.2.1").endswith(":192.0.2.1"))
+
+    def test_ipv6_is_limited_per_network(self):
+        self.assertEqual(
+            ip_bucket_key("2001:db8::1"), ip_bucket_key("2001:db8::ffff:1234")
+        )
+        self.assertNotEqual(ip_bucket_key("2001:db8::1"), ip_bucket_key("2001:db9::1"))
+
+    def test_ipv4_mapped(self):
+        self.assertEqual(ip_bucket_key("::ffff:192.0.2.1"), ip_bucket_key("192.0.2.1"))
@@ -1,6 +1,7 @@
 import unittest
 from unittest.mock import patch
 
+import idna
 from django.core.exceptions import ValidationError
 from idna import IDNAError
 
@@ -37,6 +38,42 @@ class TestNormalizeDomain(unittest.TestCase):
         with self.assertRaises(IDNAError):
             normalize_domain("invalid_domain_###")
 
+    def test_ascii_fast_path_matches_idna(self):
+        hosts = [
+            "localhost",
+            "www.example.com",
+            "a--b.example.com",
+            "ab--c.example.com",
+            "xn--mnchen-3ya.de",
+            "xn--abc.com",
+            "-a.example.com",
+            "a-.example.com",
+            "a..b",
+            ".",
+            "1.2.3.4",
+            "a" * 63 + ".com",
+            "a" * 64 + ".com",
+            ("a" * 63 + ".") * 3 + "a" * 61,
+            ("a" * 63 + ".") * 3 + "a" * 62,
+        ]
+        for host in hosts:
+            with self.subTest(host=host):
+                try:
+                    expected = idna.encode(host.rstrip(".")).decode("ascii")
+                except IDNAError:
+                    with self.assertRaises(IDNAError):
+                        normalize_domain(host)
+                else:
+                    self.assertEqual(normalize_domain(host), expected)
+
+    def test_results_are_memoized(self):
+        normalize_domain.cache_clear()
+        normalize_domain("MüNCHEN.de")
+        with patch("webquills.sites.validators.idna.encode") as mock_encode:
+            self.assertEqual(normalize_domain("MüNCHEN.de"), "xn--mnchen-3ya.de")
+        mock_encode.assert_not_called()
+        self.assertEqual(normalize_domain.cache_info().hits, 1)
+
 
 class TestValidateSubdomain(unittest.TestCase):
     def test_valid_subdomain(self):
@@ -2,11 +2,15 @@ from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
-from django.db import DatabaseError
+from django.core.cache import cache
+from django.db import DatabaseError, connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from webquills.sites import actions
+from webquills.sites.availability import subdomain_index
+from webquills.sites.cache import domain_cache, unknown_hosts
 from webquills.sites.models import Domain, Site
 from webquills.sites.validators import domain_not_available
 
@@ -37,10 +41,19 @@ class WebQuillsViewTestCase(TestCase):
             is_primary=True,
         )
 
+    def setUp(self):
+        # Cached values (e.g. a user's site IDs, keyed by user pk) outlive the rolled
+        # back data of earlier tests.
+        cache.clear()
+        domain_cache.clear()
+        unknown_hosts.clear()
+        subdomain_index.clear()
+
 
 @override_settings(WEBQUILLS_ROOT_DOMAIN="testserver")
 class SiteCreateViewTests(WebQuillsViewTestCase):
     def setUp(self):
+        super().setUp()
         self.client.force_login(self.user)
         self.valid_data = {
             "name": "Test Site",
@@ -73,6 +86,7 @@ class SiteCreateViewTests(WebQuillsViewTestCase):
 @override_settings(WEBQUILLS_ROOT_DOMAIN="testserver")
 class SiteUpdateViewTests(WebQuillsViewTestCase):
     def setUp(self):
+        super().setUp()
         self.client.force_login(self.user)
         self.valid_data = {
             "name": "Updated Site",
@@ -107,3 +121,73 @@ class SiteUpdateViewTests(WebQuillsViewTestCase):
         self.assertContains(resp, domain_not_available)
         site.refresh_from_db()
         self.assertEqual(site.name, "Test Site")  # No changes applied
+
+    def test_other_users_site_is_not_found(self):
+        other = User.objects.create_user(username="other")
+        other.groups.add(Group.objects.get(name="regular_user"))
+        site = actions.create_site(other, name="Other Site", subdomain="other")
+        with self.assertLogs("django.request", "WARNING"):
+            response = self.client.get(reverse("site_update", args=[site.pk]))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(WEBQUILLS_ROOT_DOMAIN="testserver")
+class SiteListViewTests(WebQuillsViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def make_sites(self, count):
+        return [
+            actions.create_site(self.user, name=f"Site {i}", subdomain=f"site{i}")
+            for i in range(count)
+        ]
+
+    def listed(self, response):
+        return [site.pk for site in response.context["sites"]]
+
+    def test_lists_unarchived_sites_with_domain(self):
+        site, archived = self.make_sites(2)
+        Site.objects.filter(pk=archived.pk).update(archive_date=archived.create_date)
+        response = self.client.get(reverse("site_list"))
+        self.assertEqual(self.listed(response), [site.pk, self.site.pk])
+        self.assertEqual(response.context["site_count"], 2)
+        self.assertContains(response, "site0.testserver")
+        self.assertContains(response, reverse("site_update", args=[site.pk]))
+        self.assertNotContains(response, "site1.testserver")
+
+    @patch("webquills.sites.views.SiteListView.page_size", 2)
+    def test_keyset_pages(self):
+        sites = [*self.make_sites(4)[::-1], self.site]
+        first = self.client.get(reverse("site_list"))
+        self.assertEqual(self.listed(first), [s.pk for s in sites[:2]])
+        self.assertIsNone(first.context["newer_cursor"])
+        self.assertEqual(first.context["older_cursor"], sites[1].pk)
+
+        second = self.client.get(reverse("site_list"), {"after": sites[1].pk})
+        self.assertEqual(self.listed(second), [s.pk for s in sites[2:4]])
+        self.assertEqual(second.context["newer_cursor"], sites[2].pk)
+        self.assertEqual(second.context["older_cursor"], sites[3].pk)
+
+        last = self.client.get(reverse("site_list"), {"after": sites[3].pk})
+        self.assertEqual(self.listed(last), [sites[4].pk])
+        self.assertIsNone(last.context["older_cursor"])
+
+        back = self.client.get(reverse("site_list"), {"before": sites[2].pk})
+        self.assertEqual(self.listed(back), [s.pk for s in sites[:2]])
+        self.assertIsNone(back.context["newer_cursor"])
+        self.assertEqual(back.context["older_cursor"], sites[1].pk)
+
+    @patch("webquills.sites.views.SiteListView.page_size", 2)
+    def test_every_page_costs_the_same(self):
+        sites = self.make_sites(6)
+        self.client.get(reverse("site_list"))  # Warm the caches.
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(reverse("site_list"))
+        with CaptureQueriesContext(connection) as later:
+            self.client.get(reverse("site_list"), {"after": sites[2].pk})
+        self.assertEqual(len(first), len(later))
+
+    def test_invalid_cursor_is_ignored(self):
+        response = self.client.get(reverse("site_list"), {"after": "nope"})
+        self.assertEqual(self.listed(response), [self.site.pk])
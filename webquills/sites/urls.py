@@ -1,9 +1,19 @@
 from django.urls import path
 
-from webquills.sites.views import SiteCreateView, SiteListView, SiteUpdateView
+from webquills.sites.views import (
+    SiteCreateView,
+    SiteListView,
+    SiteUpdateView,
+    SubdomainAvailabilityView,
+)
 
 urlpatterns = [
     path("", SiteListView.as_view(), name="site_list"),
     path("create/", SiteCreateView.as_view(), name="site_create"),
     path("<int:pk>/", SiteUpdateView.as_view(), name="site_update"),
+    path(
+        "availability/",
+        SubdomainAvailabilityView.as_view(),
+        name="subdomain_availability",
+    ),
 ]
@@ -2,21 +2,37 @@
 Validation routines for webquills sites.
 """
 
+import functools
+import re
+from collections.abc import Iterable
+
 import idna
-from django.apps import apps
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 
-sites_config = apps.get_app_config("sites")
+from webquills.sites.policy import subdomain_policy
 
 # Some error messages for the form validation
 subdomain_too_long = _("Subdomain names must be 63 characters or less.")
 domain_not_available = _("This domain name is not available.")
 
 
+# A host name that is already lowercase ASCII letters, digits and hyphens (LDH), in
+# labels that IDNA would accept unchanged: 1-63 characters, not starting or ending with
+# a hyphen, and without hyphens in the 3rd and 4th positions (reserved for "xn--").
+_ldh_label = r"(?![a-z0-9]{2}--)[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?"
+_ldh_domain = re.compile(rf"{_ldh_label}(?:\.{_ldh_label})*")
+
+
+@functools.lru_cache(maxsize=4096)
 def normalize_domain(domain: str) -> str:
     """Normalize a domain name according to RFC 3986 and RFC 3987."""
+    # This runs at least once per request, and the set of host names seen is small
+    # and repetitive, so results are memoized. Most hosts are plain ASCII, so we also
+    # skip the (slow, pure-Python) IDNA codec when it would not change anything.
     domain = domain.strip().lower().rstrip(".")  # Remove trailing dots and lowercase
+    if len(domain) <= 253 and _ldh_domain.fullmatch(domain):
+        return domain
     domain = idna.encode(domain).decode("ascii")  # Convert to Punycode if needed
     return domain
 
@@ -43,8 +59,8 @@ def validate_subdomain(subdomain: str) -> None:
             code="subdomain_too_long",
             params={"subdomain": subdomain},
         )
-    # Check if the subdomain is reserved
-    if subdomain in sites_config.reserved_names:
+    # Check if the subdomain is reserved or blocked (or looks like one that is)
+    if subdomain_policy().violation(subdomain):
         raise ValidationError(
             domain_not_available,
             code="domain_not_available",
@@ -56,3 +72,18 @@ def validate_subdomain(subdomain: str) -> None:
         normalize_domain(subdomain)
     except idna.IDNAError as e:
         raise ValidationError(_("Invalid domain name.")) from e
+
+
+def validate_subdomains(subdomains: Iterable[str]) -> dict[str, ValidationError]:
+    """
+    Validate many subdomains, e.g. for an import, each as `validate_subdomain` would.
+
+    :return: The error for each invalid subdomain. Valid subdomains are not included.
+    """
+    errors = {}
+    for subdomain in set(subdomains):
+        try:
+            validate_subdomain(subdomain)
+        except ValidationError as e:
+            errors[subdomain] = e
+    return errors
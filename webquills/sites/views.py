@@ -1,13 +1,15 @@
 from django import forms
 from django.apps import apps
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
+from django.core.exceptions import ValidationError
 from django.db import DatabaseError
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
 from django.urls import reverse_lazy
 from django.utils.translation import gettext_lazy as _
-from django.views.generic import CreateView, ListView, UpdateView
+from django.views.generic import CreateView, ListView, UpdateView, View
 
 from webquills.sites.actions import create_site, update_site
+from webquills.sites.availability import subdomain_index, suggest_subdomains
 from webquills.sites.models import Site
 from webquills.sites.validators import (
     domain_not_available,
@@ -20,21 +22,55 @@ sites_config = apps.get_app_config("sites")
 
 class SiteListView(LoginRequiredMixin, ListView):
     """
-    Let's the user view a list of their (unarchived) sites.
+    Let's the user view a list of their (unarchived) sites, newest first.
+
+    Pages are keyset paginated on the primary key: `?after=<pk>` shows the sites
+    older than that site, and `?before=<pk>` those newer. Unlike offset pagination,
+    every page costs the same, however many sites the user has.
     """
 
     model = Site
     template_name = "sites/site_list.html"
     context_object_name = "sites"
-    paginate_by = 10  # FIXME: Get from settings
+    page_size = 10  # FIXME: Get from settings
+    # The user, the count, and the page of sites. See webquills.metrics.
+    query_budget = 3
 
     def get_queryset(self):
-        return Site.objects.for_user(self.request.user).filter(archived_date=None)
+        return Site.objects.for_user(self.request.user).filter(archive_date=None)
+
+    def get(self, request, *args, **kwargs):
+        sites = self.get_queryset()
+        page = (
+            sites.select_related(None)
+            .with_domain_names()
+            .only("pk", "name", "subdomain", "create_date", "modified_date")
+        )
+        after = self.get_cursor("after")
+        before = self.get_cursor("before")
+        if before is not None:
+            rows = list(page.filter(pk__gt=before).order_by("pk")[: self.page_size + 1])
+            has_newer, has_older = len(rows) > self.page_size, True
+            rows = rows[: self.page_size][::-1]
+        else:
+            if after is not None:
+                page = page.filter(pk__lt=after)
+            rows = list(page.order_by("-pk")[: self.page_size + 1])
+            has_newer, has_older = after is not None, len(rows) > self.page_size
+            rows = rows[: self.page_size]
+        self.object_list = rows
+        context = self.get_context_data(
+            site_count=sites.order_by().count(),
+            newer_cursor=rows[0].pk if rows and has_newer else None,
+            older_cursor=rows[-1].pk if rows and has_older else None,
+        )
+        return self.render_to_response(context)
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context["site_count"] = self.get_queryset().count()
-        return context
+    def get_cursor(self, name: str) -> int | None:
+        try:
+            return int(self.request.GET[name])
+        except (KeyError, ValueError):
+            return None
 
 
 class SiteEditForm(forms.ModelForm):
@@ -61,7 +97,11 @@ class SiteEditForm(forms.ModelForm):
         )
         if self.instance.pk:
             dupe_subdomain = dupe_subdomain.exclude(pk=self.instance.pk)
-        if dupe_subdomain.exists():
+        # Most names are free, which the index can tell without a query.
+        if (
+            subdomain_index.might_be_taken(normalized_subdomain)
+            and dupe_subdomain.exists()
+        ):
             raise forms.ValidationError(
                 domain_not_available, code="domain_not_available"
             )
@@ -124,15 +164,32 @@ class SiteUpdateView(PermissionRequiredMixin, UpdateView):
     template_name = "sites/site_form.html"
     success_url = reverse_lazy("site_list")
 
+    def has_permission(self):
+        """Check the permission on the site itself (see SitePermissionBackend)."""
+        # Anonymous users are sent to log in, before looking the site up.
+        if not self.request.user.is_authenticated:
+            return False
+        # Sites the user cannot access are not found, rather than forbidden.
+        self.object = self.get_object()
+        return self.request.user.has_perms(self.get_permission_required(), self.object)
+
+    def get_object(self, queryset=None):
+        if getattr(self, "object", None) is None:
+            self.object = super().get_object(queryset)
+        return self.object
+
     def get_queryset(self):
         """Constrain queryset to user's sites."""
-        return Site.objects.filter(group__in=self.request.user.groups.all())
+        if self.kwargs["pk"] not in Site.objects.accessible_ids(self.request.user):
+            return Site.objects.none()
+        return Site.objects.all()
 
     def form_valid(self, form):
         """Handle the form submission and update the Site instance."""
         try:
             update_site(
-                site=self.get_object(),
+                # A fresh copy, since validating the form modified self.object.
+                site=self.get_queryset().get(pk=self.object.pk),
                 name=form.cleaned_data["name"],
                 subdomain=form.cleaned_data["subdomain"],
             )
@@ -148,3 +205,39 @@ class SiteUpdateView(PermissionRequiredMixin, UpdateView):
         # We intentionally don't call super().form_valid() here, because it would call
         # form.save(), and our form is intentionally incomplete.
         return HttpResponseRedirect(self.get_success_url())
+
+
+class SubdomainAvailabilityView(LoginRequiredMixin, View):
+    """
+    Answers as-you-type checks of a subdomain (`?subdomain=<name>`) with JSON: whether
+    it is `available`, and if not, why (`message`) and some free `suggestions`.
+    """
+
+    raise_exception = True
+    # The user, confirming a possible hit, and (every few seconds) refreshing the
+    # subdomain index. See webquills.metrics.
+    query_budget = 3
+
+    def get(self, request, *args, **kwargs):
+        subdomain = request.GET.get("subdomain", "").strip()
+        try:
+            validate_subdomain(subdomain)
+            if subdomain_index.is_taken(normalize_domain(subdomain)):
+                raise ValidationError(domain_not_available)
+        except ValidationError as e:
+            return JsonResponse(
+                {
+                    "subdomain": subdomain,
+                    "available": False,
+                    "message": e.messages[0],
+                    "suggestions": suggest_subdomains(subdomain),
+                }
+            )
+        return JsonResponse(
+            {
+                "subdomain": subdomain,
+                "available": True,
+                "message": None,
+                "suggestions": [],
+            }
+        )
@@ -0,0 +1,139 @@
+"""
+Precompressed static output.
+
+Web servers can serve a precompressed `.gz` or `.br` sibling of a file instead of
+compressing each response on the fly (nginx `gzip_static` and `brotli_static`, Caddy
+`file_server { precompressed }`). This module writes those siblings, both for static
+files at `collectstatic` time and for published site pages.
+
+Brotli output requires the optional `brotli` package; without it, only gzip siblings
+are written.
+"""
+
+from __future__ import annotations
+
+import gzip
+import os
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+from pathlib import Path
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+if find_spec("brotli"):
+    import brotli
+else:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = frozenset(
+    {".html", ".css", ".js", ".mjs", ".svg", ".xml", ".rss", ".json", ".txt"}
+)
+# Below this size, compression saves too little to be worth a file.
+MIN_SIZE = 256
+
+
+def _encoders():
+    encoders = {".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoders[".br"] = lambda data: brotli.compress(data, quality=11)
+    return encoders
+
+
+def is_compressible(path: str | Path) -> bool:
+    return Path(path).suffix.lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def compress_file(path: str | Path, immutable: bool = False) -> list[Path]:
+    """
+    Write compressed siblings (e.g. `app.css.gz`) of a file, unless they are already
+    up to date, or compression would not make the file smaller.
+
+    :param path: The file to compress.
+    :param immutable: True if the file's name changes whenever its content does (e.g.
+        a hashed static file), so that existing siblings are always up to date.
+    :return: The siblings that were written.
+    """
+    path = Path(path)
+    if not is_compressible(path):
+        return []
+    stat = path.stat()
+    if stat.st_size < MIN_SIZE:
+        remove_compressed(path)
+        return []
+    data = None
+    written = []
+    for suffix, encode in _encoders().items():
+        sibling = path.with_name(path.name + suffix)
+        try:
+            sibling_mtime = sibling.stat().st_mtime_ns
+        except FileNotFoundError:
+            sibling_mtime = None
+        # Siblings are written after their source, so an older sibling is stale.
+        if sibling_mtime is not None and (
+            immutable or sibling_mtime >= stat.st_mtime_ns
+        ):
+            continue
+        if data is None:
+            data = path.read_bytes()
+        compressed = encode(data)
+        if len(compressed) >= len(data):
+            sibling.unlink(missing_ok=True)
+            continue
+        tmp = sibling.with_name(f".{sibling.name}.tmp")
+        tmp.write_bytes(compressed)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, sibling)
+        written.append(sibling)
+    return written
+
+
+def compress_files(
+    paths: Iterable[str | Path], immutable: bool = False, workers: int | None = None
+) -> int:
+    """
+    Compress many files in parallel (see `compress_file`). The compressors release
+    the GIL, so threads use all available cores.
+
+    :return: The number of compressed siblings written.
+    """
+    paths = [p for p in paths if is_compressible(p)]
+    if not paths:
+        return 0
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        results = pool.map(lambda path: compress_file(path, immutable), paths)
+        return sum(len(written) for written in results)
+
+
+def remove_compressed(path: str | Path) -> None:
+    """Remove any compressed siblings of a file."""
+    path = Path(path)
+    for suffix in (".gz", ".br"):
+        path.with_name(path.name + suffix).unlink(missing_ok=True)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    A `ManifestStaticFilesStorage` that also writes `.gz` and `.br` siblings of
+    compressible static files during `collectstatic`.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        names = set()
+        hashed_names = set()
+        for name, hashed_name, processed in super().post_process(
+            paths, dry_run=dry_run, **options
+        ):
+            if not isinstance(processed, Exception):
+                names.add(name)
+                if hashed_name:
+                    hashed_names.add(hashed_name)
+            yield name, hashed_name, processed
+        if dry_run:
+            return
+        # Hashed files may be rewritten on every run, but their content never changes.
+        compress_files(
+            (self.path(name) for name in hashed_names if self.exists(name)),
+            immutable=True,
+        )
+        compress_files(self.path(name) for name in names if self.exists(name))
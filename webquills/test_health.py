@@ -0,0 +1,63 @@
+import json
+import time
+from unittest.mock import MagicMock, patch
+
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+
+from webquills.health import HealthCheckMiddleware
+
+
+class TestHealthCheckMiddleware(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.get_response = MagicMock(return_value=HttpResponse("OK"))
+        self.middleware = HealthCheckMiddleware(self.get_response)
+
+    def test_liveness(self):
+        response = self.middleware(self.factory.get("/healthz"))
+        self.assertEqual(response.status_code, 200)
+        self.get_response.assert_not_called()
+
+    def test_readiness(self):
+        response = self.middleware(self.factory.get("/readyz"))
+        self.assertEqual(response.status_code, 200)
+        report = json.loads(response.content)
+        self.assertEqual(report["status"], "ok")
+        self.assertTrue(report["checks"]["database"]["ok"])
+        self.assertTrue(report["checks"]["cache"]["ok"])
+        self.assertIn("latency_ms", report["checks"]["database"])
+        self.get_response.assert_not_called()
+
+    def test_readiness_failure(self):
+        with patch.dict(
+            HealthCheckMiddleware.checks, {"cache": MagicMock(side_effect=OSError)}
+        ):
+            response = self.middleware(self.factory.get("/readyz"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            json.loads(response.content)["checks"]["cache"]["error"], "OSError"
+        )
+
+    def test_readiness_timeout(self):
+        self.middleware.timeout = 0.01
+        with patch.dict(
+            HealthCheckMiddleware.checks, {"cache": lambda: time.sleep(0.2)}
+        ):
+            response = self.middleware(self.factory.get("/readyz"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            json.loads(response.content)["checks"]["cache"]["error"], "timeout"
+        )
+
+    def test_other_paths_pass_through(self):
+        request = self.factory.get("/")
+        response = self.middleware(request)
+        self.assertEqual(response.status_code, 200)
+        self.get_response.assert_called_once_with(request)
+
+    def test_probe_skips_site_resolution(self):
+        # Through the full stack, with a Host that belongs to no site.
+        with self.assertNumQueries(0):
+            response = self.client.get("/healthz", HTTP_HOST="probe.internal")
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,180 @@
+from unittest.mock import patch
+
+from commoncontent.models import HomePage, Status
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from webquills.metrics import (
+    QueryBudgetExceeded,
+    RequestMetrics,
+    _current,
+    count_queries,
+    install_instrumentation,
+    metrics_enabled,
+    query_budget,
+    registry,
+)
+from webquills.sites import actions
+from webquills.sites.cache import domain_cache
+from webquills.sites.models import Domain
+
+
+@override_settings(
+    WEBQUILLS_ROOT_DOMAIN="example.com",
+    WEBQUILLS_METRICS_PATH="/metrics",
+    WEBQUILLS_PAGE_CACHE_TTL=0,
+    WEBQUILLS_DOMAIN_SHARED_CACHE_TTL=300,
+    STORAGES={
+        **settings.STORAGES,
+        "staticfiles": {
+            "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+        },
+    },
+)
+class TestRequestMetricsMiddleware(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Installed at startup if metrics are enabled, which they are not in tests.
+        install_instrumentation()
+
+    def setUp(self):
+        domain_cache.clear()
+        cache.clear()
+        registry.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.site = actions.create_site(self.user, "Test Site", "test")
+        HomePage.objects.create(
+            site=self.site,
+            owner=self.user,
+            title="Home",
+            slug="home",
+            admin_name="home",
+            status=Status.USABLE,
+            date_published=timezone.now(),
+        )
+        self.client.defaults["HTTP_HOST"] = "test.example.com"
+
+    def test_records_metrics_per_view(self):
+        self.assertEqual(self.client.get("/").status_code, 200)
+        requests, seconds, queries, db_seconds, cache_calls, render_seconds, _ = (
+            registry.snapshot()["home_page"]
+        )
+        self.assertEqual(requests, 1)
+        self.assertGreater(queries, 0)
+        self.assertGreater(db_seconds, 0)
+        self.assertGreater(cache_calls, 0)
+        self.assertGreater(render_seconds, 0)
+        self.assertGreater(seconds, render_seconds)
+
+    def test_prometheus_endpoint(self):
+        self.client.get("/")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "# TYPE webquills_db_queries_total counter")
+        self.assertContains(response, 'webquills_requests_total{view="home_page"} 1')
+
+    def test_prometheus_endpoint_includes_domain_cache(self):
+        self.client.get("/")
+        response = self.client.get("/metrics")
+        self.assertContains(response, 'webquills_domain_cache_lookups_total{result="')
+        self.assertContains(
+            response, 'webquills_domain_cache_entries{cache="domains"} 1'
+        )
+
+    def test_prometheus_endpoint_is_private(self):
+        with self.assertLogs("django.request", "WARNING"):
+            response = self.client.get("/metrics", REMOTE_ADDR="192.0.2.1")
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(WEBQUILLS_METRICS_LOG=True)
+    def test_structured_log(self):
+        with self.assertLogs("webquills.metrics", "INFO") as logs:
+            self.client.get("/")
+        record = logs.records[0]
+        self.assertEqual(record.view, "home_page")
+        self.assertEqual(record.site_id, self.site.pk)
+        self.assertGreater(record.db_queries, 0)
+
+    @override_settings(WEBQUILLS_QUERY_BUDGETS={"home_page": 0})
+    def test_view_budget_fails_tests(self):
+        with self.assertLogs("django.request", "ERROR"):
+            with self.assertRaisesMessage(QueryBudgetExceeded, "home_page issued"):
+                self.client.get("/")
+
+    @override_settings(
+        WEBQUILLS_QUERY_BUDGETS={"home_page": 0}, WEBQUILLS_QUERY_BUDGET_ACTION="log"
+    )
+    def test_view_budget_warns_in_production(self):
+        with self.assertLogs("webquills.metrics", "WARNING"):
+            self.assertEqual(self.client.get("/").status_code, 200)
+        self.assertEqual(registry.snapshot()["home_page"][-1], 1)
+
+    def test_sites_middleware_budget(self):
+        get_for_request = Domain.objects.get_for_request
+
+        def extra_query(request):
+            User.objects.count()
+            return get_for_request(request)
+
+        with patch.object(Domain.objects, "get_for_request", extra_query):
+            with self.assertLogs("django.request", "ERROR"):
+                with self.assertRaisesMessage(QueryBudgetExceeded, "SitesMiddleware"):
+                    self.client.get("/")
+
+
+class TestMetricsEnabled(SimpleTestCase):
+    @override_settings(WEBQUILLS_METRICS_PATH=None, WEBQUILLS_METRICS_LOG=False)
+    def test_disabled_by_default(self):
+        self.assertFalse(metrics_enabled())
+
+    @override_settings(WEBQUILLS_METRICS_PATH=None, WEBQUILLS_METRICS_LOG=True)
+    def test_enabled_by_either_setting(self):
+        self.assertTrue(metrics_enabled())
+        with override_settings(
+            WEBQUILLS_METRICS_PATH="/metrics", WEBQUILLS_METRICS_LOG=False
+        ):
+            self.assertTrue(metrics_enabled())
+
+
+class TestQueryBudget(TestCase):
+    def run_queries(self, count):
+        with connection.cursor() as cursor:
+            for _ in range(count):
+                cursor.execute("SELECT 1")
+
+    def test_query_budget(self):
+        count_queries()
+        token = _current.set(RequestMetrics())
+        try:
+            with query_budget("block", 2):
+                self.run_queries(2)
+            with self.assertRaisesMessage(QueryBudgetExceeded, "block issued 3"):
+                with query_budget("block", 2):
+                    self.run_queries(3)
+        finally:
+            _current.reset(token)
+
+    def test_budgeted_queries_are_counted_once(self):
+        count_queries()
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            with query_budget("outer", 3):
+                self.run_queries(1)
+                with query_budget("inner", 2):
+                    self.run_queries(2)
+            self.run_queries(1)
+        finally:
+            _current.reset(token)
+        self.assertEqual(metrics.queries, 4)
+        # Not counted towards the view's budget.
+        self.assertEqual(metrics.budgeted_queries, 3)
+
+    def test_unmeasured_code_has_no_budget(self):
+        with query_budget("block", 0):
+            self.run_queries(1)
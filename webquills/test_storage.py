@@ -0,0 +1,100 @@
+import gzip
+import os
+import tempfile
+from pathlib import Path
+from unittest import skipUnless
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase
+
+from webquills import storage
+from webquills.storage import (
+    CompressedManifestStaticFilesStorage,
+    compress_file,
+    compress_files,
+    remove_compressed,
+)
+
+CSS = b"body { color: black; }\n" * 100
+
+
+class TestCompressFile(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_writes_gzip_sibling(self):
+        path = self.dir / "app.css"
+        path.write_bytes(CSS)
+        written = compress_file(path)
+        self.assertIn(self.dir / "app.css.gz", written)
+        self.assertEqual(gzip.decompress((self.dir / "app.css.gz").read_bytes()), CSS)
+
+    @skipUnless(storage.brotli, "brotli is not installed")
+    def test_writes_brotli_sibling(self):
+        path = self.dir / "app.css"
+        path.write_bytes(CSS)
+        compress_file(path)
+        self.assertEqual(
+            storage.brotli.decompress((self.dir / "app.css.br").read_bytes()), CSS
+        )
+
+    def test_skips_up_to_date_siblings(self):
+        path = self.dir / "app.css"
+        path.write_bytes(CSS)
+        compress_file(path)
+        self.assertEqual(compress_file(path), [])
+        # A rewritten source makes its siblings stale.
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertIn(self.dir / "app.css.gz", compress_file(path))
+
+    def test_immutable_files_keep_siblings(self):
+        path = self.dir / "app.0123456789ab.css"
+        path.write_bytes(CSS)
+        compress_file(path)
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(compress_file(path, immutable=True), [])
+
+    def test_skips_small_and_incompressible_files(self):
+        small = self.dir / "small.css"
+        small.write_bytes(b"body {}")
+        image = self.dir / "image.png"
+        image.write_bytes(CSS)
+        self.assertEqual(compress_files([small, image]), 0)
+        self.assertEqual(
+            sorted(p.name for p in self.dir.iterdir()), ["image.png", "small.css"]
+        )
+
+    def test_remove_compressed(self):
+        path = self.dir / "app.css"
+        path.write_bytes(CSS)
+        compress_file(path)
+        remove_compressed(path)
+        self.assertEqual([p.name for p in self.dir.iterdir()], ["app.css"])
+
+
+class TestCompressedManifestStaticFilesStorage(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = Path(self.tmpdir.name)
+        self.source = FileSystemStorage(location=root / "source")
+        self.storage = CompressedManifestStaticFilesStorage(location=root / "static")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_post_process_compresses_hashed_files(self):
+        self.source.save("css/app.css", ContentFile(CSS))
+        self.storage.save("css/app.css", ContentFile(CSS))
+        paths = {"css/app.css": (self.source, "css/app.css")}
+        processed = list(self.storage.post_process(paths))
+        hashed_name = processed[0][1]
+        self.assertNotEqual(hashed_name, "css/app.css")
+        self.assertTrue(self.storage.exists(f"{hashed_name}.gz"))
+        self.assertTrue(self.storage.exists("css/app.css.gz"))